@@ -0,0 +1,162 @@
+import time
+import threading
+import logging
+from typing import Dict, List, Optional, Callable, Set, Tuple
+
+from .buttons import Button, ButtonSlot
+from .button_style import ButtonStyle
+from .images import load_animation_frames, KeyImageEncoder
+
+
+logger = logging.getLogger(__name__)
+
+
+class FrameClock:
+    """
+    A single thread that advances every visible AnimatedButton.
+
+    `fps` caps how often any one animation can change, and `budget` caps the
+    number of frames written per second across all animations combined. When
+    the writer already has more than `max_backlog` keys waiting, frames are
+    skipped instead of queued so animations stay on time instead of lagging.
+    """
+    _shared: Optional['FrameClock'] = None
+    buttons: Set['AnimatedButton']
+
+    def __init__(self, fps:int=30, budget:int=120, max_backlog:int=4):
+        self.fps = fps
+        self.budget = budget
+        self.max_backlog = max_backlog
+        self.buttons = set()
+        self.paused = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls) -> 'FrameClock':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def pause(self):
+        """stop advancing animations (the thread sleeps) until `resume`"""
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify()
+
+    def register(self, button:'AnimatedButton'):
+        with self.condition:
+            button.next_frame_at = time.monotonic() + button.durations[button.frame_index]
+            self.buttons.add(button)
+            self.condition.notify()
+
+    def unregister(self, button:'AnimatedButton'):
+        with self.condition:
+            self.buttons.discard(button)
+
+    def _run(self):
+        tick = 1 / self.fps
+        # frames we're allowed to write; refills at `budget` per second
+        tokens = float(self.budget)
+        last = time.monotonic()
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.buttons and not self.paused)
+                buttons = sorted(self.buttons, key=lambda b: b.next_frame_at)
+
+            now = time.monotonic()
+            tokens = min(float(self.budget), tokens + (now - last) * self.budget)
+            last = now
+
+            for button in buttons:
+                if button.next_frame_at > now:
+                    break
+                if tokens < 1:
+                    # out of budget; the most overdue buttons go first next tick
+                    break
+                slot = button.slot
+                if slot is None:
+                    continue
+                button.advance(now)
+                backlog = getattr(slot.sd, 'backlog', None)
+                if backlog is not None and backlog() > self.max_backlog:
+                    continue
+                tokens -= 1
+                try:
+                    slot.set_image()
+                except Exception as e:
+                    logger.exception(f"Failed to draw animation frame; error: {e}")
+
+            with self.condition:
+                next_frame_at = min((b.next_frame_at for b in self.buttons), default=now + tick)
+                # registering a new button wakes us early
+                self.condition.wait(max(tick, next_frame_at - time.monotonic()))
+
+
+class AnimatedButton(Button):
+    """
+    A button that plays an animated GIF or APNG.
+
+    Every frame is decoded, resized, rotated and encoded once up front, so
+    showing a frame is just a key write. The button only animates while it's
+    attached to a slot, i.e. while its page is the one being shown.
+    """
+    __slots__ = ('image_path', 'frames', 'durations', 'frame_index', 'next_frame_at', 'clock')
+    image_path: str
+    frames: Dict[Tuple[KeyImageEncoder, int], List[bytes]]
+    durations: List[float]
+    frame_index: int
+    next_frame_at: float
+    clock: FrameClock
+
+    def __init__(
+        self, image_path:str,
+        fn:Optional[Callable]=None, name:Optional[str]=None,
+        text:Optional[str]='',
+        button_switches_page:bool=False, style:ButtonStyle=ButtonStyle(),
+        rotation:int=0, clock:Optional[FrameClock]=None,
+    ):
+        super().__init__(fn, name, text, button_switches_page, style)
+        self.image_path = image_path
+        self.frames = dict()
+        self.frame_index = 0
+        self.next_frame_at = 0
+        self.clock = clock or FrameClock.shared()
+        self.get_frames(rotation, KeyImageEncoder.default)
+
+    def get_frames(self, rotation:int, encoder:KeyImageEncoder) -> List[bytes]:
+        key = (encoder.key(), rotation)
+        if key not in self.frames:
+            self.frames[key], self.durations = load_animation_frames(
+                self.image_path, self.style.size, rotation, self.style.background_color,
+                encoder=encoder,
+            )
+        return self.frames[key]
+
+    def advance(self, now:float):
+        """move to the frame that should be showing at `now`, skipping any we're late for"""
+        total = sum(self.durations)
+        if now - self.next_frame_at > total:
+            # we've been paused or starved for a whole loop; don't replay it
+            self.next_frame_at = now
+        while self.next_frame_at <= now:
+            self.frame_index = (self.frame_index + 1) % len(self.durations)
+            self.next_frame_at += self.durations[self.frame_index]
+
+    def set_slot(self, slot:ButtonSlot):
+        super().set_slot(slot)
+        if len(self.durations) > 1:
+            self.clock.register(self)
+
+    def clear_slot(self):
+        super().clear_slot()
+        self.clock.unregister(self)
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        frames = self.get_frames(rotation, encoder)
+        return frames[self.frame_index % len(frames)]
@@ -0,0 +1,134 @@
+"""
+Compare JPEG encoding policies by payload size and simulated USB transfer time.
+
+    python -m vsdlib.bench
+    python -m vsdlib.bench --max-bytes 1016 --image some_icon.png --image photo.jpg
+
+Each key image is sent as a series of fixed-size HID reports, padded out to the
+full report length, so what matters is how many reports a payload needs.
+"""
+import argparse
+import io
+import importlib
+import math
+import time
+from typing import Dict, List, Tuple, Optional
+
+from PIL import Image as PILImage
+from PIL.Image import Image
+
+from .button_style import ButtonStyle
+from .colors import purples, greens, blues, grays, whites, black
+from .images import (
+    KeyImageEncoder, EncodingPolicy, LOSSLESS_ISH, FLAT, PHOTO, default_policies,
+    generate_text_image,
+)
+
+# full-speed USB interrupt endpoints move at most 64 bytes per 1ms frame
+FULL_SPEED_HID_BYTES_PER_SECOND = 64_000
+
+
+class BenchNamespace(argparse.Namespace):
+    deck: str = 'StreamDeckXL'
+    max_bytes: List[int]
+    image: List[str]
+    link_bytes_per_second: int = FULL_SPEED_HID_BYTES_PER_SECOND
+    repeat: int = 5
+
+
+def parse_args() -> BenchNamespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--deck', default=BenchNamespace.deck, help='StreamDeck device class to model. default: %(default)s')
+    parser.add_argument('--max-bytes', type=int, action='append', default=[], help='also try the default policies with this payload ceiling (repeatable)')
+    parser.add_argument('--image', action='append', default=[], help='image file to use as a photographic sample (repeatable)')
+    parser.add_argument('--link-bytes-per-second', type=int, default=BenchNamespace.link_bytes_per_second, help='simulated link throughput. default: %(default)s (full-speed HID)')
+    parser.add_argument('--repeat', type=int, default=BenchNamespace.repeat, help='encodes per sample when timing. default: %(default)s')
+    return parser.parse_args(namespace=BenchNamespace())
+
+
+def get_deck_class(name:str):
+    module = importlib.import_module(f'StreamDeck.Devices.{name}')
+    return getattr(module, name)
+
+
+def render_flat_samples(size:Tuple[int,int]) -> List[Image]:
+    """text keys like the ones main_helper produces from a toml file"""
+    ButtonStyle.set_size(size)
+    raw = KeyImageEncoder(size, format='BMP')
+    samples = []
+    for text, colors in [
+        ('g', purples), ('FSD', purples), ('Landing\n Gear', greens),
+        ('Panel 1', blues), ('12:34:56\n 01-02M\n  2024', whites), ('Clr', grays),
+    ]:
+        style = ButtonStyle(**colors, text_color=black)
+        bmp = generate_text_image(style.background_color, style, text, encoder=raw)
+        samples.append(PILImage.open(io.BytesIO(bmp)).convert('RGB'))
+    return samples
+
+
+def load_photo_samples(size:Tuple[int,int], paths:List[str]) -> List[Image]:
+    samples = []
+    for path in paths:
+        with PILImage.open(path) as image:
+            samples.append(image.convert('RGB').resize(size))
+    if not samples:
+        # stand-ins for icons/photos: lots of detail and smooth gradients
+        samples.append(PILImage.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100).convert('RGB'))
+        noise = PILImage.effect_noise(size, 64).convert('RGB')
+        gradient = PILImage.linear_gradient('L').resize(size).convert('RGB')
+        samples.append(PILImage.blend(noise, gradient, 0.7))
+    return samples
+
+
+def measure(
+    encoder:KeyImageEncoder, frame_class:str, samples:List[Image], repeat:int,
+) -> Tuple[List[int], float]:
+    sizes = [len(encoder.encode(img, frame_class)) for img in samples]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in samples:
+            encoder.encode(img, frame_class)
+    seconds_per_encode = (time.perf_counter() - start) / (repeat * len(samples))
+    return sizes, seconds_per_encode
+
+
+def main():
+    args = parse_args()
+    deck = get_deck_class(args.deck)
+    size = (deck.KEY_PIXEL_WIDTH, deck.KEY_PIXEL_HEIGHT)
+    report_length = getattr(deck, 'IMAGE_REPORT_LENGTH', 1024)
+    report_payload = getattr(deck, 'IMAGE_REPORT_PAYLOAD_LENGTH', report_length - 8)
+
+    samples: Dict[str, List[Image]] = {
+        FLAT: render_flat_samples(size),
+        PHOTO: load_photo_samples(size, args.image),
+    }
+
+    policies: List[Tuple[str, Dict[str, EncodingPolicy], Optional[int]]] = [
+        ('q100 4:4:4', {FLAT: LOSSLESS_ISH, PHOTO: LOSSLESS_ISH}, None),
+        ('default', default_policies, None),
+    ]
+    for max_bytes in args.max_bytes:
+        policies.append((f'default <= {max_bytes}B', default_policies, max_bytes))
+
+    print(f"{args.deck}: {size[0]}x{size[1]} keys, {deck.KEY_COUNT} keys, "
+          f"{report_length}B reports ({report_payload}B payload), "
+          f"link {args.link_bytes_per_second} B/s")
+    header = f"{'policy':<22}{'class':<7}{'avg B':>8}{'max B':>8}{'reports':>9}{'ms/key':>9}{'ms/page':>9}{'enc ms':>8}"
+    print(header)
+    print('-' * len(header))
+    for name, policy_set, max_bytes in policies:
+        encoder = KeyImageEncoder(size, format='JPEG', policies=policy_set, max_bytes=max_bytes)
+        for frame_class, class_samples in samples.items():
+            sizes, seconds_per_encode = measure(encoder, frame_class, class_samples, args.repeat)
+            reports = sum(math.ceil(s / report_payload) for s in sizes) / len(sizes)
+            transfer = reports * report_length / args.link_bytes_per_second
+            print(
+                f"{name:<22}{frame_class:<7}{sum(sizes)/len(sizes):>8.0f}{max(sizes):>8}"
+                f"{reports:>9.2f}{transfer*1000:>9.1f}{transfer*deck.KEY_COUNT*1000:>9.0f}"
+                f"{seconds_per_encode*1000:>8.2f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""
+Button text and colors that follow something outside the deck.
+
+    bind(button, CommandSource('nmcli -t -f STATE general', interval=5), text='net\\n{value}')
+    bind(clock, TimerSource(1), text=lambda now: now.strftime('%H:%M:%S'))
+    bind(mic, FileSource('/tmp/mic-state'), background_color=lambda v: reds['background_color'] if v == 'muted' else greens['background_color'])
+
+Each field is a format string (with `{value}`) or a function of the value.
+Sources are shared: every binding to an equal source (the same command and
+interval, the same file, ...) is served by a single poll, and only sources
+something is bound to are polled. A poll that returns the same value as last
+time does nothing, and a binding whose fields come out the same as last time
+doesn't redraw its key.
+"""
+import os
+import time
+import heapq
+import weakref
+import datetime
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from .buttons import Button, apply_update, render_batch, UPDATE_FIELDS
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# a source hasn't produced a value yet (or its last poll failed)
+MISSING: Any = object()
+
+
+class Source:
+    """
+    Something polled every `interval` seconds. Sources are interned like
+    ButtonStyle: constructing one equal to an existing source returns that
+    source, which is what lets bindings share polls.
+    """
+    _interned: 'weakref.WeakValueDictionary[tuple, Source]' = weakref.WeakValueDictionary()
+    _interned_lock = threading.Lock()
+    key: tuple
+    interval: float
+    value: Any
+    # poll on wall-clock multiples of `interval`, e.g. right as each second starts
+    aligned: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        key = (cls,) + cls.identity(*args, **kwargs)
+        with cls._interned_lock:
+            source = cls._interned.get(key)
+            if source is None:
+                source = super().__new__(cls)
+                source.key = key
+                source.value = MISSING
+                source.setup(*args, **kwargs)
+                cls._interned[key] = source
+        return source
+
+    @classmethod
+    def identity(cls, *args, **kwargs) -> Tuple[Hashable, ...]:
+        raise NotImplementedError
+
+    def setup(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def read(self) -> Any:
+        raise NotImplementedError
+
+    def close(self):
+        """let go of anything kept open between polls; called once nothing's bound to it. the next poll reopens it"""
+
+    def next_delay(self) -> float:
+        if self.aligned:
+            return self.interval - time.time() % self.interval
+        return self.interval
+
+    def __repr__(self):
+        return f'{type(self).__name__}{self.key[1:]!r}'
+
+
+class FileSource(Source):
+    """a file's contents, stripped; None if it doesn't exist. only re-read when its mtime or size changes"""
+    def __new__(cls, path:str, interval:float=1.0):
+        return super().__new__(cls, path, interval)
+
+    @classmethod
+    def identity(cls, path:str, interval:float=1.0):
+        return (os.path.abspath(path), interval)
+
+    def setup(self, path:str, interval:float=1.0):
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.signature: Optional[Tuple[int, int]] = None
+
+    def read(self) -> Optional[str]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.signature = None
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.signature and self.value is not MISSING:
+            return self.value
+        with open(self.path) as fr:
+            text = fr.read().strip()
+        self.signature = signature
+        return text
+
+
+class CommandSource(Source):
+    """a shell command's output, stripped. the command is killed after `timeout` (default: `interval`) seconds"""
+    def __new__(cls, command:str, interval:float=5.0, timeout:Optional[float]=None):
+        return super().__new__(cls, command, interval, timeout)
+
+    @classmethod
+    def identity(cls, command:str, interval:float=5.0, timeout:Optional[float]=None):
+        return (command, interval, timeout)
+
+    def setup(self, command:str, interval:float=5.0, timeout:Optional[float]=None):
+        self.command = command
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else max(interval, 1.0)
+
+    def read(self) -> str:
+        result = subprocess.run(self.command, shell=True, capture_output=True, text=True, timeout=self.timeout)
+        if result.returncode != 0:
+            logger.debug("'%s' exited with %s: %s", self.command, result.returncode, result.stderr.strip())
+        return result.stdout.strip()
+
+
+class TimerSource(Source):
+    """the local time, truncated to the second, every `interval` seconds on the dot"""
+    aligned = True
+
+    def __new__(cls, interval:float=1.0):
+        return super().__new__(cls, interval)
+
+    @classmethod
+    def identity(cls, interval:float=1.0):
+        return (interval,)
+
+    def setup(self, interval:float=1.0):
+        self.interval = interval
+
+    def read(self) -> datetime.datetime:
+        return datetime.datetime.now().replace(microsecond=0)
+
+
+class CallableSource(Source):
+    """whatever `fn()` returns. shared by everything bound to the same function and interval"""
+    def __new__(cls, fn:Callable[[], Any], interval:float=1.0):
+        return super().__new__(cls, fn, interval)
+
+    @classmethod
+    def identity(cls, fn:Callable[[], Any], interval:float=1.0):
+        return (fn, interval)
+
+    def setup(self, fn:Callable[[], Any], interval:float=1.0):
+        self.fn = fn
+        self.interval = interval
+
+    def read(self) -> Any:
+        return self.fn()
+
+
+Field = Union[str, Callable[[Any], Any]]
+
+
+class Binding:
+    """
+    Keeps some of a button's UPDATE_FIELDS in step with a source. Only holds
+    a weak reference to the button, so a button that's dropped (e.g. its page
+    was evicted) is unbound automatically.
+    """
+    fields: Dict[str, Field]
+    last: Optional[Dict[str, Any]]
+
+    def __init__(self, button:Button, source:Source, scheduler:'SourceScheduler', **fields:Field):
+        unknown = set(fields) - set(UPDATE_FIELDS)
+        if unknown:
+            raise ValueError(f"can't bind {sorted(unknown)}; fields are {list(UPDATE_FIELDS)}")
+        self.source = source
+        self.scheduler = scheduler
+        self.fields = fields or {'text': '{value}'}
+        self.last = None
+        self.button = weakref.ref(button, lambda _: scheduler.remove(self))
+
+    def evaluate(self, value:Any) -> Dict[str, Any]:
+        return {
+            name: field(value) if callable(field) else field.format(value=value)
+            for name, field in self.fields.items()
+        }
+
+    def apply(self, value:Any):
+        button = self.button()
+        if button is None:
+            return
+        try:
+            fields = self.evaluate(value)
+        except Exception as e:
+            logger.exception(f"Binding {self.source} to button {button.name or button.text!r} failed; error: {e}")
+            return
+        if fields == self.last:
+            return
+        self.last = fields
+        apply_update(button, fields)
+
+    def unbind(self):
+        self.scheduler.remove(self)
+
+
+class SourceScheduler:
+    """
+    Polls every source that has bindings, each on its own interval, from one
+    scheduling thread. Polls run on a few worker threads so a slow command
+    doesn't hold up the clock; a source is never polled again while its last
+    poll is still running. All the buttons bound to a source are redrawn as
+    one batch.
+    """
+    _shared: Optional['SourceScheduler'] = None
+    bindings: Dict[Source, List[Binding]]
+    heap: List[Tuple[float, int, Source]]
+    # sources with an entry in `heap`
+    queued: Set[Source]
+    in_flight: Set[Source]
+
+    def __init__(self, max_workers:int=4):
+        self.bindings = dict()
+        self.heap = []
+        self.queued = set()
+        self.in_flight = set()
+        self.sequence = 0
+        self.paused = False
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='vsdlib-source')
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls) -> 'SourceScheduler':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def add(self, binding:Binding):
+        source = binding.source
+        with self.condition:
+            bindings = self.bindings.get(source)
+            if bindings is None:
+                bindings = self.bindings[source] = []
+                self._schedule(source, 0)
+            bindings.append(binding)
+            value = source.value
+        if value is not MISSING:
+            # another binding already polled it; no need to wait for the next poll
+            binding.apply(value)
+
+    def remove(self, binding:Binding):
+        with self.condition:
+            bindings = self.bindings.get(binding.source)
+            if bindings is None or binding not in bindings:
+                return
+            bindings.remove(binding)
+            if not bindings:
+                # its heap entry is skipped when it comes up
+                del self.bindings[binding.source]
+                if binding.source not in self.in_flight:
+                    # (otherwise it's closed when that poll finishes)
+                    binding.source.close()
+
+    def pause(self):
+        """stop polling (e.g. while the deck is idle) until `resume`"""
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            # everything is probably out of date; poll it all now
+            self.heap = []
+            self.queued = set()
+            for source in self.bindings:
+                self._schedule(source, 0)
+            self.condition.notify()
+
+    def _schedule(self, source:Source, delay:float):
+        if source in self.queued:
+            return
+        self.queued.add(source)
+        self.sequence += 1
+        heapq.heappush(self.heap, (time.monotonic() + delay, self.sequence, source))
+        self.condition.notify()
+
+    def _run(self):
+        with self.condition:
+            while True:
+                self.condition.wait_for(lambda: self.heap and not self.paused)
+                due, _, source = self.heap[0]
+                remaining = due - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                heapq.heappop(self.heap)
+                self.queued.discard(source)
+                if source not in self.bindings or source in self.in_flight:
+                    # unbound, or already polling; the running poll reschedules it
+                    continue
+                self.in_flight.add(source)
+                self.executor.submit(self._poll, source)
+
+    def _poll(self, source:Source):
+        metrics.source_polls.inc(kind=type(source).__name__)
+        try:
+            value = source.read()
+        except Exception as e:
+            logger.warning("polling %s failed; error: %s", source, e)
+            value = MISSING
+        with self.condition:
+            self.in_flight.discard(source)
+            if source in self.bindings:
+                self._schedule(source, source.next_delay())
+            else:
+                source.close()
+            changed = value is not MISSING and value != source.value
+            if changed:
+                source.value = value
+            bindings = list(self.bindings.get(source, ()))
+        if not changed:
+            return
+        with render_batch():
+            for binding in bindings:
+                binding.apply(value)
+
+
+def bind(
+    button:Button, source:Source, scheduler:Optional[SourceScheduler]=None, **fields:Field,
+) -> Binding:
+    """keep `fields` of `button` (default: its text) in step with `source`. see the module docstring"""
+    scheduler = scheduler or SourceScheduler.shared()
+    binding = Binding(button, source, scheduler, **fields)
+    scheduler.add(binding)
+    return binding
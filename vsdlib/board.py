@@ -1,5 +1,8 @@
 import time
-from typing import Dict, Optional, Tuple, Callable, List, Type, TypeVar
+import asyncio
+import threading
+import logging
+from typing import Dict, Iterable, Optional, Tuple, Callable, List, Type, TypeVar, TYPE_CHECKING
 
 # here's a change to test poetry update..
 # from PyQt5.QtWidgets import QApplication, QWidget
@@ -9,8 +12,19 @@ from StreamDeck.Devices.StreamDeck import StreamDeck
 # from StreamDeck.Transport.Transport import Transport
 
 from .button_style import ButtonStyle
-from .buttons import Button, ButtonSlot
+from .buttons import Button, ButtonSlot, blank_button, recolor_buttons
 from .colors import black, reds, blues, greens, grays
+from .writer import KeyWriter
+from .images import KeyImageEncoder
+from .bundle import RenderBundle
+from . import metrics
+
+if TYPE_CHECKING:
+    from .idle import IdleManager
+    from .journal import KeyRecorder
+
+
+logger = logging.getLogger(__name__)
 
 # T = TypeVar('T')
 def retry(max_count=20, seconds=1):
@@ -55,15 +69,19 @@ class BoardLayout:
 
     def __init__(self):
         self._check_initialized()
-        self.positions = {
-            i: Button()
-            for i in range(self.key_count)
-        }
+        # sparse: only keys that have been set. everything else shows the shared blank button
+        self.positions = dict()
 
     def set(self, button:Button, x, y=None):
         index = self.calc_index(x, y)
         self.positions[index] = button
 
+    def get(self, x, y=None) -> Button:
+        return self.positions.get(self.calc_index(x, y), blank_button)
+
+    def unset(self, x, y=None):
+        self.positions.pop(self.calc_index(x, y), None)
+
     def refresh(self):
         if self.board.active_board_layout is self:
             self.board.apply(self)
@@ -112,10 +130,19 @@ class Board:
     _height: int
     rotation: int
     timers: Dict[int, float]
+    writer: KeyWriter
+    encoder: KeyImageEncoder
     display_keys: Dict[str, int]
+    key_listeners: List[Callable[[int, bool, Button], None]]
     dm: DeviceManager
     default_button_name: Optional[str] = None
     shutdown: bool = False
+    # set by IdleManager.start
+    idle: Optional['IdleManager'] = None
+    # set by KeyRecorder.start
+    recorder: Optional['KeyRecorder'] = None
+    # cleared while idle; periodic widgets wait on it
+    awake: threading.Event
     debug_button: Button
     debug: bool
 
@@ -134,13 +161,17 @@ class Board:
         self.brightness = 30
         self.timers = dict()
         self.display_keys = dict()
+        self.key_listeners = []
+        self.awake = threading.Event()
+        self.awake.set()
         self.debug_button = Button(self._switch_debug, text='Debug', style=ButtonStyle(**grays))
         self.debug = False
         #TODO set rotation from Board(...) input
         self.rotation = 0
 
         # get_boards_fn = retry(10)(self.enumerate)
-        if sd is not None and dm is not None:
+        if sd is not None:
+            # e.g. a RemoteStreamDeck, which has no DeviceManager on this side
             self.sd = sd
             self.dm = dm
         else:
@@ -170,26 +201,58 @@ class Board:
             self.sd.set_brightness(self.brightness)
 
         self.key_count = self.sd.key_count()
-        self.size = self.sd.key_image_format()['size']
+        self.encoder = KeyImageEncoder.for_device(self.sd)
+        KeyImageEncoder.set_default(self.encoder)
+        self.size = self.encoder.size
         ButtonStyle.set_size(self.size)
         self._width = self.sd.KEY_COLS
         self._height = self.key_count//self.sd.KEY_COLS
         BoardLayout.initialize(self)
 
         self.active_board_layout = None
+        self.buttons = dict()
 
+        # all key images go out through one writer thread so a slow USB write
+        # doesn't hold up key handlers or animations
+        self.writer = KeyWriter(self.sd)
+        KeyImageEncoder.attach(self.writer, self.encoder)
         self.slots = {
-            i: ButtonSlot(i, self.sd)
+            i: ButtonSlot(i, self.writer)
             for i in range(self.sd.key_count())
         }
 
-        self.sd.set_key_callback_async(self.handle_key_event)
+        # kept so the callback can be set again on a reconnected device
+        self.loop = asyncio.get_event_loop()
+        self.sd.set_key_callback_async(self.handle_key_event, self.loop)
         # self.sd.set_key_callback(self.handle_key_event)
         # self.app = QApplication([])
 
+    def set_brightness(self, percent:int):
+        """set (and remember, e.g. for after a reconnect) the deck's brightness"""
+        self.brightness = percent
+        self.sd.set_brightness(percent)
+
     def set_rotation(self, degrees:int=0):
         self.rotation = degrees
 
+    def load_bundle(self, path:str) -> RenderBundle:
+        """serve key images from a bundle made by `vsdlib compile` where possible"""
+        if self.encoder.bundle is not None:
+            self.encoder.bundle.close()
+        self.encoder.bundle = RenderBundle(path)
+        return self.encoder.bundle
+
+    def recolor(self, colors:Dict[str, str], layouts:Iterable[BoardLayout]=()) -> int:
+        """
+        a theme switch: replace every background, text and pressed color found
+        in `colors` on the keys showing and on every button of `layouts`. see
+        recolor_buttons
+        """
+        buttons = [slot.button for slot in self.slots.values()] + [self.debug_button]
+        for layout in layouts:
+            buttons.extend(layout.positions.values())
+        return recolor_buttons(buttons, colors)
+
     def _switch_debug(self, pressed:bool):
         if not pressed:
             return
@@ -209,9 +272,9 @@ class Board:
     def calc_index(self, x, y=None):
         return x if y is None else y*self.width+x
 
-    def get(self, x, y=None):
+    def get(self, x, y=None) -> Button:
         index = self.calc_index(x, y)
-        return self.buttons[index]
+        return self.buttons.get(index, blank_button)
 
     def set_button(
         self, x, y=None, fn:Optional[Callable]=None, name:Optional[str]=None,
@@ -221,24 +284,44 @@ class Board:
         button_switches_page=None,
     ):
         index = self.calc_index(x, y)
-        button: Button = self.buttons[index]
+        button: Button = self.get(index)
+        if button is blank_button:
+            # empty key; give it a button of its own instead of changing the shared blank one
+            button = Button()
+            self.buttons[index] = button
+            self.slots[index].set_button(button, rotation=self.rotation)
 
         button.set(fn, name, text, text_color, font_size,
                    background_color,
                    button_switches_page)
 
+    def set_display_key(self, name:str, x, y=None):
+        """name the button on this key so it can be found (and changed) by name"""
+        index = self.calc_index(x, y)
+        if self.get(index) is blank_button:
+            self.set_button(index)
+        self.get(index).set(name=name)
+        self.display_keys[name] = index
+
     def unset_display_key(self, name:str):
         index = self.display_keys[name]
-        self.buttons[index].reset()
+        button = self.get(index)
+        if button is not blank_button:
+            button.reset()
+            button.name = None
         del self.display_keys[name]
 
     async def handle_key_event(self, sd:StreamDeck, index:int, pressed:bool):
     # def handle_key_event(self, sd:StreamDeck, index:int, pressed:bool):
-        button = self.buttons[index]
+        if self.idle is not None and not self.idle.handle_key_event(index, pressed):
+            return
+        if self.recorder is not None:
+            self.recorder.record(index, pressed)
+        button = self.get(index)
         if pressed:
             self.timers[index] = time.time()
         elif index in self.timers:
-            print(time.time()-self.timers[index])
+            metrics.key_hold_seconds.observe(time.time()-self.timers.pop(index))
 
         # if pressed and self.debug:
         #     try:
@@ -247,20 +330,38 @@ class Board:
         #         pass
 
         button.handle_button_event(pressed)
+        start = time.perf_counter()
         button(sd, index, pressed)
+        metrics.handler_seconds.observe(time.perf_counter() - start, button=button.name or f'key{index}')
+        for listener in self.key_listeners:
+            try:
+                listener(index, pressed, button)
+            except Exception:
+                logger.exception("key listener %s failed", listener)
+
+    def add_key_listener(self, listener:Callable[[int, bool, Button], None]):
+        """call `listener(index, pressed, button)` after every key event"""
+        self.key_listeners.append(listener)
+
+    def remove_key_listener(self, listener:Callable[[int, bool, Button], None]):
+        if listener in self.key_listeners:
+            self.key_listeners.remove(listener)
 
     # async def handle_key_event(*args, **kwargs):
     #     print("handle_key_event", args, kwargs)
 
 
     def close(self):
+        self.writer.close()
         self.sd.close()
 
     def apply(self, layout:BoardLayout):
+        start = time.perf_counter()
         self.active_board_layout = layout
         self.buttons = layout.positions
-        for i in self.buttons.keys():
-            self.slots[i].set_button(self.buttons[i], rotation=self.rotation)
+        for i, slot in self.slots.items():
+            slot.set_button(self.buttons.get(i, blank_button), rotation=self.rotation)
+        metrics.page_switch_seconds.observe(time.perf_counter() - start)
         # for index, button in layout.positions.items():
         #     self.buttons[index] = button
         # self.sd.set_key_callback(self.handle_key_event)
@@ -0,0 +1,100 @@
+"""
+Pre-rendered key payloads, so a layout that rarely changes needs no PIL work
+at startup or when switching pages.
+
+`vsdlib compile layout.toml` renders every button of the layout into a bundle
+file; `vsdlib layout.toml --bundle layout.vsdb` memory-maps it and buttons look
+their payloads up by `Button.render_key` before falling back on rendering.
+
+File layout:
+    8 bytes   MAGIC
+    4 bytes   little-endian length of the index
+    index     json: {render_key: [offset, length], ...}; offsets are relative to the payload area
+    payloads
+"""
+import os
+import json
+import mmap
+import struct
+import hashlib
+from typing import Dict, Optional, List, Tuple
+
+
+MAGIC = b'VSDB\x00\x00\x00\x01'
+INDEX_LENGTH = struct.Struct('<I')
+
+
+class RenderBundle:
+    path: str
+    index: Dict[str, List[int]]
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as fr:
+            self.mmap = mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        if self.view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"'{path}' is not a vsdlib render bundle")
+        start = len(MAGIC)
+        index_length, = INDEX_LENGTH.unpack_from(self.view, start)
+        start += INDEX_LENGTH.size
+        self.index = json.loads(bytes(self.view[start:start + index_length]))
+        self.payload_start = start + index_length
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, render_key:str):
+        return render_key in self.index
+
+    def get(self, render_key:str) -> Optional[memoryview]:
+        """a zero-copy slice of the mapped file, or None if this key wasn't compiled"""
+        entry = self.index.get(render_key)
+        if entry is None:
+            return None
+        offset, length = entry
+        start = self.payload_start + offset
+        return self.view[start:start + length]
+
+    def close(self):
+        """
+        unmap the file. payloads still held elsewhere (e.g. queued for the
+        device) are slices of the mapping; it's unmapped once they're dropped
+        """
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    @staticmethod
+    def write(path:str, payloads:Dict[str, bytes]) -> Tuple[int, int]:
+        """
+        write `payloads` (render_key -> payload) to `path`.
+        identical payloads are stored once. returns (keys, unique payloads)
+        """
+        index: Dict[str, List[int]] = dict()
+        offsets: Dict[bytes, List[int]] = dict()
+        blobs: List[bytes] = []
+        size = 0
+        for render_key, payload in payloads.items():
+            payload = bytes(payload)
+            digest = hashlib.sha1(payload).digest()
+            if digest not in offsets:
+                offsets[digest] = [size, len(payload)]
+                blobs.append(payload)
+                size += len(payload)
+            index[render_key] = offsets[digest]
+
+        encoded_index = json.dumps(index, separators=(',', ':')).encode()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as fw:
+            fw.write(MAGIC)
+            fw.write(INDEX_LENGTH.pack(len(encoded_index)))
+            fw.write(encoded_index)
+            for blob in blobs:
+                fw.write(blob)
+        # don't leave a half-written bundle where a running deck might map it
+        os.replace(tmp_path, path)
+        return len(index), len(blobs)
@@ -1,31 +1,91 @@
-from typing import Tuple, Optional,Union
+import weakref
+from typing import Dict, Tuple, Optional, Union
 
 from .colors import light_purple, dark_purple, black
 
 
 class ButtonStyle:
+    """
+    Immutable and interned: creating a ButtonStyle with the same values as an
+    existing one returns that same object. Styles can be shared between any
+    number of buttons (and used as default arguments) without one button's
+    change leaking into the others, and they hash cheaply, so they work as
+    render cache keys. Use `replace` to get a style with some values changed.
+    """
+    __slots__ = (
+        'background_color', 'text_color', 'font_size',
+        'pressed_background_color', 'image_path', '__weakref__',
+    )
     size: Tuple[int,int]
-    background_color: str = light_purple
-    pressed_background_color: str = dark_purple
-    text_color: str = black
-    font_size: Union[int,str] = 40
+    background_color: str
+    pressed_background_color: str
+    text_color: str
+    font_size: Union[int,str]
     image_path: Optional[str]
+    _interned: 'weakref.WeakValueDictionary[tuple, ButtonStyle]' = weakref.WeakValueDictionary()
 
-    def __init__(
-        self,
-        background_color=light_purple,
-        text_color=text_color,
-        font_size:Union[int,str]=font_size,
-        pressed_background_color=pressed_background_color,
-        image_path=None,
+    def __new__(
+        cls,
+        background_color:str=light_purple,
+        text_color:str=black,
+        font_size:Union[int,str]=40,
+        pressed_background_color:str=dark_purple,
+        image_path:Optional[str]=None,
     ):
-        self.background_color = background_color
-        self.text_color = text_color
-        self.font_size = font_size
-        self.pressed_background_color = pressed_background_color
-        self.image_path = image_path
+        key = (cls, background_color, text_color, font_size, pressed_background_color, image_path)
+        style = cls._interned.get(key)
+        if style is None:
+            style = super().__new__(cls)
+            set_attr = super(ButtonStyle, style).__setattr__
+            set_attr('background_color', background_color)
+            set_attr('text_color', text_color)
+            set_attr('font_size', font_size)
+            set_attr('pressed_background_color', pressed_background_color)
+            set_attr('image_path', image_path)
+            style = cls._interned.setdefault(key, style)
+        return style
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"ButtonStyle is immutable; use style.replace({name}=...) instead")
+
+    def __reduce__(self):
+        return (self.__class__, self.values())
+
+    def __repr__(self):
+        return (
+            f"ButtonStyle(background_color={self.background_color!r}, text_color={self.text_color!r}, "
+            f"font_size={self.font_size!r}, pressed_background_color={self.pressed_background_color!r}, "
+            f"image_path={self.image_path!r})"
+        )
+
+    def values(self) -> tuple:
+        return (
+            self.background_color, self.text_color, self.font_size,
+            self.pressed_background_color, self.image_path,
+        )
+
+    def replace(self, **changes) -> 'ButtonStyle':
+        values = dict(
+            background_color=self.background_color,
+            text_color=self.text_color,
+            font_size=self.font_size,
+            pressed_background_color=self.pressed_background_color,
+            image_path=self.image_path,
+        )
+        for name in changes:
+            if name not in values:
+                raise TypeError(f"ButtonStyle has no attribute '{name}'")
+        values.update(changes)
+        return self.__class__(**values)
+
+    def recolor(self, colors:Dict[str, str]) -> 'ButtonStyle':
+        """this style with any of its colors that are keys of `colors` swapped for their values"""
+        return self.replace(
+            background_color=colors.get(self.background_color, self.background_color),
+            text_color=colors.get(self.text_color, self.text_color),
+            pressed_background_color=colors.get(self.pressed_background_color, self.pressed_background_color),
+        )
 
     @classmethod
     def set_size(cls, size:Tuple[int,int]):
         cls.size = size
-
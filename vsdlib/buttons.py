@@ -1,20 +1,116 @@
+import os
+import time
 import inspect
 import functools
-from typing import Optional, Callable, List
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Optional, Callable, Dict, Iterable, List, TYPE_CHECKING
 import logging
 
 
 from StreamDeck.Devices.StreamDeck import StreamDeck
 
-from .images import generate_text_image, generate_emoji_image, load_button_image
+from .images import generate_text_image, generate_emoji_image, load_button_image, KeyImageEncoder
 from .button_style import ButtonStyle
+from .colors import greens
+from . import metrics
+
+if TYPE_CHECKING:
+    from .state import StateFile
 
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.DEBUG)
 logging.basicConfig(level=logging.DEBUG)
 
+_batch = threading.local()
+
+STYLE_FIELDS = ('background_color', 'text_color', 'font_size', 'pressed_background_color', 'image_path')
+UPDATE_FIELDS = ('text',) + STYLE_FIELDS
+# a ToggleButton's on state, unless it's given one
+TOGGLE_ON_COLORS = greens
+
+
+@contextmanager
+def render_batch():
+    """
+    defer key updates made in this thread until the block ends, then render
+    each changed key once and hand all of them to the device together, e.g.
+
+        with render_batch():
+            display.set(text=expression)
+            result.set(text=value)
+    """
+    if getattr(_batch, 'slots', None) is not None:
+        # already batching; the outermost block sends everything
+        yield
+        return
+    _batch.slots = slots = dict()
+    try:
+        yield
+    finally:
+        _batch.slots = None
+        send_batch(slots)
+
+
+def send_batch(slots:Dict['ButtonSlot', None]):
+    images: Dict[StreamDeck, Dict[int, bytes]] = dict()
+    for slot in slots:
+        if slot.suspended:
+            slot.stale = True
+            continue
+        try:
+            payload = slot.button.render(slot.rotation, KeyImageEncoder.for_device(slot.sd))
+        except Exception as e:
+            logger.exception(f"Failed to render key {slot.index}; error: {e}")
+            continue
+        images.setdefault(slot.sd, dict())[slot.index] = payload
+    for sd, device_images in images.items():
+        set_key_images = getattr(sd, 'set_key_images', None)
+        if set_key_images is not None:
+            set_key_images(device_images)
+        else:
+            for index, payload in device_images.items():
+                sd.set_key_image(index, payload)
+
+
+def apply_update(button:'Button', fields:dict):
+    """set any of UPDATE_FIELDS on `button` and redraw it once"""
+    style_changes = {k: fields[k] for k in STYLE_FIELDS if k in fields}
+    if style_changes:
+        button.style = button.style.replace(**style_changes)
+        button.background_color_now = button.style.background_color
+    if 'text' in fields:
+        button.text = str(fields['text'])
+    button.alert_slot_button_changed()
+
+
+def draw_face(
+    text:str, style:ButtonStyle, background_color:str, rotation:int, encoder:KeyImageEncoder,
+) -> bytes:
+    """a text button's payload, or its image if the style has one"""
+    if style.image_path is not None:
+        try:
+            return load_button_image(style.image_path, style.size, rotation, encoder=encoder)
+        except:
+            logger.exception(
+                f"Failed to set button image from file path "
+                f"'{style.image_path}'. Falling back on text-based button."
+            )
+    return generate_text_image(
+        background_color,
+        style,
+        text,
+        rotation=rotation,
+        encoder=encoder,
+    )
+
 
 class Button:
+    __slots__ = (
+        'slot', 'fn', 'name', 'pressed', 'on_keydown_callbacks', 'on_keyup_callbacks',
+        'button_switches_page', 'text', 'style', 'background_color_now', '__weakref__',
+    )
     sd: StreamDeck
     fn: Callable
     name: Optional[str]
@@ -118,50 +214,100 @@ class Button:
             self.text = text
         if background_color is not None:
             self.background_color_now = background_color
+        # styles are shared and immutable; swap in a changed copy instead of editing in place
+        style_changes = dict(kwargs)
         if text_color is not None:
-            self.style.text_color = text_color
+            style_changes['text_color'] = text_color
         if font_size is not None:
-            self.style.font_size = font_size
+            style_changes['font_size'] = font_size
+        if style_changes:
+            self.style = self.style.replace(**style_changes)
 
-        for k, v in kwargs.items():
-            setattr(self.style, k, v)
         button_changed = any(list(map(lambda x:x is not None, [text, text_color, font_size]))+[kwargs])
         if button_changed:
             self.alert_slot_button_changed()
 
     def alert_slot_button_changed(self):
-        if self.slot is not None:
+        if self.slot is None:
+            return
+        batch = getattr(_batch, 'slots', None)
+        if batch is not None:
+            batch[self.slot] = None
+        else:
             self.slot.alert_button_changed()
 
-    def set_image(self, index:int, sd:StreamDeck, rotation:int=0):
+    def get_background_color(self, pressed:Optional[bool]=None) -> str:
+        pressed = self.pressed if pressed is None else pressed
         if self.button_switches_page:
-            background_color = self.style.background_color
-        elif self.pressed:
-            background_color = self.style.pressed_background_color
-        else:  # elif not self.pressed:
-            background_color = self.style.background_color
+            return self.style.background_color
+        elif pressed:
+            return self.style.pressed_background_color
+        else:  # elif not pressed:
+            return self.style.background_color
 
-        image_set = False
+    def render_key(self, rotation:int, encoder:KeyImageEncoder, pressed:Optional[bool]=None) -> str:
+        """
+        a stable name for exactly what `draw` would produce, used to look up
+        pre-rendered payloads (see vsdlib.bundle)
+        """
+        image_mtime = None
         if self.style.image_path is not None:
             try:
-                bi = load_button_image(self.style.image_path, self.style.size, rotation)
-                sd.set_key_image(index, bi)
-                image_set = True
-            except:
-                logger.exception(
-                    f"Failed to set button image from file path "
-                    f"'{self.style.image_path}'. Falling back on text-based button."
-                )
-        if not image_set:
-            sd.set_key_image(
-                index,
-                generate_text_image(
-                    background_color,
-                    self.style,
-                    self.text,
-                    rotation=rotation,
-                ),
-            )
+                image_mtime = os.stat(self.style.image_path).st_mtime_ns
+            except OSError:
+                pass
+        description = repr((
+            type(self).__name__, self.text, self.get_background_color(pressed),
+            self.style.text_color, self.style.font_size,
+            self.style.image_path, image_mtime,
+            self.style.size, rotation % 360, encoder.key(),
+        ))
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def cache_key(self, rotation:int, pressed:Optional[bool]=None) -> tuple:
+        """everything that affects what `draw` produces for a given encoder"""
+        return (type(self), self.text, self.get_background_color(pressed), self.style, rotation % 360)
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        """the device payload for the button's current state"""
+        cache_key = self.cache_key(rotation)
+        payload = encoder.cache.get(cache_key)
+        if payload is not None:
+            metrics.render_cache.inc(result='hit')
+            return payload
+        if encoder.bundle is not None:
+            payload = encoder.bundle.get(self.render_key(rotation, encoder))
+        if payload is None:
+            metrics.render_cache.inc(result='miss')
+            kind = self.render_kind()
+            start = time.perf_counter()
+            payload = self.draw(rotation, encoder)
+            metrics.render_seconds.observe(time.perf_counter() - start, kind=kind)
+            metrics.renders.inc(kind=kind)
+        else:
+            metrics.render_cache.inc(result='bundle')
+            # the cache outlives the bundle (see Board.load_bundle); keep a copy, not a slice of the mapping
+            payload = bytes(payload)
+        encoder.cache.put(cache_key, payload)
+        return payload
+
+    def render_kind(self) -> str:
+        """what `draw` makes, for metrics"""
+        return 'image' if self.style.image_path is not None else 'text'
+
+    def draw(self, rotation:int, encoder:KeyImageEncoder, pressed:Optional[bool]=None) -> bytes:
+        return draw_face(self.text, self.style, self.get_background_color(pressed), rotation, encoder)
+
+    def restyle(self, restyle:Callable[[ButtonStyle], ButtonStyle]) -> bool:
+        """replace the button's style with `restyle(style)`; returns whether that changed anything"""
+        style = restyle(self.style)
+        if style is self.style:
+            return False
+        self.style = style
+        return True
+
+    def set_image(self, index:int, sd:StreamDeck, rotation:int=0):
+        sd.set_key_image(index, self.render(rotation, KeyImageEncoder.for_device(sd)))
 
     def reset(
         self,
@@ -171,9 +317,10 @@ class Button:
         text_color=None,
         font_size=None,
     ):
-        background_color = background_color or ButtonStyle.background_color
-        text_color = text_color or ButtonStyle.text_color
-        font_size = font_size or ButtonStyle.font_size
+        default_style = ButtonStyle()
+        background_color = background_color or default_style.background_color
+        text_color = text_color or default_style.text_color
+        font_size = font_size or default_style.font_size
 
         self.set(
             fn=fn, name=name, text=text,
@@ -186,31 +333,193 @@ class Button:
 
 
 class EmojiButton(Button):
-    def set_image(self, index:int, sd:StreamDeck):
-        if self.button_switches_page or not self.pressed:
-            background_color = self.style.background_color
-        # elif self.pressed:
-        else:
-            background_color = self.style.pressed_background_color
-        sd.set_key_image(
-            index,
-            generate_emoji_image(
-                background_color,
-                self.style,
-                self.text,
-            ),
+    __slots__ = ()
+
+    def render_kind(self) -> str:
+        return 'emoji'
+
+    def draw(self, rotation:int, encoder:KeyImageEncoder, pressed:Optional[bool]=None) -> bytes:
+        return generate_emoji_image(
+            self.get_background_color(pressed),
+            self.style,
+            self.text,
+            rotation=rotation,
+            encoder=encoder,
         )
 
 
+class BlankButton(Button):
+    """
+    What an unset key shows. One instance is shared by every empty key on every
+    layout, so it never changes: it ignores presses and can't be `set`, and its
+    payload is rendered once per encoder/rotation and kept.
+    """
+    __slots__ = ('payloads',)
+
+    def __init__(self):
+        super().__init__(text='')
+        self.payloads = dict()
+
+    def handle_button_event(self, pressed:bool):
+        pass
+
+    def set(self, *args, **kwargs):
+        raise TypeError("the blank button is shared by every empty key; put a new Button on the layout instead")
+
+    def set_slot(self, slot:'ButtonSlot'):
+        pass
+
+    def clear_slot(self):
+        pass
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        key = (encoder.key(), rotation % 360)
+        payload = self.payloads.get(key)
+        if payload is None:
+            payload = self.payloads[key] = super().render(rotation, encoder)
+        return payload
+
+
+blank_button = BlankButton()
+
+
+class ToggleButton(Button):
+    """
+    A button that's on or off, flipped by each press. Each state has its own
+    text and style (e.g. its own image), and every look it can have (on or
+    off, pressed or not) is drawn once per encoder and rotation by `prerender`
+    and kept, so a press only queues payloads that already exist.
+
+    With a `state` file, the button comes back on or off as it was last left,
+    under `state_key`.
+    """
+    __slots__ = ('on', 'texts', 'styles', 'payloads', 'state', 'state_key')
+    on: bool
+    texts: Dict[bool, str]
+    styles: Dict[bool, ButtonStyle]
+
+    def __init__(
+        self, fn:Optional[Callable]=None, name:Optional[str]=None,
+        text:Optional[str]='', on_text:Optional[str]=None,
+        style:ButtonStyle=ButtonStyle(), on_style:Optional[ButtonStyle]=None,
+        on:bool=False, state:Optional['StateFile']=None, state_key:Optional[str]=None,
+    ):
+        # the default function would be handle_button_event, which Board calls anyway; it'd flip twice
+        super().__init__(fn or (lambda: None), name, text=text, style=style)
+        self.texts = {False: text or '', True: (text or '') if on_text is None else on_text}
+        self.styles = {False: style, True: on_style or style.replace(**TOGGLE_ON_COLORS)}
+        self.payloads = dict()
+        self.state = state
+        self.state_key = state_key or name
+        if state is not None and self.state_key is not None:
+            on = bool(state.get(self.state_key, on))
+        self.on = on
+        self.text, self.style = self.texts[on], self.styles[on]
+        self.background_color_now = self.style.background_color
+
+    def set_on(self, on:bool):
+        with render_batch():
+            self._switch(on)
+            self.alert_slot_button_changed()
+
+    def _switch(self, on:bool):
+        # keep whatever the current state was changed to (e.g. by `set`) for when it comes back
+        self.texts[self.on], self.styles[self.on] = self.text, self.style
+        self.on = on
+        self.text, self.style = self.texts[on], self.styles[on]
+        self.background_color_now = self.style.background_color
+        if self.state is not None and self.state_key is not None:
+            self.state.set(self.state_key, on)
+
+    def handle_button_event(self, pressed:bool):
+        self.pressed = pressed
+        if pressed:
+            self._switch(not self.on)
+        # redrawn on release too, so it doesn't stay in its pressed color
+        self.alert_slot_button_changed()
+        for callback in self.on_keydown_callbacks if pressed else self.on_keyup_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"callback {callback} failed; error:", e)
+
+    def restyle(self, restyle:Callable[[ButtonStyle], ButtonStyle]) -> bool:
+        self.styles = {on: restyle(style) for on, style in self.styles.items()}
+        return super().restyle(restyle)
+
+    def face_key(self, rotation:int, encoder:KeyImageEncoder, on:bool, pressed:bool) -> tuple:
+        text, style = (self.text, self.style) if on == self.on else (self.texts[on], self.styles[on])
+        background_color = style.pressed_background_color if pressed else style.background_color
+        return (encoder.key(), rotation % 360, text, style, background_color)
+
+    def prerender(self, rotation:int, encoder:KeyImageEncoder):
+        """draw every look this button can have, ahead of the first press"""
+        for on in (False, True):
+            for pressed in (False, True):
+                key = self.face_key(rotation, encoder, on, pressed)
+                if key not in self.payloads:
+                    _, _, text, style, background_color = key
+                    self.payloads[key] = draw_face(text, style, background_color, rotation, encoder)
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        key = self.face_key(rotation, encoder, self.on, self.pressed)
+        payload = self.payloads.get(key)
+        if payload is not None:
+            metrics.render_cache.inc(result='hit')
+            return payload
+        payload = super().render(rotation, encoder)
+        if len(self.payloads) >= 16:
+            # looks from before a `set` or recolor; they won't be back
+            self.payloads.clear()
+        self.payloads[key] = payload
+        return payload
+
+
+def recolor_buttons(buttons:Iterable[Button], colors:Dict[str, str]) -> int:
+    """
+    swap colors on each distinct button in `buttons` (see ButtonStyle.recolor).
+    buttons that are showing are redrawn as one batch; since text masks don't
+    depend on color, that's only blends and encodes. returns how many changed
+    """
+    restyled: Dict[ButtonStyle, ButtonStyle] = dict()
+
+    def restyle(style:ButtonStyle) -> ButtonStyle:
+        if style not in restyled:
+            restyled[style] = style.recolor(colors)
+        return restyled[style]
+
+    seen = set()
+    changed = 0
+    with render_batch():
+        for button in buttons:
+            if button is blank_button or id(button) in seen:
+                continue
+            seen.add(id(button))
+            if not button.restyle(restyle):
+                continue
+            button.background_color_now = colors.get(button.background_color_now, button.background_color_now)
+            button.alert_slot_button_changed()
+            changed += 1
+    return changed
+
+
 class ButtonSlot:
+    """
+    One key of the deck. While `suspended` (see vsdlib.idle), button changes
+    aren't rendered; the slot is just marked `stale` so it can be drawn once
+    when it's resumed.
+    """
+    __slots__ = ('index', 'button', 'sd', 'rotation', 'suspended', 'stale')
     index:int
     button:Button
     sd: StreamDeck
     def __init__(self, index:int, sd:StreamDeck):
         self.index = index
-        self.button = Button()
+        self.button = blank_button
         self.sd = sd
         self.rotation = 0
+        self.suspended = False
+        self.stale = False
 
     def set_button(self, button:Button, rotation:int=0):
         if self.button is not None:
@@ -218,11 +527,14 @@ class ButtonSlot:
         self.button = button
         self.button.set_slot(self)
         self.rotation = rotation
-        self.button.set_image(self.index, self.sd, self.rotation)
+        self.set_image()
 
     def alert_button_changed(self):
         if self.button is not None:
-            self.button.set_image(self.index, self.sd, self.rotation)
+            self.set_image()
 
     def set_image(self):
+        if self.suspended:
+            self.stale = True
+            return
         self.button.set_image(self.index, self.sd, self.rotation)
@@ -0,0 +1,179 @@
+"""
+An arithmetic-only expression engine for calculator keys.
+
+Keys are pushed one at a time and the expression is parsed as they arrive
+(shunting-yard, reducing operators as soon as precedence allows), so a key
+press costs O(1) amortized instead of re-parsing the whole expression. Each
+key's parser state is kept, built from immutable linked stacks that share
+their tails, so backspace is just dropping the last state, and the value of
+every prefix is computed at most once.
+
+Only numbers, + - * /, unary +/- and parentheses are understood; anything
+else makes the expression invalid rather than being run.
+"""
+from decimal import Decimal, InvalidOperation
+import operator
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+
+
+Number = Union[int, float, Decimal]
+# (top, rest) cons cells; None is the empty stack
+Stack = Optional[Tuple[Any, Any]]
+
+BINARY: Dict[str, Callable[[Number, Number], Number]] = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+}
+UNARY: Dict[str, Callable[[Number], Number]] = {
+    'neg': operator.neg,
+    'pos': operator.pos,
+}
+PRECEDENCE = {'+': 1, '-': 1, '*': 2, '/': 2, 'neg': 3, 'pos': 3}
+DIGITS = set('0123456789.')
+
+
+class InvalidExpression(Exception):
+    pass
+
+
+class ParseState(NamedTuple):
+    values: Stack = None
+    ops: Stack = None
+    number: str = ''
+    expect_operand: bool = True
+    valid: bool = True
+
+
+INVALID = ParseState(valid=False)
+
+
+class CalculatorEngine:
+    """
+    `precise=True` does arithmetic on Decimals instead of floats, so
+    e.g. 0.1+0.2 is exactly 0.3.
+    """
+    entries: List[str]
+    states: List[ParseState]
+    results: Dict[int, Optional[Number]]
+
+    def __init__(self, precise:bool=False):
+        self.precise = precise
+        self.clear()
+
+    def clear(self):
+        self.entries = []
+        self.states = [ParseState()]
+        self.results = dict()
+
+    def set(self, text:str):
+        self.clear()
+        for c in text:
+            self.push(c)
+
+    def push(self, entry):
+        entry = str(entry)
+        state = self.states[-1]
+        if state.valid:
+            try:
+                state = self.step(state, entry)
+            except (InvalidExpression, ArithmeticError, InvalidOperation, ValueError):
+                state = INVALID
+        self.entries.append(entry)
+        self.states.append(state)
+
+    def pop(self) -> Optional[str]:
+        if not self.entries:
+            return None
+        self.results.pop(len(self.states) - 1, None)
+        self.states.pop()
+        return self.entries.pop()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.entries)
+
+    def value(self) -> Optional[Number]:
+        """the value of the expression so far, or None if it isn't complete and valid"""
+        position = len(self.states) - 1
+        if position not in self.results:
+            try:
+                self.results[position] = self.evaluate(self.states[-1])
+            except (InvalidExpression, ArithmeticError, InvalidOperation, ValueError):
+                self.results[position] = None
+        return self.results[position]
+
+    def format_value(self, fmt:str='.2f') -> str:
+        """the value formatted with `fmt`, or the expression text if there is no value"""
+        value = self.value()
+        if value is None:
+            return self.text
+        try:
+            return format(value, fmt)
+        except (ArithmeticError, ValueError):
+            return self.text
+
+    def to_number(self, number:str) -> Number:
+        if self.precise:
+            return Decimal(number)
+        if '.' in number:
+            return float(number)
+        return int(number)
+
+    def step(self, state:ParseState, entry:str) -> ParseState:
+        if all(c in DIGITS for c in entry):
+            if not state.expect_operand and not state.number:
+                raise InvalidExpression("number after ')'")
+            number = state.number + entry
+            if number.count('.') > 1:
+                raise InvalidExpression("two decimal points in one number")
+            return state._replace(number=number, expect_operand=False)
+
+        values, ops = self.finish_number(state)
+        if entry in BINARY:
+            if state.expect_operand:
+                if entry not in '+-':
+                    raise InvalidExpression(f"'{entry}' needs something on its left")
+                return state._replace(ops=(('neg' if entry == '-' else 'pos'), ops))
+            values, ops = self.reduce(values, ops, PRECEDENCE[entry])
+            return ParseState(values, (entry, ops), '', True)
+        elif entry == '(':
+            if not state.expect_operand:
+                raise InvalidExpression("'(' after a value")
+            return state._replace(ops=('(', ops))
+        elif entry == ')':
+            if state.expect_operand:
+                raise InvalidExpression("')' without a value before it")
+            values, ops = self.reduce(values, ops, 0)
+            if ops is None:
+                raise InvalidExpression("unmatched ')'")
+            return ParseState(values, ops[1], '', False)
+        raise InvalidExpression(f"'{entry}' isn't arithmetic")
+
+    def finish_number(self, state:ParseState) -> Tuple[Stack, Stack]:
+        if not state.number:
+            return state.values, state.ops
+        return (self.to_number(state.number), state.values), state.ops
+
+    @staticmethod
+    def reduce(values:Stack, ops:Stack, precedence:int) -> Tuple[Stack, Stack]:
+        """apply stacked operators that bind at least as tightly as `precedence`, stopping at '('"""
+        while ops is not None and ops[0] != '(' and PRECEDENCE[ops[0]] >= precedence:
+            op, ops = ops
+            if op in UNARY:
+                value, values = values
+                values = (UNARY[op](value), values)
+            else:
+                right, (left, values) = values
+                values = (BINARY[op](left, right), values)
+        return values, ops
+
+    def evaluate(self, state:ParseState) -> Optional[Number]:
+        if not state.valid or state.expect_operand:
+            return None
+        values, ops = self.reduce(*self.finish_number(state), 0)
+        if ops is not None:
+            # unclosed '('
+            return None
+        return values[0]
@@ -0,0 +1,443 @@
+"""
+An application launcher: type a few letters on the deck, press one of the
+top matches, and quicksilver brings its window up (or starts it).
+
+Applications come from the XDG .desktop files under $XDG_DATA_HOME and
+$XDG_DATA_DIRS. They're read once into an index cached in
+$XDG_CACHE_HOME/vsdlib, along with each directory's mtime; after that, only
+directories whose mtime changed (something was added, removed or renamed in
+them) are read again. Searching never touches the filesystem: the prefix and
+trigram postings are built in memory from the cached entries.
+
+Icons are drawn into key payloads for the deck's encoder in the background,
+into a bundle file next to the index, so showing matches while typing only
+sends images.
+
+    launcher = LauncherWidget(board)
+    launcher.layout.apply(board)
+"""
+import os
+import json
+import heapq
+import string
+import hashlib
+import threading
+import logging
+from itertools import zip_longest
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from vsdlib.board import Board
+from vsdlib.buttons import Button, apply_update, render_batch
+from vsdlib.button_style import ButtonStyle
+from vsdlib.bundle import RenderBundle
+from vsdlib.colors import grays
+from vsdlib.images import KeyImageEncoder
+from vsdlib.scrolling import ScrollingListLayout
+from vsdlib.widgets import KeyPadWidget
+from vsdlib.contrib.quicksilver import create_activate_application
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+# PIL can't draw svg; these are tried in order for each icon name
+ICON_EXTENSIONS = ('.png', '.xpm')
+ICON_SIZES = ('128x128', '96x96', '256x256', '64x64', '48x48', '512x512', '32x32')
+# Exec field codes (%f, %U, ...) are filled in by file managers; a launcher has nothing to fill them with
+FIELD_CODES = ('%f', '%F', '%u', '%U', '%d', '%D', '%n', '%N', '%i', '%c', '%k', '%v', '%m')
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'vsdlib')
+
+
+def data_dirs() -> List[str]:
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    dirs = os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share'
+    return [data_home] + [d for d in dirs.split(':') if d]
+
+
+def application_dirs() -> List[str]:
+    """in order of precedence: a desktop file id found in an earlier directory hides later ones"""
+    return [os.path.join(d, 'applications') for d in data_dirs()]
+
+
+def icon_dirs() -> List[str]:
+    dirs = []
+    for d in data_dirs():
+        dirs.extend(os.path.join(d, 'icons', 'hicolor', size, 'apps') for size in ICON_SIZES)
+    dirs.extend(os.path.join(d, 'pixmaps') for d in data_dirs())
+    return dirs
+
+
+class DesktopEntry(NamedTuple):
+    # desktop file id, e.g. org.gnome.Nautilus.desktop
+    id: str
+    name: str
+    exec: str
+    icon: Optional[str]
+    # what quicksilver looks for to find an already open window
+    wm_class: str
+    keywords: str
+
+
+def strip_field_codes(exec_line:str) -> str:
+    return ' '.join(arg for arg in exec_line.split() if arg not in FIELD_CODES).replace('%%', '%')
+
+
+def find_icon(icon:str, dirs:Iterable[str]) -> Optional[str]:
+    if os.path.isabs(icon):
+        return icon if os.path.splitext(icon)[1] in ICON_EXTENSIONS and os.path.exists(icon) else None
+    for directory in dirs:
+        for extension in ICON_EXTENSIONS:
+            path = os.path.join(directory, icon + extension)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def parse_desktop_file(path:str, desktop_id:str, icon_search:Iterable[str]) -> Optional[DesktopEntry]:
+    """the launchable application `path` describes, or None if it isn't one"""
+    fields: Dict[str, str] = dict()
+    try:
+        with open(path, encoding='utf-8', errors='replace') as fr:
+            in_entry = False
+            for line in fr:
+                line = line.strip()
+                if line.startswith('['):
+                    if in_entry:
+                        break
+                    in_entry = line == '[Desktop Entry]'
+                elif in_entry and '=' in line and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    # only the untranslated keys
+                    fields.setdefault(key.strip(), value.strip())
+    except OSError:
+        return None
+    if (
+        fields.get('Type') != 'Application' or 'Exec' not in fields or 'Name' not in fields
+        or fields.get('NoDisplay') == 'true' or fields.get('Hidden') == 'true'
+    ):
+        return None
+    exec_line = strip_field_codes(fields['Exec'])
+    if not exec_line:
+        return None
+    icon = find_icon(fields['Icon'], icon_search) if fields.get('Icon') else None
+    wm_class = fields.get('StartupWMClass') or os.path.basename(exec_line.split()[0])
+    return DesktopEntry(desktop_id, fields['Name'], exec_line, icon, wm_class, fields.get('Keywords', '').replace(';', ' '))
+
+
+def trigrams(word:str) -> Set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class LauncherIndex:
+    """
+    Every application, and the postings to search them. `update` brings the
+    cached entries up to date (reading only changed directories) and saves
+    them if anything changed.
+    """
+    entries: List[DesktopEntry]
+    # per directory: [mtime_ns, subdirectories, entries]
+    directories: Dict[str, list]
+    # first one or two letters of any word -> entries
+    prefixes: Dict[str, Set[int]]
+    trigrams: Dict[str, Set[int]]
+    # each entry's searchable words, joined by spaces
+    haystacks: List[str]
+
+    def __init__(self, path:Optional[str]=None, roots:Optional[List[str]]=None):
+        self.path = path or os.path.join(cache_dir(), 'launcher-index.json')
+        self.roots = roots if roots is not None else application_dirs()
+        self.directories = dict()
+        self.entries = []
+        self.prefixes = dict()
+        self.trigrams = dict()
+        self.haystacks = []
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as fr:
+                data = json.load(fr)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("couldn't read launcher index '%s'; rebuilding it. error: %s", self.path, e)
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self.directories = data['directories']
+        self.build()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as fw:
+            json.dump({'version': INDEX_VERSION, 'directories': self.directories}, fw, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def update(self) -> int:
+        """read directories that changed since the last update; returns how many there were"""
+        icon_search = icon_dirs()
+        directories: Dict[str, list] = dict()
+        rescanned = 0
+        pending: List[Tuple[str, str]] = [(root, '') for root in self.roots]
+        while pending:
+            directory, prefix = pending.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            cached = self.directories.get(directory)
+            if cached is None or cached[0] != mtime:
+                cached = self.scan(directory, prefix, mtime, icon_search)
+                rescanned += 1
+            directories[directory] = cached
+            pending.extend((os.path.join(directory, name), f'{prefix}{name}-') for name in cached[1])
+        if rescanned or directories.keys() != self.directories.keys():
+            self.directories = directories
+            self.build()
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning("couldn't save launcher index '%s'; error: %s", self.path, e)
+        return rescanned
+
+    @staticmethod
+    def scan(directory:str, prefix:str, mtime:int, icon_search:List[str]) -> list:
+        subdirectories: List[str] = []
+        entries: List[DesktopEntry] = []
+        try:
+            with os.scandir(directory) as it:
+                for item in it:
+                    if item.is_dir():
+                        subdirectories.append(item.name)
+                    elif item.name.endswith('.desktop'):
+                        entry = parse_desktop_file(item.path, prefix + item.name, icon_search)
+                        if entry is not None:
+                            entries.append(entry)
+        except OSError as e:
+            logger.debug("couldn't read '%s': %s", directory, e)
+        return [mtime, sorted(subdirectories), entries]
+
+    def build(self):
+        """entries, in precedence order with hidden ids dropped, and their postings"""
+        seen: Set[str] = set()
+        entries: List[DesktopEntry] = []
+        for root in self.roots:
+            for directory, (_, _, directory_entries) in self.directories.items():
+                if directory != root and not directory.startswith(root + os.sep):
+                    continue
+                for entry in directory_entries:
+                    entry = DesktopEntry(*entry)
+                    if entry.id not in seen:
+                        seen.add(entry.id)
+                        entries.append(entry)
+        entries.sort(key=lambda e: e.name.lower())
+
+        prefixes: Dict[str, Set[int]] = dict()
+        grams: Dict[str, Set[int]] = dict()
+        haystacks: List[str] = []
+        for i, entry in enumerate(entries):
+            words = set(' '.join((
+                entry.name, entry.keywords, os.path.basename(entry.exec.split()[0]),
+                entry.id[:-len('.desktop')],
+            )).lower().replace('-', ' ').replace('.', ' ').split())
+            haystacks.append(' '.join(sorted(words)))
+            for word in words:
+                for length in (1, 2):
+                    prefixes.setdefault(word[:length], set()).add(i)
+                for gram in trigrams(word):
+                    grams.setdefault(gram, set()).add(i)
+        with self.lock:
+            self.entries, self.prefixes, self.trigrams, self.haystacks = entries, prefixes, grams, haystacks
+
+    def matching(self, word:str) -> Set[int]:
+        if len(word) <= 2:
+            return self.prefixes.get(word, set())
+        postings = sorted((self.trigrams.get(gram, set()) for gram in trigrams(word)), key=len)
+        candidates = set.intersection(*postings) if postings else set()
+        # trigrams can all be there without the word being there
+        return {i for i in candidates if word in self.haystacks[i]}
+
+    def search(self, query:str, limit:int=8) -> List[DesktopEntry]:
+        """the best `limit` matches: names starting with the query first, then any word starting with it"""
+        words = query.lower().split()
+        if not words:
+            return []
+        with self.lock:
+            candidates: Optional[Set[int]] = None
+            for word in words:
+                found = self.matching(word)
+                candidates = found if candidates is None else candidates & found
+                if not candidates:
+                    return []
+            query = ' '.join(words)
+
+            def rank(i:int):
+                name = self.entries[i].name.lower()
+                if name.startswith(query):
+                    first = 0
+                elif any(word.startswith(words[0]) for word in name.split()):
+                    first = 1
+                else:
+                    first = 2
+                return (first, len(name), name)
+
+            return [self.entries[i] for i in heapq.nsmallest(limit, candidates, key=rank)]
+
+
+class AppButton(Button):
+    """one of a launcher's matches. shows the application's icon (or its name, if it has none)"""
+    __slots__ = ('entry', 'launcher')
+
+    def __init__(self, launcher:'LauncherWidget', fn=None, style:ButtonStyle=ButtonStyle()):
+        super().__init__(fn, text='', style=style)
+        self.entry: Optional[DesktopEntry] = None
+        self.launcher = launcher
+
+    def show(self, entry:Optional[DesktopEntry]):
+        if entry == self.entry:
+            return
+        self.entry = entry
+        apply_update(self, {
+            'text': '' if entry is None else entry.name.replace(' ', '\n'),
+            'image_path': None if entry is None else entry.icon,
+        })
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        icons = self.launcher.icons
+        if icons is not None and self.style.image_path is not None:
+            payload = icons.get(self.render_key(rotation, encoder))
+            if payload is not None:
+                return payload
+        return super().render(rotation, encoder)
+
+
+class LauncherWidget(KeyPadWidget):
+    """
+    The first row of `layout` shows the best matches for what's been typed.
+    The key after them shows the query (press it to clear), then backspace,
+    then the letters, paged if they don't all fit.
+    """
+    icons: Optional[RenderBundle]
+
+    def __init__(
+        self, board:Board, index:Optional[LauncherIndex]=None,
+        style:ButtonStyle=ButtonStyle(), result_style:ButtonStyle=ButtonStyle(**grays),
+    ):
+        self.query = ''
+        self.icons = None
+        self.result_style = result_style
+        self.index = index or LauncherIndex()
+        rescanned = self.index.update()
+        logger.info("launcher: %s applications (%s directories read)", len(self.index.entries), rescanned)
+        super().__init__(board, style, strings=list(string.ascii_lowercase))
+
+        self.result_buttons = [
+            AppButton(self, self.create_launch_callback(i), style=result_style)
+            for i in range(board.width)
+        ]
+        self.query_button = Button(self.create_clear_callback(), text='search', style=result_style)
+        self.layout = ScrollingListLayout(self.buttons, keys=range(board.width, board.key_count))
+        for i, button in enumerate(self.result_buttons):
+            self.layout.set(button, i)
+        self.layout.set(self.query_button, board.width)
+        self.layout.set(self.backspace_button, board.width + 1)
+
+        threading.Thread(target=self.prerender_icons, args=(board.rotation, board.encoder), daemon=True).start()
+
+    def icons_path(self, encoder:KeyImageEncoder) -> str:
+        digest = hashlib.sha1(repr(encoder.key()).encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(self.index.path), f'launcher-icons-{digest}.vsdb')
+
+    def prerender_icons(self, rotation:int, encoder:KeyImageEncoder):
+        """
+        draw every application's icon, pressed and not, as the result keys
+        show it for `encoder`, keeping the ones already in the bundle
+        """
+        path = self.icons_path(encoder)
+        try:
+            existing: Optional[RenderBundle] = RenderBundle(path)
+        except (OSError, ValueError):
+            existing = None
+        if existing is not None:
+            self.icons = existing
+        # render keys cover the style, so this has to look exactly like a result button
+        button = AppButton(self, style=self.result_style)
+        payloads: Dict[str, bytes] = dict()
+        drawn = 0
+        for entry in self.index.entries:
+            if entry.icon is None:
+                continue
+            button.entry = entry
+            button.text, button.style = entry.name.replace(' ', '\n'), button.style.replace(image_path=entry.icon)
+            for pressed in (False, True):
+                render_key = button.render_key(rotation, encoder, pressed)
+                payload = existing.get(render_key) if existing is not None else None
+                if payload is None:
+                    try:
+                        payload = button.draw(rotation, encoder, pressed)
+                    except Exception as e:
+                        logger.debug("couldn't draw icon '%s': %s", entry.icon, e)
+                        break
+                    drawn += 1
+                payloads[render_key] = bytes(payload)
+        if not drawn and existing is not None and len(existing) == len(payloads):
+            return
+        try:
+            RenderBundle.write(path, payloads)
+        except OSError as e:
+            logger.warning("couldn't save launcher icons '%s'; error: %s", path, e)
+            return
+        self.icons = RenderBundle(path)
+        if existing is not None:
+            existing.close()
+        logger.info("launcher: drew %s icons (%s in all)", drawn, len(payloads))
+
+    def set_query(self, query:str):
+        self.query = query
+        matches = self.index.search(query, limit=len(self.result_buttons))
+        with render_batch():
+            for button, entry in zip_longest(self.result_buttons, matches):
+                button.show(entry)
+            self.query_button.set(text=query or 'search')
+
+    def launch(self, i:int):
+        entry = self.result_buttons[i].entry
+        if entry is None:
+            return
+        logger.info("launching '%s'", entry.name)
+        create_activate_application(entry.wm_class, entry.exec)(True)
+        self.set_query('')
+
+    def create_launch_callback(self, i:int):
+        def launch(pressed:bool):
+            if not pressed:
+                return
+            self.launch(i)
+        return launch
+
+    def create_clear_callback(self):
+        def clear(pressed:bool):
+            if not pressed:
+                return
+            self.set_query('')
+        return clear
+
+    def create_press_callback(self, string:str):
+        def type_string(pressed:bool):
+            if not pressed:
+                return
+            if string == 'backspace':
+                self.set_query(self.query[:-1])
+            elif string == 'enter':
+                self.launch(0)
+            elif string == ' ':
+                self.set_query(self.query + ' ')
+            elif len(string) == 1:
+                self.set_query(self.query + string)
+        return type_string
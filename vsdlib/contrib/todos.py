@@ -1,16 +1,40 @@
 #!/usr/bin/env python3
 """
 courtesy of chatgpt.
+
+A todo list kept in sqlite, and a widget that pages through it.
+
+Nothing here touches the database until a TodoStore is first used. All
+queries run on the store's own thread, never on the key callback thread, and
+writes that arrive close together go out in one transaction.
 """
 
+import threading
+import logging
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import (
+    create_engine, event, inspect, select, update, delete, insert, tuple_, text,
+    Column, Integer, String, DateTime, Index,
+)
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-# create SQLite database engine and session factory
-engine = create_engine('sqlite:///todos.db')
-Session = sessionmaker(bind=engine)
+from vsdlib.board import Board, BoardLayout
+from vsdlib.buttons import Button
+from vsdlib.button_style import ButtonStyle
+from vsdlib.colors import grays, yellows
+from vsdlib.widgets import Widget
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'todos.db'
+
+# bound to an engine by get_engine()
+Session = sessionmaker()
 
 # create base class for declarative model definition
 Base = declarative_base()
@@ -22,19 +46,323 @@ class Todo(Base):
     tid = Column(Integer, primary_key=True)
     name = Column(String)
     created = Column(DateTime, default=datetime.now)
+    completed = Column(DateTime, nullable=True)
+
+    # pages of open todos are read in (created, tid) order. tid is sqlite's
+    # rowid, so it's already part of every index entry
+    __table_args__ = (
+        Index('ix_todo_open_created', 'created', sqlite_where=completed.is_(None)),
+    )
 
     def __repr__(self):
         return f'Todo {self.tid}: {self.name} ({self.created})'
 
-# create table in database if it doesn't exist
-Base.metadata.create_all(engine)
 
-# session = Session()
-# new_todo = Todo(name='Buy milk')
-# session.add(new_todo)
-# session.commit()
-# print(session.query(Todo).all())
+class TodoRow(NamedTuple):
+    tid: int
+    name: str
+    created: datetime
+
+    @property
+    def position(self) -> Tuple[datetime, int]:
+        """where this row sits in page order"""
+        return (self.created, self.tid)
+
+
+_engines: Dict[str, Engine] = dict()
+_engines_lock = threading.Lock()
+
+
+def get_engine(path:str=DEFAULT_PATH) -> Engine:
+    """the engine for `path`, creating the database and its tables the first time"""
+    with _engines_lock:
+        engine = _engines.get(path)
+        if engine is None:
+            engine = _engines[path] = create_engine(f'sqlite:///{path}', pool_size=2, max_overflow=2)
+            event.listen(engine, 'connect', _set_sqlite_pragmas)
+            migrate(engine)
+            Session.configure(bind=engine)
+        return engine
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers don't block the writer and vice versa, and commits don't fsync every time
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def migrate(engine:Engine):
+    # create table in database if it doesn't exist
+    Base.metadata.create_all(engine)
+    # todos.db files made before `completed` existed
+    columns = {c['name'] for c in inspect(engine).get_columns(Todo.__tablename__)}
+    with engine.begin() as conn:
+        if 'completed' not in columns:
+            conn.execute(text('ALTER TABLE todo ADD COLUMN completed DATETIME'))
+        for index in Todo.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+
+class TodoStore:
+    """
+    Runs every query for one todo database on a single background thread.
+
+    `add`, `complete` and `delete` return immediately; the worker waits
+    `batch_seconds` for more to arrive and commits them all together. Page
+    reads are answered through a callback, after any writes queued before
+    them, so a page read straight after a write already shows it.
+    """
+    path: str
+    batch_seconds: float
+    pending_writes: List[Tuple[str, object]]
+    pending_reads: List[Callable[[Engine], None]]
+
+    def __init__(self, path:str=DEFAULT_PATH, batch_seconds:float=0.05):
+        self.path = path
+        self.batch_seconds = batch_seconds
+        self.pending_writes = []
+        self.pending_reads = []
+        self.working = False
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, name:str):
+        self._write('add', name)
+
+    def complete(self, tid:int):
+        self._write('complete', tid)
+
+    def delete(self, tid:int):
+        self._write('delete', tid)
+
+    def fetch_page(
+        self, callback:Callable[[List[TodoRow]], None], limit:int,
+        after:Optional[Tuple[datetime, int]]=None,
+        before:Optional[Tuple[datetime, int]]=None,
+    ):
+        """
+        call `callback` with up to `limit` open todos following `after` (or
+        preceding `before`), oldest first. pass a row's `position`, not an
+        offset: the index finds the start directly however deep the page is
+        """
+        def read(engine:Engine):
+            rows = self.query_page(engine, limit, after, before)
+            try:
+                callback(rows)
+            except Exception as e:
+                logger.exception(f"Todo page callback {callback} failed; error: {e}")
+        with self.condition:
+            self.pending_reads.append(read)
+            self._start()
+            self.condition.notify_all()
+
+    @staticmethod
+    def query_page(
+        engine:Engine, limit:int,
+        after:Optional[Tuple[datetime, int]]=None,
+        before:Optional[Tuple[datetime, int]]=None,
+    ) -> List[TodoRow]:
+        position = tuple_(Todo.created, Todo.tid)
+        query = select(Todo.tid, Todo.name, Todo.created).where(Todo.completed.is_(None))
+        if before is not None:
+            query = query.where(position < tuple_(*before)).order_by(Todo.created.desc(), Todo.tid.desc())
+        else:
+            if after is not None:
+                query = query.where(position > tuple_(*after))
+            query = query.order_by(Todo.created, Todo.tid)
+        with engine.connect() as conn:
+            rows = [TodoRow(*row) for row in conn.execute(query.limit(limit))]
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    def flush(self, timeout:Optional[float]=None) -> bool:
+        """block until everything queued so far has been done"""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not (self.pending_writes or self.pending_reads or self.working), timeout,
+            )
+
+    def close(self, timeout:Optional[float]=5):
+        self.flush(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _write(self, operation:str, value):
+        with self.condition:
+            self.pending_writes.append((operation, value))
+            self._start()
+            self.condition.notify_all()
+
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        engine = get_engine(self.path)
+        while True:
+            with self.condition:
+                self.working = False
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: self.pending_writes or self.pending_reads or not self.running)
+                if not self.running:
+                    return
+                if self.pending_writes and not self.pending_reads:
+                    # give a burst of presses a moment to collect into one commit
+                    self.condition.wait_for(lambda: self.pending_reads or not self.running, self.batch_seconds)
+                writes, self.pending_writes = self.pending_writes, []
+                reads, self.pending_reads = self.pending_reads, []
+                self.working = True
+            if writes:
+                try:
+                    self.apply_writes(engine, writes)
+                except Exception as e:
+                    logger.exception(f"Failed to save {len(writes)} todo changes; error: {e}")
+            for read in reads:
+                try:
+                    read(engine)
+                except Exception as e:
+                    logger.exception(f"Failed to read todos; error: {e}")
+
+    @staticmethod
+    def apply_writes(engine:Engine, writes:List[Tuple[str, object]]):
+        now = datetime.now()
+        added = [{'name': value, 'created': now} for operation, value in writes if operation == 'add']
+        completed = [value for operation, value in writes if operation == 'complete']
+        deleted = [value for operation, value in writes if operation == 'delete']
+        with engine.begin() as conn:
+            if added:
+                conn.execute(insert(Todo), added)
+            if completed:
+                conn.execute(update(Todo).where(Todo.tid.in_(completed)).values(completed=now))
+            if deleted:
+                conn.execute(delete(Todo).where(Todo.tid.in_(deleted)))
+
+
+class TodoWidget(Widget):
+    """
+    A page of open todos, one per key, with prev/next keys. Pressing a todo
+    completes it.
+
+    The keys' buttons are made once and only have their text changed as pages
+    load, and the next page is read and rendered ahead so paging forward
+    doesn't wait on the database or on drawing.
+    """
+    store: TodoStore
+    keys: List[int]
+    buttons: List[Button]
+    rows: List[Optional[TodoRow]]
+
+    def __init__(
+        self, board:Board, style:ButtonStyle=ButtonStyle(**yellows),
+        store:Optional[TodoStore]=None, keys:Optional[List[int]]=None,
+        prev_key:Optional[int]=None, next_key:Optional[int]=None,
+    ):
+        super().__init__(board, style)
+        self.store = store or TodoStore()
+        self.prev_key = board.key_count - board.width if prev_key is None else prev_key
+        self.next_key = board.key_count - 1 if next_key is None else next_key
+        if keys is None:
+            keys = [k for k in range(board.key_count) if k not in (self.prev_key, self.next_key)]
+        self.keys = keys
+        self.lock = threading.Lock()
+        self.rows = [None] * len(keys)
+        # page starts of the pages before this one, to page back without an offset
+        self.history: List[Optional[Tuple[datetime, int]]] = []
+        self.start: Optional[Tuple[datetime, int]] = None
+        self.next_rows: Optional[List[TodoRow]] = None
+        # whether the page being shown has one after it
+        self.has_more = False
+
+        self.buttons = [Button(self.create_complete_callback(i), style=style) for i in range(len(keys))]
+        nav_style = ButtonStyle(**grays)
+        self.prev_button = Button(self.create_page_callback(-1), text='<', style=nav_style, button_switches_page=True)
+        self.next_button = Button(self.create_page_callback(1), text='>', style=nav_style, button_switches_page=True)
+
+    def create_layout(self) -> BoardLayout:
+        layout = BoardLayout()
+        for key, button in zip(self.keys, self.buttons):
+            layout.set(button, key)
+        layout.set(self.prev_button, self.prev_key)
+        layout.set(self.next_button, self.next_key)
+        self.reload()
+        return layout
+
+    def add(self, name:str):
+        self.store.add(name)
+        self.reload()
+
+    def reload(self):
+        """read the current page again, e.g. after the list changed"""
+        with self.lock:
+            start = self.start
+        self.store.fetch_page(self.show_rows, len(self.keys) + 1, after=start)
+
+    def show_rows(self, rows:List[TodoRow]):
+        # one extra row is read to know whether there's a next page
+        page, more = rows[:len(self.keys)], len(rows) > len(self.keys)
+        with self.lock:
+            self.rows = page + [None] * (len(self.keys) - len(page))
+            self.next_rows = None
+            self.has_more = more
+        for button, row in zip(self.buttons, self.rows):
+            button.set(text='' if row is None else row.name)
+        self.next_button.set(text='>' if more else '')
+        self.prev_button.set(text='<' if self.history else '')
+        if more:
+            self.store.fetch_page(self.keep_next_rows, len(self.keys) + 1, after=page[-1].position)
+
+    def keep_next_rows(self, rows:List[TodoRow]):
+        # render them now, on the store's thread, so showing the page later is a cache hit
+        board = self.board
+        for row in rows[:len(self.keys)]:
+            Button(text=row.name, style=self.style).render(board.rotation, board.encoder)
+        with self.lock:
+            self.next_rows = rows
+
+    def page(self, direction:int):
+        with self.lock:
+            if direction > 0:
+                last = next((row for row in reversed(self.rows) if row is not None), None)
+                if last is None or not self.has_more:
+                    return
+                self.history.append(self.start)
+                self.start = last.position
+                next_rows = self.next_rows
+            else:
+                if not self.history:
+                    return
+                self.start = self.history.pop()
+                next_rows = None
+        if next_rows is not None:
+            self.show_rows(next_rows)
+        else:
+            self.reload()
 
-# print the new todo object (with its tid and created fields automatically filled in)
-# print(new_todo)
+    def create_page_callback(self, direction:int):
+        def change_page(pressed:bool):
+            if not pressed:
+                return
+            self.page(direction)
+        return change_page
 
+    def create_complete_callback(self, i:int):
+        def complete_todo(pressed:bool):
+            if not pressed:
+                return
+            with self.lock:
+                row = self.rows[i]
+            if row is None:
+                return
+            self.store.complete(row.tid)
+            self.buttons[i].set(text=f'{row.name}\n(done)')
+            self.reload()
+        return complete_todo
@@ -1,78 +1,305 @@
-from typing import List, Union, Callable, Optional
-import logging
-from time import sleep
+"""
+Keyboard macros for PressButtonSchema keys.
+
+A shortcut string is compiled once into a program of key presses, releases
+and waits, and programs are played back by a MacroPlayer thread so a long
+macro never holds up the deck's key handling.
 
-from pynput.keyboard import Controller, Key
+Shortcut strings are comma-separated steps, played in order:
+    j               press and release one key
+    ctrl+shift+t    a chord: press in order, release in reverse
+    hello           type text (anything longer than a key name that isn't one)
+    type:a+b        type text literally, even if it looks like a chord (commas still separate steps)
+    wait:0.25       pause for 0.25 seconds
+    down*3          any step followed by *N is repeated N times
+e.g. `alt+k,alt+r` is alt+k followed by alt+r, and `ctrl+a,wait:0.1,ctrl+c`
+selects, waits, then copies.
+"""
+from typing import Any, Deque, List, NamedTuple, Optional, Union, Callable
+from collections import deque
+import logging
+import threading
+import time
 
 
 logger = logging.getLogger(__file__)
 
+# pynput needs a display to import, so it's only loaded once a macro actually plays
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            from pynput.keyboard import Controller
+            _controller = Controller()
+        return _controller
+
+
+# typed the way pynput's Controller.type types them: as the keys, not the characters
+CONTROL_CHARACTERS = {'\n': 'enter', '\r': 'enter', '\t': 'tab'}
 
-# Create a Controller
-controller = Controller()
 
+def get_key(name:str) -> Union[Any, str]:
+    """a pynput Key for names like 'alt' or 'enter', otherwise the name itself"""
+    from pynput.keyboard import Key
+    return getattr(Key, name, name)
 
-def parse_keys(shortcut: str) -> Union[str, List[Union[Key, str]]]:
+
+def is_key_name(name:str) -> bool:
+    from pynput.keyboard import Key
+    return hasattr(Key, name)
+
+
+class KeyEvent(NamedTuple):
+    # 'press', 'release' or 'wait'
+    action: str
+    key: Any = None
+    seconds: float = 0.0
+
+
+def parse_keys(shortcut: str) -> Union[str, List[Union[Any, str]]]:
     """
-    Parse a keyboard shortcut string into a list of keys.
+    Parse one step of a shortcut string: a list of keys to press together, or
+    a string to type.
     """
     if len(shortcut)==1:
         return [shortcut]
-    elif '+' in shortcut or ',' in shortcut:
+    elif '+' in shortcut:
         parsed_keys = []
         for key in shortcut.split('+'):
-            if hasattr(Key, key):
-                parsed_keys.append(getattr(Key, key))
-            else:
-                parsed_keys.append(key)
-        if parsed_keys:
-            return parsed_keys
-        return shortcut
+            parsed_keys.append(get_key(key))
+        return parsed_keys
+    elif is_key_name(shortcut):
+        return [get_key(shortcut)]
     else:
         return shortcut
 
 
-def create_execute_shortcut_function(command_string: str, delay:Optional[float]=0.0) -> Callable:
+def split_steps(shortcut:str) -> List[str]:
+    # a lone ',' is the comma key, not a separator
+    if shortcut == ',':
+        return [',']
+    return [step for step in shortcut.split(',') if step]
+
+
+def compile_macro(shortcut:str, hold:Optional[float]=0.0, type_interval:float=0.0) -> List[KeyEvent]:
+    """
+    compile `shortcut` (see the module docstring) into key events.
+    `hold` is how long each key or chord is held down, and `type_interval`
+    the pause between typed characters.
+    """
+    program: List[KeyEvent] = []
+    for step in split_steps(shortcut):
+        repeat = 1
+        body, star, count = step.rpartition('*')
+        if star and body and count.isdigit():
+            step, repeat = body, int(count)
+
+        step_events: List[KeyEvent] = []
+        if step.startswith('wait:'):
+            try:
+                step_events.append(KeyEvent('wait', seconds=float(step[len('wait:'):])))
+            except ValueError:
+                raise ValueError(f"bad wait in shortcut '{shortcut}': '{step}'")
+        elif step.startswith('type:'):
+            step_events.extend(type_events(step[len('type:'):], type_interval))
+        else:
+            parsed_keys = parse_keys(step)
+            if isinstance(parsed_keys, str):
+                step_events.extend(type_events(parsed_keys, type_interval))
+            else:
+                step_events.extend(KeyEvent('press', key) for key in parsed_keys)
+                if hold:
+                    step_events.append(KeyEvent('wait', seconds=hold))
+                # release keys in reverse order
+                step_events.extend(KeyEvent('release', key) for key in reversed(parsed_keys))
+        program.extend(step_events * repeat)
+    return program
+
+
+def type_events(text:str, interval:float=0.0) -> List[KeyEvent]:
+    events: List[KeyEvent] = []
+    for c in text:
+        key = get_key(CONTROL_CHARACTERS[c]) if c in CONTROL_CHARACTERS else c
+        events.append(KeyEvent('press', key))
+        events.append(KeyEvent('release', key))
+        if interval:
+            events.append(KeyEvent('wait', seconds=interval))
+    return events
+
+
+class Macro:
+    """
+    A shortcut plus its rate limits: presses less than `min_interval` seconds
+    after the last accepted one are ignored, and at most `max_pending` runs of
+    it are queued or playing at once.
+
+    The shortcut is compiled the first time it's played (telling key names
+    from text needs pynput, which needs a display), then kept.
+    """
+    _program: Optional[List[KeyEvent]]
+
+    def __init__(
+        self, shortcut:str, hold:Optional[float]=0.0, type_interval:float=0.0,
+        min_interval:float=0.0, max_pending:int=4,
+    ):
+        self.shortcut = shortcut
+        self.hold = hold
+        self.type_interval = type_interval
+        self._program = None
+        self.min_interval = min_interval
+        self.max_pending = max_pending
+        self.pending = 0
+        self.last_accepted: Optional[float] = None
+
+    @property
+    def program(self) -> List[KeyEvent]:
+        if self._program is None:
+            self._program = compile_macro(self.shortcut, self.hold, self.type_interval)
+            logger.debug("compiled '%s' to %s key events", self.shortcut, len(self._program))
+        return self._program
+
+    def __repr__(self):
+        return f'Macro({self.shortcut!r})'
+
+
+class MacroPlayer:
+    """
+    Plays macros one after another on a dedicated thread.
+
+    Waits are timed against the macro's start rather than slept one after
+    another, so small delays don't add up over a long macro, and they can be
+    interrupted: `cancel` stops the playing macro at the next event, drops
+    queued ones and releases any keys the macro was holding down.
+    """
+    _shared: Optional['MacroPlayer'] = None
+    queue: Deque[Macro]
+    held: List[Any]
+
+    def __init__(self, controller=None):
+        self.controller = controller
+        self.queue = deque()
+        self.current: Optional[Macro] = None
+        self.cancelled = False
+        self.held = []
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls) -> 'MacroPlayer':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def play(self, macro:Macro) -> bool:
+        """queue `macro`; returns False if its rate limits dropped it"""
+        now = time.monotonic()
+        with self.condition:
+            if macro.last_accepted is not None and now - macro.last_accepted < macro.min_interval:
+                logger.debug("dropping %s: pressed again within %ss", macro, macro.min_interval)
+                return False
+            if macro.pending >= macro.max_pending:
+                logger.debug("dropping %s: already %s queued or playing", macro, macro.pending)
+                return False
+            macro.last_accepted = now
+            macro.pending += 1
+            self.queue.append(macro)
+            self.condition.notify_all()
+        return True
+
+    def cancel(self, macro:Optional[Macro]=None):
+        """stop `macro` (or everything) whether it's playing or still queued"""
+        with self.condition:
+            kept = deque()
+            for queued in self.queue:
+                if macro is None or queued is macro:
+                    queued.pending -= 1
+                else:
+                    kept.append(queued)
+            self.queue = kept
+            if self.current is not None and (macro is None or self.current is macro):
+                self.cancelled = True
+            self.condition.notify_all()
+
+    def idle(self, timeout:Optional[float]=None) -> bool:
+        """block until nothing is queued or playing"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and self.current is None, timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                self.current = macro = self.queue.popleft()
+                self.cancelled = False
+            try:
+                self.play_program(macro.program)
+            except Exception as e:
+                logger.exception(f"Macro {macro} failed; error: {e}")
+            finally:
+                self.release_held()
+                with self.condition:
+                    macro.pending -= 1
+                    self.current = None
+                    self.condition.notify_all()
+
+    def play_program(self, program:List[KeyEvent]):
+        controller = self.controller or get_controller()
+        due = time.monotonic()
+        for event in program:
+            if event.action == 'wait':
+                due += event.seconds
+                with self.condition:
+                    if self.condition.wait_for(lambda: self.cancelled, max(due - time.monotonic(), 0)):
+                        return
+                continue
+            if self.cancelled:
+                return
+            if event.action == 'press':
+                logger.debug("pressing: %s", event.key)
+                controller.press(event.key)
+                self.held.append(event.key)
+            else:
+                logger.debug("releasing: %s", event.key)
+                controller.release(event.key)
+                if event.key in self.held:
+                    self.held.remove(event.key)
+
+    def release_held(self):
+        # never leave a modifier stuck down because a macro was cut short
+        controller = self.controller or get_controller()
+        while self.held:
+            key = self.held.pop()
+            try:
+                controller.release(key)
+            except Exception as e:
+                logger.exception(f"Failed to release {key}; error: {e}")
+
+
+def create_execute_shortcut_function(
+    command_string: str, delay:Optional[float]=0.0,
+    player:Optional[MacroPlayer]=None, min_interval:float=0.0,
+) -> Callable:
     """
     command_string examples:
-        alt+k,alt-r
+        alt+k,alt+r
         alt+k
         j
         ctrl+c
+        down*3,wait:0.5,enter
+
+    `delay` is how long each key or chord is held down (some applications
+    require a "firm" key press).
     """
-    parsed_keys = parse_keys(command_string)
-    logger.debug("parsed keys from '%s': '%s'", command_string, parsed_keys)
+    macro = Macro(command_string, hold=delay, min_interval=min_interval)
 
     def execute_shortcut(pressed:bool) -> None:
         if not pressed:
             return
-        #TODO:refactor..
-        if isinstance(parsed_keys, str):
-            logger.debug("typing: %s", parsed_keys)
-            if len(parsed_keys) == 1:
-                controller.press(parsed_keys)
-                if delay:
-                    sleep(delay)
-                controller.release(parsed_keys)
-            else:
-                controller.type(parsed_keys)
-        else:
-            # Press keys
-            for key in parsed_keys:
-                logger.debug("pressing (and not releasing): %s", key)
-                controller.press(key)
-            if delay:
-                sleep(delay)
-            # Release keys in reverse order
-            for key in reversed(parsed_keys):
-                logger.debug("releasing key: %s", key)
-                controller.release(key)
+        (player or MacroPlayer.shared()).play(macro)
 
     return execute_shortcut
-
-
-# Create an execute function for the shortcut "ctrl+w"
-# close_window_fn = create_execute_shortcut_function('ctrl+w')
-
-# # Execute the shortcut
-# close_window_fn(controller)
@@ -0,0 +1,307 @@
+"""
+A Unix-socket API so other programs can drive keys on a running deck.
+
+    vsdlib layout.toml --socket
+
+Buttons are addressed by name: the `name` of a button in the toml file, or a
+display key claimed over the socket. Clients send one JSON object per line:
+
+    {"op": "update", "buttons": {"build": {"text": "ok", "background_color": "#2C1"}, "mic": {"text": "muted"}}}
+    {"op": "flush"}
+    {"op": "claim", "keys": {"build": 7}}
+    {"op": "release", "names": ["build"]}
+    {"op": "subscribe", "names": ["mic"]}    (or "names": "*")
+    {"op": "unsubscribe", "names": ["mic"]}
+    {"op": "list"}
+
+Updates from every client are merged per button and applied together every
+`flush_interval` seconds (or straight away on "flush"), so a client can send
+as often as it likes and each key is still redrawn at most once per flush.
+Subscribers get a line per key press or release of the buttons they asked
+for: {"event": "key", "name": "mic", "index": 3, "pressed": true}.
+Only "list" and errors get a reply.
+
+DaemonClient is a small blocking client for scripts.
+"""
+import os
+import json
+import errno
+import socket
+import tempfile
+import asyncio
+import logging
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from .board import Board
+from .buttons import Button, render_batch, blank_button, apply_update, UPDATE_FIELDS
+from .pages import LazyPages
+
+
+logger = logging.getLogger(__name__)
+
+def default_socket_path() -> str:
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(runtime_dir, 'vsdlib.sock')
+
+
+def socket_in_use(path:str) -> bool:
+    """whether something is accepting connections on the socket at `path`"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def bind_private_socket(path:str) -> socket.socket:
+    """
+    a socket bound at `path` that only this user can connect to. it's bound in
+    a fresh 0700 directory, made 0600 and then moved into place, so there's no
+    moment where others could connect
+    """
+    private_dir = tempfile.mkdtemp(prefix='.vsdlib-', dir=os.path.dirname(path) or '.')
+    private_path = os.path.join(private_dir, 'sock')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(private_path)
+        os.chmod(private_path, 0o600)
+        os.rename(private_path, path)
+    except BaseException:
+        sock.close()
+        if os.path.exists(private_path):
+            os.unlink(private_path)
+        raise
+    finally:
+        os.rmdir(private_dir)
+    return sock
+
+
+class Subscriber:
+    def __init__(self, writer:asyncio.StreamWriter):
+        self.writer = writer
+        self.names: Set[str] = set()
+        self.everything = False
+
+    def wants(self, name:str) -> bool:
+        return self.everything or name in self.names
+
+
+class Daemon:
+    """
+    Serves the socket API for one Board. Runs on the board's asyncio loop, so
+    updates are applied on the same thread as key events.
+
+    `max_client_buffer` bounds how many bytes of events can pile up for a
+    subscriber that isn't reading; past that its events are dropped.
+    """
+    pending: Dict[str, dict]
+    subscribers: Dict[asyncio.StreamWriter, Subscriber]
+
+    def __init__(
+        self, board:Board, path:Optional[str]=None, pages:Optional[LazyPages]=None,
+        flush_interval:float=1/30, max_client_buffer:int=64*1024,
+    ):
+        self.board = board
+        self.path = path or default_socket_path()
+        self.pages = pages
+        self.flush_interval = flush_interval
+        self.max_client_buffer = max_client_buffer
+        self.pending = dict()
+        self.subscribers = dict()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # (st_dev, st_ino) of the socket file we bound
+        self.inode: Optional[Tuple[int, int]] = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            if socket_in_use(self.path):
+                raise OSError(errno.EADDRINUSE, f"'{self.path}' is already being served; is vsdlib already running?")
+            # left over from a run that didn't get to clean up
+            os.unlink(self.path)
+        sock = bind_private_socket(self.path)
+        stat = os.stat(self.path)
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.server = await asyncio.start_unix_server(self.handle_client, sock=sock)
+        self.board.add_key_listener(self.handle_key_event)
+        logger.info("listening for button updates on '%s'", self.path)
+
+    async def stop(self):
+        self.board.remove_key_listener(self.handle_key_event)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        # only if it's still ours, not one a later instance bound after ours was removed
+        if (stat.st_dev, stat.st_ino) == self.inode:
+            os.unlink(self.path)
+
+    def find_buttons(self, names:Set[str]) -> Dict[str, List[Button]]:
+        """every button with one of `names` on a display key, the page showing, or any built page"""
+        found: Dict[str, List[Button]] = {name: [] for name in names}
+        for name in names:
+            index = self.board.display_keys.get(name)
+            if index is not None:
+                found[name].append(self.board.get(index))
+        layouts = [self.board.buttons]
+        if self.pages is not None:
+            layouts.extend(layout.positions for layout in list(self.pages.layouts.values()))
+        seen: Set[int] = set()
+        for positions in layouts:
+            for button in positions.values():
+                if button.name in found and id(button) not in seen:
+                    seen.add(id(button))
+                    found[button.name].append(button)
+        return found
+
+    def queue_update(self, buttons:Dict[str, dict]):
+        for name, fields in buttons.items():
+            unknown = set(fields) - set(UPDATE_FIELDS)
+            if unknown:
+                raise ValueError(f"can't update {sorted(unknown)} of '{name}'; fields are {list(UPDATE_FIELDS)}")
+            self.pending.setdefault(name, dict()).update(fields)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        pending, self.pending = self.pending, dict()
+        if not pending:
+            return
+        found = self.find_buttons(set(pending))
+        with render_batch():
+            for name, fields in pending.items():
+                if not found[name]:
+                    logger.debug("no button named '%s' to update", name)
+                for button in found[name]:
+                    try:
+                        apply_update(button, fields)
+                    except Exception as e:
+                        logger.exception(f"Failed to update button '{name}'; error: {e}")
+
+    def claim(self, keys:Dict[str, int]):
+        for name, index in keys.items():
+            if not 0 <= int(index) < self.board.key_count:
+                raise ValueError(f"key {index} is out of range")
+            self.board.set_display_key(name, int(index))
+
+    def release(self, names:List[str]):
+        for name in names:
+            if name in self.board.display_keys:
+                self.board.unset_display_key(name)
+
+    def handle_key_event(self, index:int, pressed:bool, button:Button):
+        if button is blank_button or not button.name or not self.subscribers:
+            return
+        line = json.dumps({'event': 'key', 'name': button.name, 'index': index, 'pressed': pressed}).encode() + b'\n'
+        for subscriber in list(self.subscribers.values()):
+            if not subscriber.wants(button.name):
+                continue
+            if subscriber.writer.transport.get_write_buffer_size() > self.max_client_buffer:
+                logger.debug("subscriber isn't reading; dropping key event")
+                continue
+            subscriber.writer.write(line)
+
+    def handle_message(self, message:dict, writer:asyncio.StreamWriter) -> Optional[dict]:
+        op = message.get('op')
+        if op == 'update':
+            self.queue_update(message.get('buttons', {}))
+            if message.get('flush'):
+                self.flush()
+        elif op == 'flush':
+            self.flush()
+        elif op == 'claim':
+            self.claim(message.get('keys', {}))
+        elif op == 'release':
+            self.release(message.get('names', []))
+        elif op in ('subscribe', 'unsubscribe'):
+            subscriber = self.subscribers.setdefault(writer, Subscriber(writer))
+            names = message.get('names', '*')
+            if names == '*':
+                subscriber.everything = op == 'subscribe'
+            elif op == 'subscribe':
+                subscriber.names.update(names)
+            else:
+                subscriber.names.difference_update(names)
+        elif op == 'list':
+            names = {button.name for button in self.board.buttons.values() if button.name}
+            return {'names': sorted(names | set(self.board.display_keys))}
+        else:
+            raise ValueError(f"unknown op {op!r}")
+        return None
+
+    async def handle_client(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    reply = self.handle_message(json.loads(line), writer)
+                except Exception as e:
+                    reply = {'error': f"{type(e).__name__}: {e}"}
+                if reply is not None:
+                    writer.write(json.dumps(reply).encode() + b'\n')
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.subscribers.pop(writer, None)
+            writer.close()
+
+
+class DaemonClient:
+    """
+        client = DaemonClient()
+        client.update(build={'text': 'ok', 'background_color': '#2C1'})
+        for event in client.subscribe(['mic']):
+            ...
+    """
+    def __init__(self, path:Optional[str]=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path or default_socket_path())
+        self.file = self.socket.makefile('rb')
+
+    def send(self, **message):
+        self.socket.sendall(json.dumps(message).encode() + b'\n')
+
+    def request(self, **message) -> dict:
+        self.send(**message)
+        return json.loads(self.file.readline())
+
+    def update(self, flush:bool=False, **buttons:dict):
+        self.send(op='update', buttons=buttons, flush=flush)
+
+    def flush(self):
+        self.send(op='flush')
+
+    def claim(self, **keys:int):
+        self.send(op='claim', keys=keys)
+
+    def release(self, *names:str):
+        self.send(op='release', names=list(names))
+
+    def list(self) -> List[str]:
+        return self.request(op='list')['names']
+
+    def subscribe(self, names:Union[List[str], str]='*') -> Iterator[dict]:
+        """start getting key events for `names` (default: every named button); returns `events()`"""
+        self.send(op='subscribe', names=names)
+        return self.events()
+
+    def events(self) -> Iterator[dict]:
+        for line in self.file:
+            yield json.loads(line)
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
@@ -0,0 +1,289 @@
+"""
+Run the StreamDeck's USB I/O in a separate process.
+
+Rendering and button handlers share the main process's GIL, so a busy render
+or a slow pure-Python handler could hold up reading key events. With
+RemoteStreamDeck, a small child process owns the device instead: it reads key
+events and sends them back over a pipe, and writes the key images the main
+process puts in a shared-memory ring buffer.
+
+    sd = RemoteStreamDeck()
+    board = Board(sd)
+
+The child only imports the StreamDeck library, so it starts fast and never
+waits on anything but the device.
+"""
+import struct
+import threading
+import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Dict, Optional, Union
+
+
+logger = logging.getLogger(__name__)
+
+# per ring slot: key index, payload length. the payload follows
+SLOT_HEADER = struct.Struct('<HI')
+# a payload that didn't fit in its slot; it comes over the overflow pipe instead
+OVERFLOW = 0xFFFFFFFF
+
+
+def run_device_process(
+    conn, overflow_conn, shm_name:str, slots:int, slot_size:int, filled, free,
+    device_index:int, serial:Optional[str], transport:Optional[str],
+):
+    from StreamDeck.DeviceManager import DeviceManager
+
+    shm = SharedMemory(name=shm_name)
+    sd = None
+    try:
+        try:
+            decks = DeviceManager(transport=transport).enumerate()
+            if serial is not None:
+                for deck in decks:
+                    deck.open()
+                    if deck.get_serial_number() == serial:
+                        sd = deck
+                        break
+                    deck.close()
+                else:
+                    raise RuntimeError(f"no StreamDeck with serial number '{serial}'")
+            else:
+                sd = decks[device_index]
+                sd.open()
+        except Exception as e:
+            conn.send(('error', f"{type(e).__name__}: {e}"))
+            return
+
+        conn.send(('ready', {
+            'deck_class': type(sd).__name__,
+            'deck_type': sd.deck_type(),
+            'key_count': sd.key_count(),
+            'KEY_COLS': sd.KEY_COLS,
+            'KEY_ROWS': sd.KEY_ROWS,
+            'KEY_PIXEL_WIDTH': sd.KEY_PIXEL_WIDTH,
+            'KEY_PIXEL_HEIGHT': sd.KEY_PIXEL_HEIGHT,
+            'KEY_IMAGE_FORMAT': sd.KEY_IMAGE_FORMAT,
+            'KEY_FLIP': sd.KEY_FLIP,
+            'KEY_ROTATION': sd.KEY_ROTATION,
+        }))
+        sd.set_key_callback(lambda deck, key, state: conn.send(('key', key, state)))
+
+        stopping = threading.Event()
+
+        def write_frames():
+            tail = 0
+            while True:
+                filled.acquire()
+                if stopping.is_set():
+                    return
+                start = tail * slot_size
+                key, length = SLOT_HEADER.unpack_from(shm.buf, start)
+                if length == OVERFLOW:
+                    image: Union[bytes, memoryview] = overflow_conn.recv_bytes()
+                else:
+                    data_start = start + SLOT_HEADER.size
+                    image = shm.buf[data_start:data_start + length]
+                try:
+                    sd.set_key_image(key, image)
+                except Exception as e:
+                    logger.exception(f"Failed to write image to key {key}; error: {e}")
+                finally:
+                    if isinstance(image, memoryview):
+                        image.release()
+                    tail = (tail + 1) % slots
+                    free.release()
+
+        frame_thread = threading.Thread(target=write_frames, daemon=True)
+        frame_thread.start()
+
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                # the main process went away
+                break
+            command, *args = message
+            if command == 'close':
+                break
+            try:
+                getattr(sd, command)(*args)
+            except Exception as e:
+                logger.exception(f"StreamDeck.{command}{tuple(args)} failed; error: {e}")
+
+        stopping.set()
+        filled.release()
+        frame_thread.join(5)
+    finally:
+        if sd is not None:
+            try:
+                sd.close()
+            except Exception:
+                pass
+        shm.close()
+
+
+class RemoteStreamDeck:
+    """
+    Stands in for a StreamDeck whose I/O happens in a child process (see the
+    module docstring). Has the parts of the StreamDeck interface that Board
+    and KeyWriter use.
+
+    Images go through a ring of `slots` slots of `slot_size` bytes each, so up
+    to `slots` images can be waiting before `set_key_image` blocks. Images
+    bigger than a slot are sent over a pipe instead.
+    """
+    key_callback: Optional[Callable]
+    KEY_COLS: int
+    KEY_ROWS: int
+    KEY_PIXEL_WIDTH: int
+    KEY_PIXEL_HEIGHT: int
+
+    def __init__(
+        self, device_index:int=0, serial:Optional[str]=None,
+        slots:int=32, slot_size:int=64*1024,
+        transport:Optional[str]=None, start_timeout:float=10,
+    ):
+        ctx = multiprocessing.get_context('spawn')
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = SharedMemory(create=True, size=slots * slot_size)
+        self.conn, child_conn = ctx.Pipe()
+        overflow_recv, self.overflow_conn = ctx.Pipe(duplex=False)
+        self.filled = ctx.Semaphore(0)
+        self.free = ctx.Semaphore(slots)
+        self.head = 0
+        self.write_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.key_callback = None
+        self.closed = False
+
+        self.process = ctx.Process(
+            target=run_device_process, name='vsdlib-device', daemon=True,
+            args=(
+                child_conn, overflow_recv, self.shm.name, slots, slot_size, self.filled, self.free,
+                device_index, serial, transport,
+            ),
+        )
+        self.process.start()
+        child_conn.close()
+        overflow_recv.close()
+
+        if not self.conn.poll(start_timeout):
+            self._shutdown()
+            raise TimeoutError(f"StreamDeck process didn't start within {start_timeout} seconds")
+        status, info = self.conn.recv()
+        if status != 'ready':
+            self._shutdown()
+            raise RuntimeError(f"StreamDeck process failed to open the device: {info}")
+        self.info: Dict[str, Any] = info
+        for name in ('KEY_COLS', 'KEY_ROWS', 'KEY_PIXEL_WIDTH', 'KEY_PIXEL_HEIGHT', 'KEY_IMAGE_FORMAT', 'KEY_FLIP', 'KEY_ROTATION'):
+            setattr(self, name, info[name])
+
+        self.reader = threading.Thread(target=self._read_events, daemon=True)
+        self.reader.start()
+
+    @property
+    def deck_class(self) -> str:
+        """the StreamDeck.Devices class of the deck in the child process, e.g. 'StreamDeckXL'"""
+        return self.info['deck_class']
+
+    def deck_type(self) -> str:
+        return self.info['deck_type']
+
+    def key_count(self) -> int:
+        return self.info['key_count']
+
+    def key_image_format(self) -> dict:
+        return {
+            'size': (self.KEY_PIXEL_WIDTH, self.KEY_PIXEL_HEIGHT),
+            'format': self.KEY_IMAGE_FORMAT,
+            'flip': self.KEY_FLIP,
+            'rotation': self.KEY_ROTATION,
+        }
+
+    def is_visual(self) -> bool:
+        return True
+
+    def open(self):
+        pass
+
+    def set_key_image(self, key:int, image:Union[bytes, memoryview]):
+        length = len(image)
+        with self.write_lock:
+            # wait for the child to free a slot, giving up if it has died
+            while not self.free.acquire(timeout=0.5):
+                if not self.process.is_alive():
+                    raise RuntimeError("StreamDeck process is gone")
+            start = self.head * self.slot_size
+            self.head = (self.head + 1) % self.slots
+            if SLOT_HEADER.size + length > self.slot_size:
+                SLOT_HEADER.pack_into(self.shm.buf, start, key, OVERFLOW)
+                # let the child start reading before sending, or a payload
+                # bigger than the pipe's buffer would never finish sending
+                self.filled.release()
+                self.overflow_conn.send_bytes(image)
+            else:
+                SLOT_HEADER.pack_into(self.shm.buf, start, key, length)
+                data_start = start + SLOT_HEADER.size
+                self.shm.buf[data_start:data_start + length] = image
+                self.filled.release()
+
+    def set_brightness(self, percent:int):
+        self._send('set_brightness', percent)
+
+    def reset(self):
+        self._send('reset')
+
+    def set_key_callback(self, callback:Optional[Callable]):
+        self.key_callback = callback
+
+    def set_key_callback_async(self, async_callback:Callable, loop=None):
+        import asyncio
+
+        loop = loop or asyncio.get_event_loop()
+
+        def callback(*args):
+            asyncio.run_coroutine_threadsafe(async_callback(*args), loop)
+
+        self.set_key_callback(callback)
+
+    def close(self, timeout:float=5):
+        if self.closed:
+            return
+        self.closed = True
+        self._send('close')
+        self.process.join(timeout)
+        self._shutdown()
+
+    def _send(self, *message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def _read_events(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                if not self.closed:
+                    logger.error("StreamDeck process exited")
+                return
+            _, key, state = message
+            callback = self.key_callback
+            if callback is None:
+                continue
+            try:
+                callback(self, key, state)
+            except Exception as e:
+                logger.exception(f"Key callback failed for key {key}; error: {e}")
+
+    def _shutdown(self):
+        self.closed = True
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        self.conn.close()
+        self.overflow_conn.close()
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,133 @@
+import time
+import threading
+import logging
+from typing import Dict, Optional, Set
+
+from .board import Board
+from .buttons import ButtonSlot, send_batch
+from .animation import FrameClock
+from .bindings import SourceScheduler
+
+
+logger = logging.getLogger(__name__)
+
+
+class IdleManager:
+    """
+    Puts a Board to sleep when nobody has pressed a key for `timeout` seconds.
+
+    Asleep, the deck is dimmed to `idle_brightness`, nothing is rendered or
+    written (buttons still change; their keys are just marked stale),
+    animations and bound sources stop and `board.awake` is cleared so other
+    periodic work can wait for it. The next key press wakes it: brightness comes
+    back and every stale key is rendered once and sent as one batch, skipping
+    any that ended up looking the same as before. The press that wakes the
+    deck (and its release) isn't passed on to the button, since the keys
+    weren't showing what they do.
+    """
+    swallowed: Set[int]
+
+    def __init__(self, board:Board, timeout:float=600, idle_brightness:int=0):
+        self.board = board
+        self.timeout = timeout
+        self.idle_brightness = idle_brightness
+        self.asleep = False
+        self.last_activity = time.monotonic()
+        self.swallowed = set()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.board.idle = self
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(5)
+        self.wake()
+        if self.board.idle is self:
+            self.board.idle = None
+
+    def handle_key_event(self, index:int, pressed:bool) -> bool:
+        """note activity; returns False if the event only woke the deck and shouldn't go to the button"""
+        with self.condition:
+            self.last_activity = time.monotonic()
+            self.condition.notify_all()
+            if not pressed and index in self.swallowed:
+                self.swallowed.discard(index)
+                return False
+            if not self.asleep:
+                return True
+            if pressed:
+                self.swallowed.add(index)
+        self.wake()
+        return not pressed
+
+    def _run(self):
+        with self.condition:
+            while not self.stopped:
+                remaining = self.last_activity + self.timeout - time.monotonic()
+                if remaining > 0 or self.asleep:
+                    self.condition.wait(remaining if remaining > 0 else None)
+                    continue
+                self.condition.release()
+                try:
+                    self.sleep()
+                finally:
+                    self.condition.acquire()
+
+    def sleep(self):
+        board = self.board
+        with self.condition:
+            if self.asleep:
+                return
+            self.asleep = True
+        logger.info("no key pressed for %ss; going idle", self.timeout)
+        board.awake.clear()
+        for slot in board.slots.values():
+            slot.suspended = True
+        board.writer.pause()
+        if FrameClock._shared is not None:
+            FrameClock._shared.pause()
+        if SourceScheduler._shared is not None:
+            SourceScheduler._shared.pause()
+        self.dim()
+
+    def dim(self):
+        try:
+            self.board.sd.set_brightness(self.idle_brightness)
+        except Exception as e:
+            logger.exception(f"Failed to dim the stream deck; error: {e}")
+
+    def wake(self):
+        board = self.board
+        with self.condition:
+            if not self.asleep:
+                return
+            self.asleep = False
+            self.last_activity = time.monotonic()
+            self.condition.notify_all()
+        stale: Dict[ButtonSlot, None] = dict()
+        for slot in board.slots.values():
+            slot.suspended = False
+            if slot.stale:
+                slot.stale = False
+                stale[slot] = None
+        # queued while the writer is still paused, so they all go out together
+        send_batch(stale)
+        board.writer.resume()
+        if FrameClock._shared is not None:
+            FrameClock._shared.resume()
+        if SourceScheduler._shared is not None:
+            SourceScheduler._shared.resume()
+        try:
+            board.sd.set_brightness(board.brightness)
+        except Exception as e:
+            logger.exception(f"Failed to restore brightness; error: {e}")
+        board.awake.set()
+        logger.info("woke up; redrew %s changed keys", len(stale))
@@ -1,17 +1,31 @@
 import io
 import os
-from typing import Dict, Optional, Tuple, Callable, List
+import logging
+import threading
+import weakref
+import functools
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Callable, List, Any, NamedTuple
 
 from PIL.ImageDraw import Draw
-from PIL.Image import Image, new as new_image
+from PIL.Image import Image, new as new_image, LANCZOS, Transpose
 from PIL.ImageFont import truetype, FreeTypeFont
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageSequence, ImageColor
+import numpy as np
 
 from .button_style import ButtonStyle
 from .colors import light_purple
 
 
-emoji_font_filepath = os.path.join('Noto_Color_Emoji', 'NotoColorEmoji-Regular.ttf')
+logger = logging.getLogger(__name__)
+
+# Noto_Color_Emoji lives next to the vsdlib package, not wherever we were started from
+emoji_font_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Noto_Color_Emoji')
+emoji_font_filepath = os.path.join(emoji_font_dir, 'NotoColorEmoji-Regular.ttf')
+# color emoji fonts (CBDT) only contain fixed bitmap strikes; Noto Color Emoji's is 109px
+emoji_font_size = 109
+# found relative to where we were started from
+text_font_path = 'SourceCodePro-Regular.otf'
 
 
 def img_to_bytes(img:Image, rotate:bool=False) -> bytes:
@@ -27,30 +41,250 @@ def img_to_bytes(img:Image, rotate:bool=False) -> bytes:
 def rotate_image(image: Image, degrees: int) -> Image:
     return image.rotate(-degrees)  # Negative degree for clockwise rotation
 
-# @functools.lru_cache
-def generate_text_image(
-    # size:Tuple[int,int]=(97,97),
-    background_color:str,
-    style:'ButtonStyle',
-    text:str='',
-    rotation:int=0,
-    # background_color=light_purple,
-    # text_color=black,
-    # font_size=40,
-):
-    width, height = style.__class__.size
-    img: Image = new_image("RGB", style.size, color=background_color)
-    draw = Draw(img)
+
+# frame classes, used to pick an EncodingPolicy.
+# flat: solid background + text/emoji. photo: image files and animations.
+# graph: live graphs, redrawn every sample, so cheap to encode matters more than small
+FLAT = 'flat'
+PHOTO = 'photo'
+GRAPH = 'graph'
+
+
+class EncodingPolicy(NamedTuple):
+    """
+    JPEG settings for one class of key image.
+
+    subsampling: 0 is 4:4:4 (sharp colored edges, bigger), 2 is 4:2:0 (smaller, smears color edges)
+    min_quality: how far quality may be lowered to fit under an encoder's max_bytes
+    """
+    quality: int
+    subsampling: int
+    optimize: bool = True
+    min_quality: int = 40
+
+    def encode(self, img:Image, quality:Optional[int]=None) -> bytes:
+        buf = io.BytesIO()
+        img.save(
+            buf, format='JPEG', quality=quality or self.quality,
+            subsampling=self.subsampling, optimize=self.optimize,
+        )
+        return buf.getvalue()
+
+
+# what we did before having policies; mostly useful for comparing against
+LOSSLESS_ISH = EncodingPolicy(quality=100, subsampling=0, optimize=False, min_quality=100)
+
+default_policies: Dict[str, EncodingPolicy] = {
+    # text needs full chroma or colored glyph edges bleed, but solid backgrounds compress
+    # so well that quality 85 is already visually identical on a 96px key
+    FLAT: EncodingPolicy(quality=85, subsampling=0),
+    PHOTO: EncodingPolicy(quality=80, subsampling=2),
+    # white labels and solid fills survive 4:2:0; skipping the optimize pass takes a third off the encode
+    GRAPH: EncodingPolicy(quality=80, subsampling=2, optimize=False),
+}
+
+
+class PayloadCache:
+    """
+    A small thread-safe LRU of rendered payloads, so redrawing a button whose
+    look hasn't changed (page switches, press/release) skips PIL entirely.
+    """
+    entries: 'OrderedDict[Any, bytes]'
+
+    def __init__(self, max_entries:int=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key) -> Optional[bytes]:
+        with self.lock:
+            payload = self.entries.get(key)
+            if payload is not None:
+                self.entries.move_to_end(key)
+            return payload
+
+    def put(self, key, payload:bytes):
+        with self.lock:
+            self.entries[key] = payload
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class KeyImageEncoder:
+    """
+    Turns a rendered key image into the bytes a particular stream deck expects.
+
+    The device's `key_image_format()` is read once. The board's rotation and the
+    device's own flip/rotation are folded into a single transpose, so each frame
+    is transformed and encoded exactly once.
+
+    JPEG quality/subsampling comes from the EncodingPolicy for the frame's class.
+    If max_bytes is set, quality is stepped down until the payload fits (or the
+    policy's min_quality is reached), since every extra report costs transfer time.
+    """
+    size: Optional[Tuple[int,int]]
+    format: str
+    flip: Tuple[bool,bool]
+    rotation: int
+    transposes: Dict[int, Optional[Transpose]]
+    policies: Dict[str, EncodingPolicy]
+    max_bytes: Optional[int]
+    cache: PayloadCache
+    # pre-rendered payloads to try before rendering; see vsdlib.bundle
+    bundle: Optional[Any] = None
+    default: 'KeyImageEncoder'
+    _device_encoders: 'weakref.WeakKeyDictionary[Any, KeyImageEncoder]' = weakref.WeakKeyDictionary()
+
+    def __init__(
+        self, size:Optional[Tuple[int,int]]=None, format:str='JPEG',
+        flip:Tuple[bool,bool]=(False, False), rotation:int=0,
+        policies:Optional[Dict[str, EncodingPolicy]]=None, max_bytes:Optional[int]=None,
+    ):
+        self.size = tuple(size) if size is not None else None
+        self.format = format
+        self.flip = tuple(flip)
+        self.rotation = rotation
+        self.transposes = dict()
+        self.policies = {**default_policies, **(policies or {})}
+        self.max_bytes = max_bytes
+        self.cache = PayloadCache()
+        self._key: Optional[tuple] = None
+
+    def key(self) -> tuple:
+        """
+        everything that decides what a frame encodes to. the encoder itself can
+        change (set_policy, set_max_bytes), so key payloads kept for it on this,
+        not on the encoder
+        """
+        if self._key is None:
+            self._key = (
+                self.size, self.format, self.flip, self.rotation,
+                tuple(sorted(self.policies.items())), self.max_bytes,
+            )
+        return self._key
+
+    @classmethod
+    def from_format(cls, key_image_format:dict) -> 'KeyImageEncoder':
+        return cls(
+            key_image_format['size'], key_image_format['format'],
+            key_image_format['flip'], key_image_format['rotation'],
+        )
+
+    @classmethod
+    def for_device(cls, sd) -> 'KeyImageEncoder':
+        encoder = cls._device_encoders.get(sd)
+        if encoder is None:
+            encoder = cls._device_encoders[sd] = cls.from_format(sd.key_image_format())
+        return encoder
+
+    @classmethod
+    def attach(cls, sd, encoder:'KeyImageEncoder'):
+        """use `encoder` for everything rendered for `sd` (a StreamDeck or anything standing in for one)"""
+        cls._device_encoders[sd] = encoder
+
+    @classmethod
+    def set_default(cls, encoder:'KeyImageEncoder'):
+        """used for images rendered before they know which device they'll be shown on"""
+        cls.default = encoder
+
+    def apply_device_transform(self, img:Image, rotation:int=0) -> Image:
+        """the slow way: every step applied separately. only used to work out the combined transpose."""
+        img = img.rotate(-rotation)
+        if self.rotation:
+            img = img.rotate(self.rotation)
+        if self.flip[0]:
+            img = img.transpose(Transpose.FLIP_LEFT_RIGHT)
+        if self.flip[1]:
+            img = img.transpose(Transpose.FLIP_TOP_BOTTOM)
+        return img
+
+    def get_transpose(self, rotation:int=0) -> Optional[Transpose]:
+        rotation %= 360
+        if rotation not in self.transposes:
+            if rotation % 90 or self.rotation % 90:
+                raise ValueError(f"Key images can only be rotated by multiples of 90 degrees, not {rotation}")
+            # rotations and flips of a square all land on one of the 8 symmetries
+            # of the square; find which one by pushing a small asymmetric probe through.
+            probe = new_image("L", (2, 2))
+            probe.putdata([0, 1, 2, 3])
+            expected = list(self.apply_device_transform(probe, rotation).getdata())
+            if expected == [0, 1, 2, 3]:
+                self.transposes[rotation] = None
+            else:
+                self.transposes[rotation] = next(
+                    t for t in Transpose
+                    if list(probe.transpose(t).getdata()) == expected
+                )
+        return self.transposes[rotation]
+
+    def transform(self, img:Image, rotation:int=0) -> Image:
+        if self.size is not None and img.size != self.size:
+            img = img.resize(self.size)
+        transpose = self.get_transpose(rotation)
+        if transpose is not None:
+            img = img.transpose(transpose)
+        return img
+
+    def set_policy(self, frame_class:str, policy:EncodingPolicy):
+        self.policies[frame_class] = policy
+        self._key = None
+        self.cache.clear()
+
+    def set_max_bytes(self, max_bytes:Optional[int]):
+        self.max_bytes = max_bytes
+        self._key = None
+        self.cache.clear()
+
+    def encode(self, img:Image, frame_class:str=FLAT) -> bytes:
+        if self.format != 'JPEG':
+            buf = io.BytesIO()
+            img.save(buf, format=self.format)
+            return buf.getvalue()
+
+        policy = self.policies.get(frame_class, self.policies[FLAT])
+        quality = policy.quality
+        while True:
+            payload = policy.encode(img, quality)
+            if self.max_bytes is None or len(payload) <= self.max_bytes or quality <= policy.min_quality:
+                return payload
+            quality = max(policy.min_quality, quality - 10)
+
+    def to_native(self, img:Image, rotation:int=0, frame_class:str=FLAT) -> bytes:
+        return self.encode(self.transform(img, rotation), frame_class)
+
+
+# until a Board says otherwise, assume an XL-style deck: JPEG, mounted upside down
+KeyImageEncoder.set_default(KeyImageEncoder(format='JPEG', flip=(True, True)))
+
+@functools.lru_cache(maxsize=64)
+def load_font(path:str, size:int) -> FreeTypeFont:
+    return truetype(path, size=size)
+
+
+@functools.lru_cache(maxsize=512)
+def text_mask(text:str, font_size:int, size:Tuple[int,int], font_path:str=text_font_path) -> np.ndarray:
+    """
+    `text` rasterized as an alpha mask (0-255) the size of a key, centered and
+    shrunk from `font_size` until it fits. Keyed only on what affects the
+    layout, so every color a key is ever shown in shares one mask.
+    """
+    width, height = size
+    draw = Draw(new_image("L", size))
 
     textwidth: float = 0
     textheight: float = 0
     font: Optional[FreeTypeFont] = None
     text_fits = False
-    font_size = int(style.font_size)
     while not text_fits:
-        font = truetype('SourceCodePro-Regular.otf', size=font_size)
-        # font = truetype(emoji_font_filepath, size=font_size)
-        # font = truetype('NotoColorEmoji.ttf', size=109)
+        font = load_font(font_path, font_size)
         try:
             _, _, textwidth, textheight = draw.textbbox((0, 0), text, font)
         except Exception as e:
@@ -59,44 +293,150 @@ def generate_text_image(
         text_fits = textwidth <= width and textheight <= height
         font_size -= 1
 
-    x = (width - textwidth) / 2
-    y = (height - textheight) / 2
-    draw.text((x, y), text, font=font, fill=style.text_color)
-    if rotation:
-        img = rotate_image(img, rotation)
-    img = rotate_image(img, 180)
-    return img_to_bytes(img)
+    mask = new_image("L", size, 0)
+    Draw(mask).text(((width - textwidth) / 2, (height - textheight) / 2), text, font=font, fill=255)
+    array = np.asarray(mask)
+    array.flags.writeable = False
+    return array
+
+
+@functools.lru_cache(maxsize=256)
+def blend_palette(background_color:str, text_color:str) -> bytes:
+    """for every alpha 0-255, text_color blended over background_color, as a 'P' image palette"""
+    background = np.array(ImageColor.getrgb(background_color)[:3], dtype=np.float32)
+    text = np.array(ImageColor.getrgb(text_color)[:3], dtype=np.float32)
+    alpha = np.arange(256, dtype=np.float32)[:, None] / 255
+    return np.rint(background + (text - background) * alpha).astype(np.uint8).tobytes()
+
+
+def colorize(mask:np.ndarray, background_color:str, text_color:str) -> Image:
+    """
+    a text mask in the given colors. the blend is worked out once per alpha
+    value, and PIL maps every pixel through it, so no text is laid out again
+    """
+    height, width = mask.shape
+    img = PILImage.frombuffer("P", (width, height), mask.tobytes(), "raw", "P", 0, 1)
+    img.putpalette(blend_palette(background_color, text_color))
+    return img.convert("RGB")
+
+
+def generate_text_image(
+    # size:Tuple[int,int]=(97,97),
+    background_color:str,
+    style:'ButtonStyle',
+    text:str='',
+    rotation:int=0,
+    # background_color=light_purple,
+    # text_color=black,
+    # font_size=40,
+    encoder:Optional[KeyImageEncoder]=None,
+):
+    mask = text_mask(text, int(style.font_size), tuple(style.__class__.size))
+    img = colorize(mask, background_color, style.text_color)
+    return (encoder or KeyImageEncoder.default).to_native(img, rotation)
+
+
+class EmojiAtlas:
+    """
+    In-memory cache of rasterized color emoji, keyed by codepoint sequence and key size.
+
+    Glyphs are drawn from the font's bitmap strike once, scaled to fit the key,
+    and kept as RGBA images so drawing an emoji button is just a paste.
+    """
+    glyphs: Dict[Tuple[Tuple[int, ...], Tuple[int, int]], Image]
+    font: Optional[FreeTypeFont]
+
+    def __init__(self, font_path:str=emoji_font_filepath, font_size:int=emoji_font_size, margin:int=4):
+        self.font_path = font_path
+        self.font_size = font_size
+        self.margin = margin
+        self.glyphs = dict()
+        self.font = None
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def load_font(self) -> FreeTypeFont:
+        if self.font is None:
+            self.font = truetype(self.font_path, size=self.font_size)
+        return self.font
+
+    def get(self, text:str, size:Tuple[int,int]) -> Image:
+        key = (tuple(ord(c) for c in text), tuple(size))
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            with self.lock:
+                glyph = self.glyphs.get(key)
+                if glyph is None:
+                    glyph = self.glyphs[key] = self.rasterize(text, size)
+        return glyph
+
+    def rasterize(self, text:str, size:Tuple[int,int]) -> Image:
+        font = self.load_font()
+        left, top, right, bottom = font.getbbox(text)
+        glyph: Image = new_image("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+        Draw(glyph).text((-left, -top), text, font=font, embedded_color=True)
+
+        width, height = size
+        scale = min(
+            (width - 2*self.margin) / glyph.width,
+            (height - 2*self.margin) / glyph.height,
+        )
+        return glyph.resize((max(1, round(glyph.width*scale)), max(1, round(glyph.height*scale))), LANCZOS)
+
+
+emoji_atlas = EmojiAtlas()
 
 
 def generate_emoji_image(
     background_color:str=light_purple,
     style:'ButtonStyle'=ButtonStyle(),
     text:str='',
+    rotation:int=0,
+    encoder:Optional[KeyImageEncoder]=None,
 ):
-    width, height = style.__class__.size
+    try:
+        glyph = emoji_atlas.get(text, style.size)
+    except OSError as e:
+        # font file missing or not a color font; still show something useful
+        if not emoji_atlas.failed:
+            logger.warning(f"Failed to load emoji font '{emoji_atlas.font_path}'; falling back on text. error: {e}")
+            emoji_atlas.failed = True
+        return generate_text_image(background_color, style, text, rotation=rotation, encoder=encoder)
+
+    width, height = style.size
     img: Image = new_image("RGB", style.size, color=background_color)
-    draw = Draw(img)
+    img.paste(glyph, ((width - glyph.width) // 2, (height - glyph.height) // 2), glyph)
+    return (encoder or KeyImageEncoder.default).to_native(img, rotation)
 
-    textwidth: float = 0
-    textheight: float = 0
-    font: Optional[FreeTypeFont] = None
-    font = truetype('SourceCodePro-Regular.otf', size=109)
-
-    x = (width - textwidth) / 2
-    y = (height - textheight) / 2
-    draw.text((x, y), text, font=font, fill=style.text_color)
-    return img_to_bytes(img)
-
-
-def load_button_image(filepath:str, size:Tuple[int,int], rotation:int=0) -> bytes:
-    image = PILImage.open(filepath)
-    N, M = size # Sample values
-    image_resized = image.resize((N, M))
-    buffer = io.BytesIO()
-    image_resized.save(buffer, format="JPEG")
-    image_jpeg = PILImage.open(buffer)
-    image_rotated = image_jpeg.rotate(rotation, expand=True)
-    final_buffer = io.BytesIO()
-    image_rotated.save(final_buffer, format="JPEG")
-    image_bytes = final_buffer.getvalue()
-    return image_bytes
+
+def load_button_image(
+    filepath:str, size:Tuple[int,int], rotation:int=0,
+    encoder:Optional[KeyImageEncoder]=None,
+) -> bytes:
+    with PILImage.open(filepath) as image:
+        image_resized = image.convert("RGB").resize(size)
+    return (encoder or KeyImageEncoder.default).to_native(image_resized, rotation, PHOTO)
+
+
+def load_animation_frames(
+    filepath:str, size:Tuple[int,int], rotation:int=0,
+    background_color:str=light_purple,
+    encoder:Optional[KeyImageEncoder]=None,
+) -> Tuple[List[bytes], List[float]]:
+    """
+    decode every frame of an animated GIF/APNG once and return the frames already
+    resized, rotated and encoded for the device, along with each frame's duration in seconds.
+    """
+    encoder = encoder or KeyImageEncoder.default
+    frames: List[bytes] = []
+    durations: List[float] = []
+    with PILImage.open(filepath) as image:
+        for frame in ImageSequence.Iterator(image):
+            # durations are in milliseconds; some encoders write 0 meaning "as fast as possible"
+            duration = frame.info.get('duration') or 100
+            rgba = frame.convert('RGBA').resize(size)
+            img: Image = new_image("RGB", size, color=background_color)
+            img.paste(rgba, (0, 0), rgba)
+            frames.append(encoder.to_native(img, rotation, PHOTO))
+            durations.append(duration / 1000)
+    return frames, durations
@@ -0,0 +1,205 @@
+"""
+Record the key presses of a real session and play them back against a
+stand-in deck, so a slow session can be turned into a repeatable benchmark.
+
+    vsdlib layout.toml --record session.vsdj
+    vsdlib replay session.vsdj                  # as fast as possible
+    vsdlib replay session.vsdj --speed 1        # at the recorded pace
+
+Only the events that reached the buttons are recorded (not the press that
+wakes an idle deck), along with which page was showing for each one, so a page
+changed from outside (e.g. through the daemon) is changed back to on replay.
+
+File layout:
+    8 bytes   MAGIC
+    4 bytes   little-endian length of the header
+    header    json: {deck, key_count, toml_path, page, started}
+    records   each EVENT: seconds since the start (double), kind, key index.
+              a PAGE record is followed by the page name's length (2 bytes) and the name
+"""
+import json
+import time
+import struct
+import asyncio
+import threading
+import logging
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional
+
+from .board import Board
+from .pages import LazyPages
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VSDJ\x00\x00\x00\x01'
+HEADER_LENGTH = struct.Struct('<I')
+EVENT = struct.Struct('<dBB')
+NAME_LENGTH = struct.Struct('<H')
+# record kinds
+RELEASE, PRESS, PAGE = 0, 1, 2
+
+
+class JournalEvent(NamedTuple):
+    # seconds since recording started
+    time: float
+    index: int
+    pressed: bool
+    # the page showing when the key was pressed, if pages were recorded
+    page: Optional[str]
+
+
+class Journal(NamedTuple):
+    header: Dict[str, Any]
+    events: List[JournalEvent]
+
+    @classmethod
+    def read(cls, path:str) -> 'Journal':
+        with open(path, 'rb') as fr:
+            data = fr.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' is not a vsdlib key journal")
+        offset = len(MAGIC)
+        header_length, = HEADER_LENGTH.unpack_from(data, offset)
+        offset += HEADER_LENGTH.size
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+
+        events: List[JournalEvent] = []
+        page = header.get('page')
+        # a recording cut off mid-record (e.g. the process was killed) just ends early
+        while offset + EVENT.size <= len(data):
+            seconds, kind, index = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            if kind == PAGE:
+                if offset + NAME_LENGTH.size > len(data):
+                    break
+                length, = NAME_LENGTH.unpack_from(data, offset)
+                offset += NAME_LENGTH.size
+                page = data[offset:offset + length].decode()
+                offset += length
+            else:
+                events.append(JournalEvent(seconds, index, kind == PRESS, page))
+        return cls(header, events)
+
+
+class KeyRecorder:
+    """
+    Appends every key event a Board handles to a journal file. Each record is
+    flushed as it's written (key presses come at human speed), so a crash
+    loses nothing.
+    """
+    file: Optional[BinaryIO]
+
+    def __init__(
+        self, board:Board, path:str,
+        pages:Optional[LazyPages]=None, toml_path:Optional[str]=None,
+    ):
+        self.board = board
+        self.path = path
+        self.pages = pages
+        self.toml_path = toml_path
+        self.file = None
+        self.page: Optional[str] = None
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.page = self.current_page()
+        header = json.dumps({
+            # a RemoteStreamDeck knows which class of deck it's standing in for
+            'deck': getattr(self.board.sd, 'deck_class', type(self.board.sd).__name__),
+            'key_count': self.board.key_count,
+            'toml_path': self.toml_path,
+            'page': self.page,
+            'started': time.time(),
+        }).encode()
+        self.file = open(self.path, 'wb')
+        self.file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        self.file.flush()
+        self.started = time.monotonic()
+        self.board.recorder = self
+        logger.info("recording key events to '%s'", self.path)
+
+    def stop(self):
+        if self.board.recorder is self:
+            self.board.recorder = None
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def current_page(self) -> Optional[str]:
+        return self.pages.current if self.pages is not None else None
+
+    def record(self, index:int, pressed:bool):
+        seconds = time.monotonic() - self.started
+        page = self.current_page()
+        with self.lock:
+            if self.file is None:
+                return
+            if page != self.page and page is not None:
+                name = page.encode()
+                self.file.write(EVENT.pack(seconds, PAGE, 0) + NAME_LENGTH.pack(len(name)) + name)
+                self.page = page
+            self.file.write(EVENT.pack(seconds, PRESS if pressed else RELEASE, index))
+            self.file.flush()
+
+
+class ReplayReport(NamedTuple):
+    events: int
+    # per event: from handing it to the board (showing its page first, if that changed)
+    # until every key it changed was written
+    latencies: List[float]
+    writes: int
+    bytes_written: int
+    seconds: float
+
+    def percentile(self, fraction:float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def format(self) -> str:
+        return '\n'.join([
+            f"{self.events} events in {self.seconds:.2f}s",
+            f"latency ms: p50 {self.percentile(0.5)*1000:.2f}  p95 {self.percentile(0.95)*1000:.2f}  "
+            f"max {max(self.latencies, default=0)*1000:.2f}  total {sum(self.latencies)*1000:.1f}",
+            f"device writes: {self.writes} ({self.bytes_written} bytes)",
+        ])
+
+
+async def replay(
+    board:Board, journal:Journal, pages:Optional[LazyPages]=None,
+    speed:Optional[float]=None, actions:bool=True,
+) -> ReplayReport:
+    """
+    feed `journal`'s events to `board`, as fast as possible or at `speed`
+    times the recorded pace. with `actions` off, buttons only show being
+    pressed and released and the recorded pages are shown, so nothing a button
+    does (typing, running commands) happens outside the deck
+    """
+    writes, bytes_written = metrics.key_write_bytes.count(), metrics.key_write_bytes.total()
+    latencies: List[float] = []
+    start = time.perf_counter()
+    for event in journal.events:
+        if speed:
+            delay = start + event.time / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        event_start = time.perf_counter()
+        if pages is not None and event.page is not None and event.page != pages.current:
+            pages.show(event.page, remember_parent=False)
+        if actions:
+            await board.handle_key_event(board.sd, event.index, event.pressed)
+        else:
+            board.get(event.index).handle_button_event(event.pressed)
+        board.writer.flush()
+        latencies.append(time.perf_counter() - event_start)
+    return ReplayReport(
+        len(journal.events), latencies,
+        metrics.key_write_bytes.count() - writes,
+        int(metrics.key_write_bytes.total() - bytes_written),
+        time.perf_counter() - start,
+    )
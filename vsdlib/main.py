@@ -1,19 +1,33 @@
 import time
 import argparse
+import importlib
 import tomllib
-from typing import Optional, TypedDict, NotRequired
+from typing import Callable, Optional, TypedDict, NotRequired, Tuple, List, Dict
 import asyncio
 import os
 import logging
 import sys
+import threading
 from os.path import exists, dirname, abspath, join
 
 from pydantic import BaseModel
+from StreamDeck.DeviceManager import DeviceManager
+from StreamDeck.Transport.Dummy import Dummy
 
 from vsdlib.board import Board, BoardLayout
-from vsdlib.buttons import Button, ButtonStyle
+from vsdlib.buttons import Button, ButtonStyle, ToggleButton, blank_button, TOGGLE_ON_COLORS
 from vsdlib.control import create_execute_shortcut_function
 from vsdlib.toml_loader import normalize
+from vsdlib.bundle import RenderBundle
+from vsdlib.pages import LazyPages
+from vsdlib.daemon import Daemon, default_socket_path
+from vsdlib.supervisor import DeviceSupervisor
+from vsdlib import metrics
+from vsdlib.idle import IdleManager
+from vsdlib.bindings import bind, Source, CommandSource, FileSource
+from vsdlib.journal import Journal, KeyRecorder, replay
+from vsdlib.scripts import ScriptPool
+from vsdlib.state import StateFile
 
 NO_LOG_FILE = 1
 
@@ -26,6 +40,14 @@ class VSDLibNamespace(argparse.Namespace):
     positions: bool
     log_level: str = 'INFO'
     log_file: Optional[str]
+    max_key_bytes: Optional[int] = None
+    bundle: Optional[str] = None
+    device_process: bool = False
+    socket: Optional[str] = None
+    metrics_port: Optional[int] = None
+    idle_timeout: Optional[float] = None
+    idle_brightness: int = 0
+    record: Optional[str] = None
 
 
 def list_log_levels():
@@ -44,6 +66,14 @@ def parse_args() -> VSDLibNamespace:
     parser.add_argument('--positions', default=False, action='store_true', help='use the demo "positions" board')
     parser.add_argument('--log-level', default=VSDLibNamespace.log_level, help=f"log level. default: %(default)s; options: {list_log_levels()}")
     parser.add_argument('--log-file', default=NO_LOG_FILE, nargs='?', help=f"log file. if specified without a filename, '{default_log_file}' will be appended to.")
+    parser.add_argument('--max-key-bytes', type=int, default=VSDLibNamespace.max_key_bytes, help="lower JPEG quality until each key image fits in this many bytes. see `python -m vsdlib.bench`")
+    parser.add_argument('--bundle', default=VSDLibNamespace.bundle, help="pre-rendered key images from `vsdlib compile`; keys not in it are rendered as usual")
+    parser.add_argument('--device-process', default=VSDLibNamespace.device_process, action='store_true', help="talk to the stream deck from a separate process, so key presses are read even while this one is busy")
+    parser.add_argument('--socket', nargs='?', const=default_socket_path(), default=VSDLibNamespace.socket, help=f"let other programs update named buttons through this unix socket. if specified without a path, '{default_socket_path()}' is used")
+    parser.add_argument('--metrics-port', type=int, default=VSDLibNamespace.metrics_port, help="serve render/write/handler metrics in prometheus format at http://127.0.0.1:PORT/metrics. they're also dumped to stderr on SIGUSR1")
+    parser.add_argument('--idle-timeout', type=float, default=VSDLibNamespace.idle_timeout, help="after this many seconds without a key press, dim the deck and stop redrawing it until the next press")
+    parser.add_argument('--idle-brightness', type=int, default=VSDLibNamespace.idle_brightness, help="brightness while idle. default: %(default)s")
+    parser.add_argument('--record', default=VSDLibNamespace.record, help="write every key event (and the page it happened on) to this file, for `vsdlib replay`")
     args = parser.parse_args(namespace=VSDLibNamespace())
     return args
 
@@ -56,10 +86,14 @@ class ButtonSchema(BaseModel):
     color: Optional[str] = None
     img: Optional[str] = None
     button_schema_classes: Optional[str] = None
+    # name of a [pages.<name>] table to switch to when pressed
+    page: Optional[str] = None
+    # lets `vsdlib --socket` clients update this button
+    name: Optional[str] = None
 
 
-#TODO:make a version that can start and interact with a separate thread that's listening for incoming connection requests
 class PythonScriptButtonSchema(ButtonSchema):
+    """runs script_path in a warm interpreter when pressed; see vsdlib/scripts.py"""
     script_path: str
 
 class PressButtonSchema(ButtonSchema):
@@ -67,21 +101,69 @@ class PressButtonSchema(ButtonSchema):
     delay: Optional[float] = None
 
 class ToggleButtonSchema(ButtonSchema):
+    """flips on or off with each press, and stays that way across restarts"""
+    # whether it starts out on, the first time
     toggle: bool = False
     toggle_true_img: Optional[str] = None
     toggle_false_img: Optional[str] = None
+    toggle_true_text: Optional[str] = None
+    toggle_true_color: Optional[str] = None
 
 class TogglePressButtonSchema(*[PressButtonSchema, ToggleButtonSchema]):
     pass
 
+class SourceButtonSchema(ButtonSchema):
+    """text that follows a command's output or a file's contents; buttons with the same source share its polls"""
+    command: Optional[str] = None
+    file: Optional[str] = None
+    interval: Optional[float] = None
+    # e.g. "CPU\n{value}"
+    text_format: str = '{value}'
+
 schema_name_to_schema = {
     'PythonScriptButtonSchema': PythonScriptButtonSchema,
     'PressButtonSchema': PressButtonSchema,
     'ToggleButtonSchema': ToggleButtonSchema,
     'TogglePressButtonSchema': TogglePressButtonSchema,
+    'SourceButtonSchema': SourceButtonSchema,
 }
 
 
+def create_toggle_button(
+    schema:ToggleButtonSchema, fn:Optional[Callable], kwargs:'Kwargs', colors:dict, position:str,
+    live:bool=True,
+) -> ToggleButton:
+    """
+    a ToggleButton with every look drawn already, remembered by name (or page and position if it has none).
+    without `live` it isn't remembered, so replaying presses doesn't overwrite the saved state
+    """
+    off_style = ButtonStyle(**kwargs)
+    if schema.toggle_false_img and exists(schema.toggle_false_img):
+        off_style = off_style.replace(image_path=schema.toggle_false_img)
+    on_style = off_style.replace(image_path=None, **TOGGLE_ON_COLORS)
+    if schema.toggle_true_color:
+        color = colors.get(schema.toggle_true_color, schema.toggle_true_color)
+        on_style = on_style.replace(background_color=color, pressed_background_color=color)
+    if schema.toggle_true_img and exists(schema.toggle_true_img):
+        on_style = on_style.replace(image_path=schema.toggle_true_img)
+    button = ToggleButton(
+        fn, schema.name, text=schema.text, on_text=schema.toggle_true_text,
+        style=off_style, on_style=on_style, on=schema.toggle,
+        state=StateFile.shared() if live else None, state_key=schema.name or position,
+    )
+    board = BoardLayout.board
+    button.prerender(board.rotation, board.encoder)
+    return button
+
+
+def create_source(schema:SourceButtonSchema) -> Optional[Source]:
+    if schema.command:
+        return CommandSource(schema.command, schema.interval or 5.0)
+    if schema.file:
+        return FileSource(schema.file, schema.interval or 1.0)
+    return None
+
+
 # In [15]: with con.pressed('2'):
 #     ...:     time.sleep(0.1)
 
@@ -105,30 +187,32 @@ def produce_positions_data(cols:int, rows:int) -> dict:
     return data
 
 
-async def main_helper(board:Board, args:VSDLibNamespace):
+def load_toml(toml_path:str) -> Tuple[str, dict]:
+    """returns the resolved path (bare names may refer to one of the bundled demos) and its data"""
+    this_dir = dirname(abspath(__file__))
+    demo_path = join(this_dir, 'demos', toml_path)
+    if exists(demo_path) and not exists(toml_path):
+        toml_path = demo_path
 
-    logger.debug(args)
-    logger.debug(args.toml_path)
-    layout = BoardLayout()
-    if args.positions:
-        data = produce_positions_data(BoardLayout.width, BoardLayout.height)
-
-    elif args.toml_path:
-        this_dir = dirname(abspath(__file__))
-        demo_path = join(this_dir, 'demos', args.toml_path)
-        if exists(demo_path) and not exists(args.toml_path):
-            args.toml_path = demo_path
-
-        with open(args.toml_path, 'rb') as fr:
-            # Read TOML and validate
-            data = tomllib.load(fr)
-    else:
-        logger.fatal("toml_path or --positions required")
-        exit(1)
+    with open(toml_path, 'rb') as fr:
+        # Read TOML and validate
+        data = tomllib.load(fr)
+    return toml_path, data
 
 
+def build_layout(
+    data:dict, colors:Optional[dict]=None, pages:Optional[LazyPages]=None,
+    page:str=LazyPages.HOME, live:bool=True,
+) -> Tuple[BoardLayout, bool]:
+    """
+    returns the layout and whether the data was valid. `page` is its name, for remembering toggles.
+    without `live` (compiling, replaying) buttons aren't bound to their sources, so no commands are polled,
+    and toggles neither read nor save their remembered state
+    """
+    layout = BoardLayout()
     col_to_row_data = normalize(data)
-    colors: dict = data.get('colors', {})
+    if colors is None:
+        colors = data.get('colors', {})
     valid = True
     logger.debug('BoardLayout.height %s', BoardLayout.height)
 
@@ -167,32 +251,295 @@ async def main_helper(board:Board, args:VSDLibNamespace):
                 kwargs['background_color'] = button_data.color
 
             button_fn = None
-            if button_schema_classes:
+            switches_page = False
+            source = None
+            script_path = None
+            toggle = None
+            if button_data.page is not None:
+                if pages is None or button_data.page not in pages.names:
+                    logger.error("button %s.%s links to page '%s', which doesn't exist", ck, rk, button_data.page)
+                    valid = False
+                else:
+                    button_fn = pages.create_link_callback(button_data.page)
+                    switches_page = True
+            elif button_schema_classes:
                 class ValidatorClass(*button_schema_classes):
                     pass
                 button_data_extra = ValidatorClass(**button_dict)
                 if isinstance(button_data_extra, PressButtonSchema):
                     button_fn = create_execute_shortcut_function(button_data_extra.key, button_data_extra.delay) if button_data_extra.key else None
-
-            button = Button(
-                fn=button_fn, name=None, text=button_data.text,
-                style=ButtonStyle(
-                    **kwargs,
-                    # background_color,
-                    # text_color,
-                    # pressed_background_color,
-                    # image_path,
-                ),
-            )
+                if isinstance(button_data_extra, ToggleButtonSchema):
+                    toggle = button_data_extra
+                    for img in (toggle.toggle_true_img, toggle.toggle_false_img):
+                        if img and not os.path.exists(img):
+                            logger.error("toggle image was provided but doesn't exist: '%s'", img)
+                            valid = False
+                if isinstance(button_data_extra, PythonScriptButtonSchema):
+                    script_path = button_data_extra.script_path
+                    if not os.path.exists(os.path.expanduser(script_path)):
+                        logger.error("button %s.%s runs '%s', which doesn't exist", ck, rk, script_path)
+                        valid = False
+                if isinstance(button_data_extra, SourceButtonSchema):
+                    source = create_source(button_data_extra)
+                    text_format = button_data_extra.text_format
+                    if source is None:
+                        logger.error("button %s.%s is a SourceButtonSchema without a command or file", ck, rk)
+                        valid = False
+
+            if toggle is not None:
+                button = create_toggle_button(toggle, button_fn, kwargs, colors, f'{page}/{ck}.{rk}', live)
+            else:
+                button = Button(
+                    fn=button_fn, name=button_data.name, text=button_data.text,
+                    button_switches_page=switches_page,
+                    style=ButtonStyle(
+                        **kwargs,
+                        # background_color,
+                        # text_color,
+                        # pressed_background_color,
+                        # image_path,
+                    ),
+                )
+            if source is not None and live:
+                bind(button, source, text=text_format)
+            if script_path is not None:
+                # the function needs the button to update, so it's set once the button exists
+                button.set(fn=ScriptPool.create_shared_press_callback(button, script_path))
             layout.set(button, col_num, row_num)
 
+    return layout, valid
+
+
+def create_pages(board:Board, data:dict, live:bool=True) -> Tuple[LazyPages, bool]:
+    """
+    the top-level cN.rM keys make up the home page, which is built right away.
+    each [pages.<name>] table (with its own cN.rM keys) is built the first time it's shown.
+
+        [settings]
+        page_cache_size = 8  # built pages kept in memory
+
+        [pages.media]
+        back = true          # put a back button on key 0 unless it's used (default true)
+        back_text = "< Back"
+    """
+    pages_data: Dict[str, dict] = data.get('pages', {})
+    settings: dict = data.get('settings', {})
+    colors: dict = data.get('colors', {})
+
+    def build_page(name:str) -> BoardLayout:
+        page_data = pages_data[name]
+        layout, valid = build_layout(page_data, colors, pages, name, live)
+        if not valid:
+            logger.error("page '%s' has errors; showing what could be built", name)
+        if page_data.get('back', True) and 0 not in layout.positions:
+            layout.set(pages.create_back_button(name, page_data.get('back_text', '< Back')), 0)
+        return layout
+
+    pages = LazyPages(board, build_page, pages_data.keys(), settings.get('page_cache_size'))
+    home, valid = build_layout(data, colors, pages, live=live)
+    pages.add(LazyPages.HOME, home)
+    return pages, valid
+
+
+def uses_scripts(data:dict) -> bool:
+    """whether any key, on the home page or any other, runs a python script"""
+    for page_data in [data, *data.get('pages', {}).values()]:
+        for col in normalize(page_data).values():
+            for button_dict in col.values():
+                if 'PythonScriptButtonSchema' in (button_dict.get('button_schema_classes') or ''):
+                    return True
+    return False
+
+
+async def main_helper(board:Board, args:VSDLibNamespace):
+
+    logger.debug(args)
+    logger.debug(args.toml_path)
+    if args.positions:
+        data = produce_positions_data(BoardLayout.width, BoardLayout.height)
+
+    elif args.toml_path:
+        args.toml_path, data = load_toml(args.toml_path)
+    else:
+        logger.fatal("toml_path or --positions required")
+        exit(1)
+
+    pages, valid = create_pages(board, data)
+
     if not valid:
         print("toml file validation failed; please fix errors")
         exit(1)
 
-    layout.apply(board)
-    while not board.shutdown:
-        await asyncio.sleep(1.2)
+    if uses_scripts(data):
+        # start the workers now, off the loop, so the first script press doesn't pay for it
+        threading.Thread(target=lambda: ScriptPool.shared().warm_up(), name='vsdlib-script-warm-up', daemon=True).start()
+
+    if args.bundle:
+        bundle = board.load_bundle(args.bundle)
+        logger.info("loaded %s pre-rendered key images from '%s'", len(bundle), args.bundle)
+
+    pages.show(LazyPages.HOME)
+
+    recorder = None
+    if args.record:
+        recorder = KeyRecorder(board, args.record, pages, abspath(args.toml_path) if args.toml_path else None)
+        recorder.start()
+
+    daemon = None
+    if args.socket:
+        daemon = Daemon(board, args.socket, pages)
+        try:
+            await daemon.start()
+        except OSError as e:
+            logger.fatal("couldn't serve the socket API: %s", e)
+            exit(1)
+
+    try:
+        while not board.shutdown:
+            await asyncio.sleep(1.2)
+    finally:
+        if daemon is not None:
+            await daemon.stop()
+        if recorder is not None:
+            recorder.stop()
+
+
+class CompileNamespace(argparse.Namespace):
+    toml_path: str
+    output: Optional[str]
+    deck: str = 'StreamDeckXL'
+    rotation: List[int]
+    max_key_bytes: Optional[int] = None
+
+
+def parse_compile_args(argv:List[str]) -> CompileNamespace:
+    parser = argparse.ArgumentParser(prog='vsdlib compile', description="pre-render every key of a toml layout into a bundle file for `vsdlib --bundle`")
+    parser.add_argument('toml_path', help='the toml file to render')
+    parser.add_argument('-o', '--output', help="bundle file to write. default: the toml path with a .vsdb extension")
+    parser.add_argument('--deck', default=CompileNamespace.deck, help="StreamDeck device class to render for. default: %(default)s")
+    parser.add_argument('--rotation', type=int, action='append', default=[], help="board rotation(s) in use (repeatable). default: 0")
+    parser.add_argument('--max-key-bytes', type=int, default=CompileNamespace.max_key_bytes, help="must match the --max-key-bytes the deck runs with")
+    return parser.parse_args(argv, namespace=CompileNamespace())
+
+
+class StandInDevice(Dummy.Device):
+    """
+    The library's dummy transport, minus its logging of every report.
+    Takes `report_seconds` per report written, to stand in for the USB link.
+    """
+    def __init__(self, report_seconds:float=0):
+        super().__init__(vid=0, pid=0)
+        self.report_seconds = report_seconds
+        self.is_open = True
+
+    def write_feature(self, payload):
+        return True
+
+    def read_feature(self, report_id, length):
+        return bytearray(length)
+
+    def write(self, payload):
+        if self.report_seconds:
+            time.sleep(self.report_seconds)
+        return True
+
+    def read(self, length):
+        return None
+
+
+def create_offline_board(deck_name:str, link_bytes_per_second:Optional[int]=None) -> Board:
+    """a Board for the given device class, backed by a stand-in device instead of hardware"""
+    deck_class = getattr(importlib.import_module(f'StreamDeck.Devices.{deck_name}'), deck_name)
+    report_length = getattr(deck_class, 'IMAGE_REPORT_LENGTH', 1024)
+    report_seconds = report_length / link_bytes_per_second if link_bytes_per_second else 0
+    sd = deck_class(StandInDevice(report_seconds))
+    return Board(sd, DeviceManager(transport='dummy'))
+
+
+def compile_layout(args:CompileNamespace) -> int:
+    toml_path, data = load_toml(args.toml_path)
+    output = args.output or os.path.splitext(toml_path)[0] + '.vsdb'
+    rotations = args.rotation or [0]
+
+    board = create_offline_board(args.deck)
+    try:
+        board.encoder.set_max_bytes(args.max_key_bytes)
+        pages, valid = create_pages(board, data, live=False)
+        if not valid:
+            print("toml file validation failed; please fix errors")
+            return 1
+
+        buttons = [blank_button]
+        for name in sorted(pages.names):
+            # every page, built directly so they don't go through (and get dropped from) the page cache
+            layout = pages.layouts[name] if name == LazyPages.HOME else pages.build(name)
+            buttons.extend(layout.positions.values())
+
+        payloads: Dict[str, bytes] = dict()
+        for button in buttons:
+            for rotation in rotations:
+                for pressed in (False, True):
+                    render_key = button.render_key(rotation, board.encoder, pressed)
+                    if render_key not in payloads:
+                        payloads[render_key] = button.draw(rotation, board.encoder, pressed)
+    finally:
+        board.writer.close()
+
+    keys, unique = RenderBundle.write(output, payloads)
+    logger.info("wrote %s key images (%s unique) to '%s'", keys, unique, output)
+    return 0
+
+
+class ReplayNamespace(argparse.Namespace):
+    journal_path: str
+    toml_path: Optional[str] = None
+    deck: Optional[str] = None
+    speed: Optional[float] = None
+    no_actions: bool = False
+    link_bytes_per_second: Optional[int] = None
+    max_key_bytes: Optional[int] = None
+    bundle: Optional[str] = None
+
+
+def parse_replay_args(argv:List[str]) -> ReplayNamespace:
+    parser = argparse.ArgumentParser(prog='vsdlib replay', description="play key events recorded with `vsdlib --record` into a stand-in deck and report how long each took to show")
+    parser.add_argument('journal_path', help='the file written by --record')
+    parser.add_argument('toml_path', nargs='?', help="the toml file to build the layout from. default: the one that was recorded with (or the positions demo)")
+    parser.add_argument('--deck', help="StreamDeck device class to stand in for. default: the one that was recorded with")
+    parser.add_argument('--speed', type=float, help="replay at this multiple of the recorded pace (1 is real time). default: as fast as possible")
+    parser.add_argument('--no-actions', default=ReplayNamespace.no_actions, action='store_true', help="don't run the buttons' functions (no typing or commands); just press and release them and follow the recorded pages")
+    parser.add_argument('--link-bytes-per-second', type=int, help="make the stand-in deck take as long as a link this fast to write each key. default: instant. see `python -m vsdlib.bench`")
+    parser.add_argument('--max-key-bytes', type=int, default=ReplayNamespace.max_key_bytes, help="as for vsdlib")
+    parser.add_argument('--bundle', default=ReplayNamespace.bundle, help="as for vsdlib")
+    return parser.parse_args(argv, namespace=ReplayNamespace())
+
+
+def replay_journal(args:ReplayNamespace) -> int:
+    journal = Journal.read(args.journal_path)
+    header = journal.header
+    toml_path = args.toml_path or header.get('toml_path')
+    if toml_path:
+        toml_path, data = load_toml(toml_path)
+    board = create_offline_board(args.deck or header['deck'], args.link_bytes_per_second)
+    if not toml_path:
+        data = produce_positions_data(BoardLayout.width, BoardLayout.height)
+    try:
+        board.encoder.set_max_bytes(args.max_key_bytes)
+        if args.bundle:
+            board.load_bundle(args.bundle)
+        pages, valid = create_pages(board, data, live=False)
+        if not valid:
+            print("toml file validation failed; please fix errors")
+            return 1
+        pages.show(header.get('page') or LazyPages.HOME)
+        board.writer.flush()
+        report = board.loop.run_until_complete(replay(board, journal, pages, args.speed, not args.no_actions))
+    finally:
+        if ScriptPool._shared is not None:
+            ScriptPool._shared.close()
+        board.writer.close()
+    print(report.format())
+    return 0
 
 
 this_file = abspath(__file__)
@@ -205,6 +552,16 @@ log_formatter = logging.Formatter(log_format)
 
 
 def main():
+    if sys.argv[1:2] == ['compile']:
+        logging.basicConfig(level=logging.INFO, format=log_format)
+        logger.setLevel(logging.INFO)
+        exit(compile_layout(parse_compile_args(sys.argv[2:])))
+    if sys.argv[1:2] == ['replay']:
+        logging.basicConfig(level=logging.WARNING, format=log_format)
+        # the report is what matters; not every write and render
+        logging.getLogger().setLevel(logging.WARNING)
+        exit(replay_journal(parse_replay_args(sys.argv[2:])))
+
     args = parse_args()
     log_level = getattr(logging, args.log_level.upper())
     logger.setLevel(level=log_level)
@@ -231,14 +588,43 @@ def main():
         logger.addHandler(file_handler)
         logger.info("finished setting up log file for logging: '%s'", log_file_path)
 
-    board = Board()
+    if args.device_process:
+        from vsdlib.device_process import RemoteStreamDeck
+        board = Board(RemoteStreamDeck())
+        board.sd.set_brightness(board.brightness)
+    else:
+        board = Board()
+    board.encoder.set_max_bytes(args.max_key_bytes)
     BoardLayout.initialize(board)
+    metrics.install_dump_signal()
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = metrics.serve_metrics(args.metrics_port)
+    supervisor = None
+    if not args.device_process:
+        # reconnect (and redraw) if the deck is unplugged or the usb hub resets
+        supervisor = DeviceSupervisor(board)
+        supervisor.start()
+    idle = None
+    if args.idle_timeout:
+        idle = IdleManager(board, args.idle_timeout, args.idle_brightness)
+        idle.start()
     try:
         loop = asyncio.get_event_loop()
         init_ok = loop.run_until_complete(main_helper(board, args))
         if init_ok:
             loop.run_forever()
     finally:
+        if supervisor is not None:
+            supervisor.stop()
+        if idle is not None:
+            idle.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if ScriptPool._shared is not None:
+            ScriptPool._shared.close()
+        if StateFile._shared is not None:
+            StateFile._shared.close()
         board.close()
 
 if __name__ == '__main__':
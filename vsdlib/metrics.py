@@ -0,0 +1,197 @@
+"""
+Counters and histograms for a running deck, in Prometheus text format.
+
+    vsdlib layout.toml --metrics-port 9310
+    curl -s localhost:9310/metrics
+    kill -USR1 <pid>     # dumps the same text to stderr
+
+Metrics are recorded all the time (an observation is a lock and a few
+additions); the endpoint only formats what's already there.
+"""
+import sys
+import bisect
+import signal
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, TextIO, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+BYTES_BUCKETS = (256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536)
+
+
+def escape_label_value(value:str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names:Sequence[str], values:Sequence[str], extra:str='') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type_name: str
+
+    def __init__(self, name:str, help:str, labels:Sequence[str]=(), registry:Optional['Registry']=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        (registry or default_registry).register(self)
+
+    def label_values(self, labels:Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type_name}']
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, amount:float=1, **labels:str):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels:str) -> float:
+        return self.values.get(self.label_values(labels), 0)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [
+            f'{self.name}{format_labels(self.label_names, key)} {value:g}'
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, *args, buckets:Sequence[float]=SECONDS_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: per-bucket counts (not cumulative; +Inf last), sum
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value:float, **labels:str):
+        key = self.label_values(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1][0] += value
+
+    def count(self, **labels:str) -> int:
+        entry = self.values.get(self.label_values(labels))
+        return 0 if entry is None else sum(entry[0])
+
+    def total(self, **labels:str) -> float:
+        entry = self.values.get(self.label_values(labels))
+        return 0.0 if entry is None else entry[1][0]
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self.values.items())
+        lines = self.header()
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound:g}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {total:g}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    metrics: List[Metric]
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric:Metric):
+        with self.lock:
+            if any(m.name == metric.name for m in self.metrics):
+                raise ValueError(f"a metric named '{metric.name}' is already registered")
+            self.metrics.append(metric)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = Registry()
+
+renders = Counter('vsdlib_renders_total', 'key images drawn, by kind of image', ['kind'])
+render_seconds = Histogram('vsdlib_render_seconds', 'time to draw and encode one key image', ['kind'])
+render_cache = Counter('vsdlib_render_cache_total', 'where key images came from: the payload cache, a bundle, or drawn', ['result'])
+key_write_bytes = Histogram('vsdlib_key_write_bytes', 'payload size of each key image sent to the device', buckets=BYTES_BUCKETS)
+key_write_seconds = Histogram('vsdlib_key_write_seconds', 'time spent in StreamDeck.set_key_image')
+key_write_errors = Counter('vsdlib_key_write_errors_total', 'key image writes that failed')
+handler_seconds = Histogram('vsdlib_handler_seconds', 'time spent in a button\'s function, by button name (or key)', ['button'])
+key_hold_seconds = Histogram('vsdlib_key_hold_seconds', 'how long keys are held down')
+page_switch_seconds = Histogram('vsdlib_page_switch_seconds', 'time to apply a layout to the board (render and queue every key)')
+script_seconds = Histogram('vsdlib_script_seconds', 'time to run a script button\'s script in a worker, by outcome (ok, error, timeout)', ['result'])
+source_polls = Counter('vsdlib_source_polls_total', 'polls of bound sources (shared by every binding to the same source), by kind of source', ['kind'])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = default_registry
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics request: " + format, *args)
+
+
+def serve_metrics(port:int, host:str='127.0.0.1', registry:Registry=default_registry) -> ThreadingHTTPServer:
+    """serve `registry` at http://host:port/metrics from a background thread. localhost only by default"""
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='vsdlib-metrics').start()
+    logger.info("serving metrics on http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+
+def install_dump_signal(signum:int=signal.SIGUSR1, stream:TextIO=sys.stderr, registry:Registry=default_registry):
+    """dump `registry` to `stream` whenever the process gets `signum`. must be called from the main thread"""
+    def render_and_write():
+        stream.write(registry.render())
+        stream.flush()
+
+    def dump(signum, frame):
+        # the handler runs on the main thread, which may be inside a metric's lock right now;
+        # rendering takes those locks, so leave it to a thread that can wait for them
+        threading.Thread(target=render_and_write, daemon=True, name='vsdlib-metrics-dump').start()
+    signal.signal(signum, dump)
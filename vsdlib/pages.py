@@ -0,0 +1,115 @@
+import threading
+import logging
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from .board import Board, BoardLayout
+from .buttons import Button, recolor_buttons
+from .button_style import ButtonStyle
+
+
+logger = logging.getLogger(__name__)
+
+
+class LazyPages:
+    """
+    Named pages that are only built the first time they're shown.
+
+    At most `max_pages` built pages are kept; past that, the least recently
+    shown ones are dropped and rebuilt if they're visited again. The home page
+    and the page currently showing are never dropped.
+
+    Back buttons go back by page name rather than holding on to the previous
+    layout (which is what BoardLayout.sublayout's return button does), so a
+    dropped page really is freed.
+    """
+    HOME = 'home'
+    max_pages: int = 8
+    layouts: 'OrderedDict[str, BoardLayout]'
+    parents: Dict[str, str]
+    names: Set[str]
+    current: Optional[str]
+    colors: Dict[str, str]
+
+    def __init__(
+        self, board:Board, build:Callable[[str], BoardLayout],
+        names:Iterable[str], max_pages:Optional[int]=None,
+    ):
+        self.board = board
+        self.build = build
+        self.names = set(names) | {self.HOME}
+        if max_pages is not None:
+            self.max_pages = max_pages
+        self.layouts = OrderedDict()
+        self.parents = dict()
+        self.current = None
+        # every recolor so far, folded together, for pages built from now on
+        self.colors = dict()
+        self.lock = threading.RLock()
+
+    def add(self, name:str, layout:BoardLayout):
+        """use an already built layout for `name`"""
+        with self.lock:
+            self.names.add(name)
+            self.layouts[name] = layout
+
+    def get(self, name:str) -> BoardLayout:
+        with self.lock:
+            layout = self.layouts.get(name)
+            if layout is None:
+                if name not in self.names:
+                    raise KeyError(f"no page named '{name}'")
+                logger.debug("building page '%s'", name)
+                layout = self.layouts[name] = self.build(name)
+                if self.colors:
+                    recolor_buttons(layout.positions.values(), self.colors)
+            self.layouts.move_to_end(name)
+            self.evict()
+            return layout
+
+    def evict(self):
+        with self.lock:
+            while len(self.layouts) > self.max_pages:
+                for name in self.layouts:
+                    if name not in (self.HOME, self.current):
+                        logger.debug("dropping page '%s'", name)
+                        del self.layouts[name]
+                        break
+                else:
+                    return
+
+    def recolor(self, colors:Dict[str, str]) -> int:
+        """recolor every built page now (see Board.recolor), and pages that are built later as they're built"""
+        with self.lock:
+            folded = {original: colors.get(color, color) for original, color in self.colors.items()}
+            for color, replacement in colors.items():
+                folded.setdefault(color, replacement)
+            self.colors = folded
+            layouts = list(self.layouts.values())
+        return self.board.recolor(colors, layouts)
+
+    def show(self, name:str, remember_parent:bool=True):
+        with self.lock:
+            if remember_parent and name not in (self.current, self.HOME) and self.current is not None:
+                self.parents[name] = self.current
+            # set before building so the page being shown can't be the one evicted
+            self.current = name
+            layout = self.get(name)
+        layout.apply(self.board)
+
+    def back(self, name:str):
+        self.show(self.parents.get(name, self.HOME), remember_parent=False)
+
+    def create_link_callback(self, name:str):
+        def show_page(pressed:bool):
+            if not pressed:
+                return
+            self.show(name)
+        return show_page
+
+    def create_back_button(self, name:str, text:str='< Back', style:ButtonStyle=ButtonStyle()) -> Button:
+        def go_back(pressed:bool):
+            if not pressed:
+                return
+            self.back(name)
+        return Button(go_back, text=text, style=style, button_switches_page=True)
@@ -0,0 +1,258 @@
+"""
+Python script buttons, run in a pool of already-started interpreters.
+
+    [c3.r0]
+    text = "backup"
+    button_schema_classes = "PythonScriptButtonSchema"
+    script_path = "~/bin/deck/backup.py"
+
+Starting `python script.py` for every press would spend most of the press
+starting an interpreter. Instead a few worker processes are started up front,
+with commonly used modules already imported, and each press runs the script
+in one of them. A worker compiles each script once and only reads it again
+when its mtime changes, so a press costs a pipe round trip and the script
+itself.
+
+A script sees `pressed` (always True; scripts run on press), `name` and
+`text` (the button's). To change the button, it sets `result` to the new
+text or to a dict of fields:
+
+    result = {'text': 'backup\\nok', 'background_color': '#2C1'}
+
+A script that runs longer than the pool's timeout has its worker killed (and
+replaced); the button is left as it was.
+"""
+import os
+import sys
+import queue
+import weakref
+import threading
+import traceback
+import importlib
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .buttons import Button, apply_update, UPDATE_FIELDS
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# imported by every worker before it takes any script
+DEFAULT_PRELOAD = ('os', 're', 'json', 'time', 'datetime', 'pathlib', 'shutil', 'subprocess', 'urllib.request')
+
+
+class ScriptError(Exception):
+    pass
+
+
+def run_script_worker(conn, preload:Sequence[str]):
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"vsdlib script worker: couldn't preload {module}: {e}", file=sys.stderr)
+    # path -> (mtime_ns, size, code)
+    code_cache: Dict[str, Tuple[int, int, Any]] = dict()
+    conn.send(('ready',))
+    while True:
+        try:
+            path, variables = conn.recv()
+        except (EOFError, OSError):
+            # the main process went away
+            return
+        try:
+            stat = os.stat(path)
+            cached = code_cache.get(path)
+            if cached is None or cached[:2] != (stat.st_mtime_ns, stat.st_size):
+                with open(path, 'rb') as fr:
+                    cached = code_cache[path] = (stat.st_mtime_ns, stat.st_size, compile(fr.read(), path, 'exec'))
+            namespace = {'__name__': '__main__', '__file__': path, **variables}
+            exec(cached[2], namespace)
+            conn.send(('ok', namespace.get('result')))
+        except BaseException:
+            conn.send(('error', traceback.format_exc()))
+
+
+class ScriptWorker:
+    def __init__(self, ctx, preload:Sequence[str]):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=run_script_worker, name='vsdlib-script', daemon=True,
+            args=(child_conn, tuple(preload)),
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self, timeout:float):
+        if self.ready:
+            return
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"script worker didn't start within {timeout} seconds")
+        self.conn.recv()
+        self.ready = True
+
+    def run(self, path:str, variables:Dict[str, Any], timeout:float) -> Any:
+        self.conn.send((path, variables))
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"'{path}' didn't finish within {timeout} seconds")
+        status, value = self.conn.recv()
+        if status == 'error':
+            raise ScriptError(value)
+        return value
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+
+def result_fields(result:Any) -> Optional[Dict[str, Any]]:
+    """a script's `result` as button fields"""
+    if result is None:
+        return None
+    if isinstance(result, str):
+        return {'text': result}
+    if not isinstance(result, dict):
+        raise ScriptError(f"result must be a str or a dict, not {type(result).__name__}")
+    unknown = set(result) - set(UPDATE_FIELDS)
+    if unknown:
+        raise ScriptError(f"can't set {sorted(unknown)}; fields are {list(UPDATE_FIELDS)}")
+    return result
+
+
+class ScriptPool:
+    """
+    `workers` interpreters (see the module docstring). Presses are handed to
+    a thread per worker, so a slow script never holds up key handling, and a
+    press while every worker is busy waits for the next free one.
+    """
+    _shared: Optional['ScriptPool'] = None
+    _shared_lock = threading.Lock()
+    idle: 'queue.Queue[ScriptWorker]'
+    workers: List[ScriptWorker]
+
+    def __init__(
+        self, workers:int=2, timeout:float=10.0,
+        preload:Sequence[str]=DEFAULT_PRELOAD, start_timeout:float=30.0,
+    ):
+        self.ctx = multiprocessing.get_context('spawn')
+        self.timeout = timeout
+        self.preload = tuple(preload)
+        self.start_timeout = start_timeout
+        self.idle = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.closed = False
+        for _ in range(workers):
+            self._add_worker()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='vsdlib-script')
+
+    @classmethod
+    def shared(cls) -> 'ScriptPool':
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _add_worker(self):
+        worker = ScriptWorker(self.ctx, self.preload)
+        with self.lock:
+            self.workers.append(worker)
+        self.idle.put(worker)
+
+    def _replace(self, worker:ScriptWorker):
+        worker.kill()
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            if self.closed:
+                return
+        self._add_worker()
+
+    def warm_up(self):
+        """wait until every worker has started and preloaded, so no press waits for it"""
+        with self.lock:
+            count = len(self.workers)
+        for _ in range(count):
+            worker = self.idle.get()
+            try:
+                worker.wait_ready(self.start_timeout)
+            except (TimeoutError, EOFError, OSError) as e:
+                logger.warning("script worker failed to start: %s", e)
+                self._replace(worker)
+                continue
+            self.idle.put(worker)
+
+    def run(self, path:str, timeout:Optional[float]=None, **variables) -> Any:
+        """run the script at `path` in a free worker and return its `result`"""
+        timeout = self.timeout if timeout is None else timeout
+        worker = self.idle.get()
+        start = perf_counter()
+        try:
+            worker.wait_ready(self.start_timeout)
+            result = worker.run(os.path.abspath(os.path.expanduser(path)), variables, timeout)
+        except ScriptError:
+            metrics.script_seconds.observe(perf_counter() - start, result='error')
+            self.idle.put(worker)
+            raise
+        except (TimeoutError, EOFError, OSError):
+            # stuck in the script or gone; it can't be trusted with the next one
+            metrics.script_seconds.observe(perf_counter() - start, result='timeout')
+            self._replace(worker)
+            raise
+        metrics.script_seconds.observe(perf_counter() - start, result='ok')
+        self.idle.put(worker)
+        return result
+
+    def press(self, button:Button, path:str):
+        """run the script for a press of `button` (in the background) and update it with the result"""
+        button_ref = weakref.ref(button)
+        name, text = button.name, button.text
+
+        def run_and_apply():
+            try:
+                fields = result_fields(self.run(path, pressed=True, name=name, text=text))
+            except Exception as e:
+                logger.warning("script '%s' failed: %s", path, e)
+                return
+            button = button_ref()
+            if fields and button is not None:
+                apply_update(button, fields)
+
+        self.executor.submit(run_and_apply)
+
+    def create_press_callback(self, button:Button, path:str):
+        button_ref = weakref.ref(button)
+
+        def run_script(pressed:bool):
+            button = button_ref()
+            if not pressed or button is None:
+                return
+            self.press(button, path)
+        return run_script
+
+    @classmethod
+    def create_shared_press_callback(cls, button:Button, path:str):
+        """like create_press_callback, on the shared pool, which is started on the first press if it isn't running yet"""
+        button_ref = weakref.ref(button)
+
+        def run_script(pressed:bool):
+            button = button_ref()
+            if not pressed or button is None:
+                return
+            cls.shared().press(button, path)
+        return run_script
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            workers = list(self.workers)
+            self.workers = []
+        self.executor.shutdown(wait=False)
+        for worker in workers:
+            worker.kill()
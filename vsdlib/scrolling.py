@@ -0,0 +1,191 @@
+import threading
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Any
+
+from .board import Board, BoardLayout
+from .buttons import Button
+from .button_style import ButtonStyle
+from .colors import grays
+
+
+logger = logging.getLogger(__name__)
+
+
+class ScrollingListLayout(BoardLayout):
+    """
+    Shows an indexable data source of any length a window of keys at a time,
+    with prev/next keys to scroll by a window.
+
+    Only the items in view have buttons: `source[i]` and `make_button` are
+    called for the visible window, and buttons that scroll out of view are
+    dropped. After each scroll the windows on either side are built and
+    rendered into the encoder's cache from a background thread, so the next
+    scroll only has to send images.
+
+    `source` only needs `len()` and integer indexing, so it can be a list or
+    something that loads rows on demand. Keys set with `set` (e.g. a back
+    button) are taken out of the window.
+    """
+    source: Sequence
+    make_button: Callable[[Any, int], Button]
+    keys: List[int]
+    offset: int
+    window_buttons: Dict[int, Button]
+    prefetch_idle_seconds: float = 10
+
+    def __init__(
+        self, source:Sequence,
+        make_button:Optional[Callable[[Any, int], Button]]=None,
+        keys:Optional[Iterable[int]]=None,
+        prev_key:Optional[int]=None, next_key:Optional[int]=None,
+        style:ButtonStyle=ButtonStyle(), nav_style:ButtonStyle=ButtonStyle(**grays),
+        prefetch:bool=True,
+    ):
+        super().__init__()
+        self.source = source
+        self.style = style
+        self.make_button = make_button or self.default_make_button
+        self.prev_key = self.key_count - self.width if prev_key is None else prev_key
+        self.next_key = self.key_count - 1 if next_key is None else next_key
+        if keys is None:
+            keys = range(self.key_count)
+        self.keys = [k for k in keys if k not in (self.prev_key, self.next_key)]
+        self.offset = 0
+        self.window_buttons = dict()
+        self.lock = threading.RLock()
+
+        self.prev_button = Button(self.create_scroll_callback(-1), text='<', style=nav_style, button_switches_page=True)
+        self.next_button = Button(self.create_scroll_callback(1), text='>', style=nav_style, button_switches_page=True)
+        super().set(self.prev_button, self.prev_key)
+        super().set(self.next_button, self.next_key)
+
+        self.prefetch = prefetch
+        self.prefetch_offsets: List[int] = []
+        self.prefetch_condition = threading.Condition(self.lock)
+        self.prefetch_thread: Optional[threading.Thread] = None
+
+        self.show_window()
+
+    def default_make_button(self, item, index:int) -> Button:
+        if isinstance(item, Button):
+            return item
+        return Button(text=str(item), style=self.style)
+
+    @property
+    def page_size(self) -> int:
+        return len(self.keys)
+
+    def set(self, button:Button, x, y=None):
+        index = self.calc_index(x, y)
+        with self.lock:
+            if index in self.keys:
+                self.keys.remove(index)
+            super().set(button, index)
+            self.show_window()
+
+    def clamp_offset(self, offset:int) -> int:
+        last_page = max(len(self.source) - 1, 0) // max(self.page_size, 1)
+        return min(max(offset, 0), last_page * self.page_size)
+
+    def get_item_button(self, index:int) -> Button:
+        """the button for `source[index]`, building it if it isn't already"""
+        with self.lock:
+            button = self.window_buttons.get(index)
+        if button is None:
+            button = self.make_button(self.source[index], index)
+            with self.lock:
+                button = self.window_buttons.setdefault(index, button)
+        return button
+
+    def scroll(self, pages:int):
+        with self.lock:
+            offset = self.clamp_offset(self.offset + pages * self.page_size)
+            if offset == self.offset:
+                return
+            self.offset = offset
+        self.show_window()
+
+    def scroll_to(self, index:int):
+        """scroll so that `source[index]` is in view"""
+        with self.lock:
+            self.offset = self.clamp_offset(index - index % max(self.page_size, 1))
+        self.show_window()
+
+    def invalidate(self):
+        """the source changed; rebuild the buttons in view"""
+        with self.lock:
+            self.window_buttons.clear()
+            self.offset = self.clamp_offset(self.offset)
+        self.show_window()
+
+    def show_window(self):
+        with self.lock:
+            self.offset = self.clamp_offset(self.offset)
+            count = len(self.source)
+            in_view = range(self.offset, min(self.offset + self.page_size, count))
+            # buttons of the windows on either side are kept for prefetching
+            keep = range(self.offset - self.page_size, self.offset + 2 * self.page_size)
+            for index in list(self.window_buttons):
+                if index not in keep:
+                    del self.window_buttons[index]
+
+            changed: List[int] = []
+            for key_offset, key in enumerate(self.keys):
+                index = self.offset + key_offset
+                if index in in_view:
+                    button = self.get_item_button(index)
+                    if self.positions.get(key) is not button:
+                        self.positions[key] = button
+                        changed.append(key)
+                elif key in self.positions:
+                    del self.positions[key]
+                    changed.append(key)
+
+            self.prefetch_offsets = [
+                offset for offset in (self.offset + self.page_size, self.offset - self.page_size)
+                if 0 <= offset < count
+            ]
+            self.prefetch_condition.notify_all()
+
+        if self.board.active_board_layout is self:
+            board = self.board
+            for key in changed:
+                board.slots[key].set_button(self.get(key), rotation=board.rotation)
+        self.start_prefetching()
+
+    def create_scroll_callback(self, pages:int):
+        def scroll(pressed:bool):
+            if not pressed:
+                return
+            self.scroll(pages)
+        return scroll
+
+    def start_prefetching(self):
+        with self.lock:
+            if not self.prefetch or self.prefetch_thread is not None:
+                return
+            self.prefetch_thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.prefetch_thread.start()
+
+    def _prefetch(self):
+        board: Board = self.board
+        while True:
+            with self.prefetch_condition:
+                # exit when idle so an unused layout doesn't keep a thread (and itself) alive
+                if not self.prefetch_condition.wait_for(lambda: self.prefetch_offsets, self.prefetch_idle_seconds):
+                    self.prefetch_thread = None
+                    return
+                offset = self.prefetch_offsets.pop(0)
+                # a scroll since this was queued may have moved the window past it
+                if abs(offset - self.offset) != self.page_size:
+                    continue
+            end = min(offset + self.page_size, len(self.source))
+            for index in range(offset, end):
+                with self.lock:
+                    if abs(offset - self.offset) != self.page_size:
+                        break
+                try:
+                    # rendering fills encoder.cache, so showing it later is a cache hit
+                    self.get_item_button(index).render(board.rotation, board.encoder)
+                except Exception as e:
+                    logger.exception(f"Failed to prefetch list item {index}; error: {e}")
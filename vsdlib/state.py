@@ -0,0 +1,89 @@
+"""
+A small JSON file of values that should outlive the process, like which
+toggle buttons were on.
+
+Changes are saved a moment later from a timer thread (so a burst of presses
+is one write, and nothing on the press path waits for the disk), by writing
+a new file and renaming it over the old one.
+"""
+import os
+import json
+import threading
+import logging
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_state_path() -> str:
+    state_dir = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(state_dir, 'vsdlib', 'state.json')
+
+
+class StateFile:
+    _shared: Optional['StateFile'] = None
+    values: Optional[Dict[str, Any]]
+
+    def __init__(self, path:Optional[str]=None, save_delay:float=1.0):
+        self.path = path or default_state_path()
+        self.save_delay = save_delay
+        self.values = None
+        self.timer: Optional[threading.Timer] = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> 'StateFile':
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def load(self) -> Dict[str, Any]:
+        if self.values is None:
+            try:
+                with open(self.path) as fr:
+                    self.values = json.load(fr)
+            except FileNotFoundError:
+                self.values = dict()
+            except (OSError, ValueError) as e:
+                logger.warning("couldn't read state file '%s', starting over; error: %s", self.path, e)
+                self.values = dict()
+        return self.values
+
+    def get(self, key:str, default:Any=None) -> Any:
+        with self.lock:
+            return self.load().get(key, default)
+
+    def set(self, key:str, value:Any):
+        with self.lock:
+            values = self.load()
+            if key in values and values[key] == value:
+                return
+            values[key] = value
+            if self.timer is None:
+                self.timer = threading.Timer(self.save_delay, self.save)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def save(self):
+        with self.lock:
+            self.timer = None
+            if self.values is None:
+                return
+            data = json.dumps(self.values, indent=1, sort_keys=True)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as fw:
+                fw.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("couldn't save state file '%s'; error: %s", self.path, e)
+
+    def close(self):
+        """save now if anything is waiting to be saved"""
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+            self.save()
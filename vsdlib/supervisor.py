@@ -0,0 +1,143 @@
+import time
+import threading
+import logging
+from typing import Optional
+
+from StreamDeck.DeviceManager import DeviceManager
+from StreamDeck.Devices.StreamDeck import StreamDeck
+
+from .board import Board
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceSupervisor:
+    """
+    Gets a Board going again after its deck is unplugged or the USB hub resets.
+
+    A disconnect is noticed either by a failed write (the KeyWriter reports it
+    straight away) or by polling every `poll_interval` seconds. Polling
+    enumerates the USB devices, so while the deck is asleep (see IdleManager)
+    it's only done every `idle_poll_interval` seconds. Writes are
+    paused and the deck is looked for again in the background, first every
+    `min_backoff` seconds and then less and less often, up to `max_backoff`.
+    The same deck (by serial number) is preferred; otherwise the first deck of
+    the same type. Once it's open again, brightness and the key callback are
+    restored and every key's last image is replayed from the writer's frames,
+    so nothing is re-rendered and the layout that was showing is back as it was.
+    """
+    def __init__(
+        self, board:Board, poll_interval:float=1.0, idle_poll_interval:float=60.0,
+        min_backoff:float=0.05, max_backoff:float=1.0,
+    ):
+        self.board = board
+        self.poll_interval = poll_interval
+        self.idle_poll_interval = idle_poll_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.deck_type = board.sd.deck_type()
+        self.serial = self.get_serial(board.sd)
+        self.dm = board.dm or DeviceManager()
+        self.disconnected = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def get_serial(sd:StreamDeck) -> Optional[str]:
+        try:
+            return sd.get_serial_number()
+        except Exception:
+            return None
+
+    def start(self):
+        self.board.writer.on_error = self.handle_write_error
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.disconnected.set()
+        self.board.writer.on_error = None
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def handle_write_error(self, e:Exception):
+        # called on the writer thread; pause right away so it doesn't keep retrying
+        if not self.disconnected.is_set():
+            logger.warning(f"Write to the stream deck failed, reconnecting; error: {e}")
+        self.board.writer.pause()
+        self.disconnected.set()
+
+    def is_connected(self, sd:StreamDeck) -> bool:
+        # a device that's still listed but whose handle went bad is caught by the writer instead
+        try:
+            return sd.connected()
+        except Exception:
+            return False
+
+    def _run(self):
+        while not self.stopped.is_set():
+            interval = self.poll_interval if self.board.awake.is_set() else self.idle_poll_interval
+            if not self.disconnected.wait(interval):
+                if self.is_connected(self.board.sd):
+                    continue
+                logger.warning("stream deck disconnected, reconnecting")
+                self.board.writer.pause()
+                self.disconnected.set()
+            if self.stopped.is_set():
+                return
+            self.reconnect()
+
+    def find_deck(self) -> Optional[StreamDeck]:
+        fallback = None
+        for sd in self.dm.enumerate():
+            if sd.deck_type() != self.deck_type:
+                continue
+            try:
+                sd.open()
+            except Exception:
+                continue
+            if self.serial is None or self.get_serial(sd) == self.serial:
+                if fallback is not None:
+                    fallback.close()
+                return sd
+            if fallback is None:
+                fallback = sd
+            else:
+                sd.close()
+        return fallback
+
+    def reconnect(self):
+        board = self.board
+        start = time.monotonic()
+        try:
+            board.sd.close()
+        except Exception:
+            pass
+
+        backoff = self.min_backoff
+        while not self.stopped.is_set():
+            try:
+                sd = self.find_deck()
+            except Exception as e:
+                logger.debug("enumerating stream decks failed: %s", e)
+                sd = None
+            if sd is not None:
+                break
+            self.stopped.wait(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+        else:
+            return
+
+        board.sd = sd
+        try:
+            idle = board.idle
+            sd.set_brightness(idle.idle_brightness if idle is not None and idle.asleep else board.brightness)
+        except Exception as e:
+            logger.exception(f"Failed to restore brightness; error: {e}")
+        sd.set_key_callback_async(board.handle_key_event, board.loop)
+        self.serial = self.get_serial(sd) or self.serial
+        self.disconnected.clear()
+        board.writer.resume(sd, replay=True)
+        logger.info("stream deck reconnected after %.2fs", time.monotonic() - start)
@@ -0,0 +1,401 @@
+"""
+CPU, memory, network and disk graphs for the deck.
+
+One SystemSource samples the machine for every monitor button: each tick is a
+single read of /proc/stat, /proc/meminfo, /proc/net/dev and /proc/diskstats,
+and the results go into fixed-size ring buffers. Graphs are drawn with NumPy
+straight into the key's pixel array (a whole sparkline is one comparison
+against a column of heights) and encoded with the cheap GRAPH policy. Most
+of a graph key's cost (about 0.15 ms a sample) is the JPEG encode, so a
+full 32-key deck of graphs at 2 Hz is about 1% of a core.
+
+    widget = SystemMonitorWidget(board)
+    layout.set(widget.cpu_button, 0)
+"""
+import os
+import time
+import logging
+import functools
+from typing import Callable, Dict, FrozenSet, Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage, ImageColor
+from PIL.ImageDraw import Draw
+
+from .buttons import Button, ButtonSlot
+from .button_style import ButtonStyle
+from .bindings import Binding, Source, SourceScheduler
+from .images import KeyImageEncoder, load_font, text_font_path, GRAPH as GRAPH_FRAME
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# samples kept per series; wider than any key, since each sample is one column of a graph
+HISTORY = 256
+
+# series SystemSource records, with their units
+SERIES = {
+    'cpu': '%',
+    'memory': '%',
+    'net_rx': 'B/s',
+    'net_tx': 'B/s',
+    'disk_read': 'B/s',
+    'disk_write': 'B/s',
+}
+
+
+class Ring:
+    """the last `capacity` samples of a series, in a preallocated array"""
+    __slots__ = ('values', 'count', 'head')
+
+    def __init__(self, capacity:int=HISTORY):
+        self.values = np.zeros(capacity, dtype=np.float32)
+        self.count = 0
+        self.head = 0
+
+    def push(self, value:float):
+        self.values[self.head] = value
+        self.head = (self.head + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def last(self, n:int) -> np.ndarray:
+        """up to `n` most recent samples, oldest first"""
+        n = min(n, self.count)
+        start = self.head - n
+        if start >= 0:
+            return self.values[start:self.head]
+        return np.concatenate((self.values[start:], self.values[:self.head]))
+
+    def latest(self) -> float:
+        return float(self.values[self.head - 1]) if self.count else 0.0
+
+
+class ProcFile:
+    """a /proc file kept open and re-read from the start with a single pread each time"""
+    __slots__ = ('fd',)
+
+    def __init__(self, path:str):
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self) -> bytes:
+        return os.pread(self.fd, 1 << 16, 0)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def whole_disks() -> FrozenSet[bytes]:
+    """block devices that aren't partitions or loop/ram devices, so diskstats isn't counted twice"""
+    try:
+        names = os.listdir('/sys/block')
+    except OSError:
+        return frozenset()
+    return frozenset(name.encode() for name in names if not name.startswith(('loop', 'ram', 'zram')))
+
+
+class SystemSource(Source):
+    """
+    Samples the machine every `interval` seconds into `rings` (see SERIES).
+    Its value is the number of samples taken, so it changes every tick. Only
+    sampled while a MonitorButton on it is showing; the /proc files are closed
+    in between.
+    """
+    rings: Dict[str, Ring]
+
+    def __new__(cls, interval:float=0.5):
+        return super().__new__(cls, interval)
+
+    @classmethod
+    def identity(cls, interval:float=0.5):
+        return (interval,)
+
+    def setup(self, interval:float=0.5):
+        self.interval = interval
+        self.rings = {name: Ring() for name in SERIES}
+        self.samples = 0
+        self.files: Optional[Dict[str, ProcFile]] = None
+        self.disks = whole_disks()
+        self.previous: Optional[Tuple[float, int, int, int, int, int, int]] = None
+
+    def open(self) -> Dict[str, ProcFile]:
+        if self.files is None:
+            self.files = {
+                name: ProcFile(f'/proc/{name}')
+                for name in ('stat', 'meminfo', 'net/dev', 'diskstats')
+            }
+        return self.files
+
+    def close(self):
+        if self.files is not None:
+            for proc_file in self.files.values():
+                proc_file.close()
+            self.files = None
+        # rates across the time nothing was showing would just be averages over the gap
+        self.previous = None
+
+    def read(self) -> int:
+        files = self.open()
+        now = time.monotonic()
+        cpu_busy, cpu_total = parse_cpu(files['stat'].read())
+        memory = parse_memory(files['meminfo'].read())
+        rx, tx = parse_net(files['net/dev'].read())
+        disk_read, disk_write = parse_disks(files['diskstats'].read(), self.disks)
+
+        counters = (now, cpu_busy, cpu_total, rx, tx, disk_read, disk_write)
+        previous, self.previous = self.previous, counters
+        if previous is None:
+            # rates need two samples
+            return self.samples
+        seconds = max(now - previous[0], 1e-6)
+        total = cpu_total - previous[2]
+        rings = self.rings
+        rings['cpu'].push(100 * (cpu_busy - previous[1]) / total if total > 0 else 0)
+        rings['memory'].push(memory)
+        rings['net_rx'].push((rx - previous[3]) / seconds)
+        rings['net_tx'].push((tx - previous[4]) / seconds)
+        rings['disk_read'].push((disk_read - previous[5]) / seconds)
+        rings['disk_write'].push((disk_write - previous[6]) / seconds)
+        self.samples += 1
+        return self.samples
+
+
+def parse_cpu(stat:bytes) -> Tuple[int, int]:
+    """busy and total jiffies across all cpus"""
+    fields = [int(v) for v in stat[:stat.index(b'\n')].split()[1:9]]
+    # idle and iowait
+    idle = fields[3] + fields[4]
+    total = sum(fields)
+    return total - idle, total
+
+
+def parse_memory(meminfo:bytes) -> float:
+    """percent of memory in use (not available)"""
+    total = available = 0
+    for line in meminfo.split(b'\n'):
+        if line.startswith(b'MemTotal:'):
+            total = int(line.split()[1])
+        elif line.startswith(b'MemAvailable:'):
+            available = int(line.split()[1])
+            break
+    return 100 * (total - available) / total if total else 0.0
+
+
+def parse_net(net_dev:bytes) -> Tuple[int, int]:
+    """bytes received and sent by every interface but loopback"""
+    rx = tx = 0
+    # two header lines
+    for line in net_dev.split(b'\n')[2:]:
+        name, _, counters = line.partition(b':')
+        if not counters or name.strip() == b'lo':
+            continue
+        fields = counters.split()
+        rx += int(fields[0])
+        tx += int(fields[8])
+    return rx, tx
+
+
+def parse_disks(diskstats:bytes, disks:FrozenSet[bytes]) -> Tuple[int, int]:
+    """bytes read and written by whole disks"""
+    read = written = 0
+    for line in diskstats.split(b'\n'):
+        fields = line.split()
+        if len(fields) < 10 or fields[2] not in disks:
+            continue
+        # sectors are always 512 bytes here, whatever the device's sector size
+        read += int(fields[5]) * 512
+        written += int(fields[9]) * 512
+    return read, written
+
+
+def format_rate(bytes_per_second:float) -> str:
+    for unit in ('', 'K', 'M', 'G'):
+        if bytes_per_second < 1000 or unit == 'G':
+            break
+        bytes_per_second /= 1000
+    return f'{bytes_per_second:.0f}{unit}' if bytes_per_second >= 10 or not unit else f'{bytes_per_second:.1f}{unit}'
+
+
+# palette indexes of a graph key. text is antialiased into TEXT_LEVELS shades
+# of text color over the background, starting at TEXT
+BACKGROUND, GRAPH, OVERLAY, TEXT = 0, 1, 2, 3
+TEXT_LEVELS = 16
+
+
+@functools.lru_cache(maxsize=64)
+def palette(background:str, graph:str, overlay:str, text:str) -> bytes:
+    bg, fg = np.array(ImageColor.getrgb(background)[:3]), np.array(ImageColor.getrgb(text)[:3])
+    colors = [bg, np.array(ImageColor.getrgb(graph)[:3]), np.array(ImageColor.getrgb(overlay)[:3])]
+    colors.extend(bg + (fg - bg) * level / (TEXT_LEVELS - 1) for level in range(TEXT_LEVELS))
+    return np.rint(colors).astype(np.uint8).tobytes()
+
+
+@functools.lru_cache(maxsize=1024)
+def glyph(char:str, size:int) -> np.ndarray:
+    """palette indexes of one character of the (monospace) label font, one text line high; 0 where it's blank"""
+    font = load_font(text_font_path, size)
+    ascent, descent = font.getmetrics()
+    img = PILImage.new('L', (int(round(font.getlength('0'))), ascent + descent))
+    Draw(img).text((0, 0), char, font=font, fill=255)
+    levels = np.rint(np.asarray(img, dtype=np.float32) * ((TEXT_LEVELS - 1) / 255)).astype(np.uint8)
+    return np.where(levels > 0, levels + TEXT, 0).astype(np.uint8)
+
+
+@functools.lru_cache(maxsize=1024)
+def label_line(line:str, size:int) -> np.ndarray:
+    """one line of a label, as palette indexes; values come round again often enough to keep"""
+    glyphs = np.hstack([glyph(char, size) for char in line])
+    glyphs.flags.writeable = False
+    return glyphs
+
+
+def draw_label(indexes:np.ndarray, text:str, size:int, x:int=3, y:int=2):
+    """
+    write `text` into a palette-index image. labels change every tick, so
+    they're put together from cached glyphs instead of going through PIL's
+    text layout
+    """
+    height, width = indexes.shape
+    for line in text.split('\n'):
+        if not line:
+            continue
+        glyphs = label_line(line, size)[:height - y, :width - x]
+        region = indexes[y:y + glyphs.shape[0], x:x + glyphs.shape[1]]
+        np.copyto(region, glyphs, where=glyphs > 0)
+        y += glyphs.shape[0]
+        if y >= height:
+            break
+
+
+class RefreshBinding(Binding):
+    """asks a MonitorButton to redraw after each sample, instead of setting fields"""
+    def __init__(self, button:'MonitorButton', source:Source, scheduler:SourceScheduler):
+        super().__init__(button, source, scheduler)
+
+    def apply(self, value):
+        button = self.button()
+        if button is not None:
+            button.refresh()
+
+
+class MonitorButton(Button):
+    """
+    A graph of one or two SystemSource series with the latest value as a label.
+
+    `kind` is 'sparkline' (history as a filled area, one column per sample)
+    or 'bar' (the latest value across the key). `scale` is the value at the
+    top of the graph; None scales to the largest value showing. A second
+    series (`overlay`, e.g. net_tx over net_rx) is drawn as a line.
+    """
+    __slots__ = (
+        'source', 'series', 'overlay', 'label', 'kind', 'scale',
+        'graph_color', 'overlay_color', 'shown', 'binding',
+    )
+
+    def __init__(
+        self, source:SystemSource, series:str, label:str,
+        kind:str='sparkline', scale:Optional[float]=None, overlay:Optional[str]=None,
+        graph_color:str='#4a4', overlay_color:str='#ddd',
+        fn:Optional[Callable]=None, name:Optional[str]=None,
+        style:ButtonStyle=ButtonStyle(background_color='#111', text_color='#fff', font_size=18),
+        scheduler:Optional[SourceScheduler]=None,
+    ):
+        super().__init__(fn, name, text=label, style=style)
+        for s in (series, overlay):
+            if s is not None and s not in SERIES:
+                raise ValueError(f"unknown series '{s}'; options: {list(SERIES)}")
+        if kind not in ('sparkline', 'bar'):
+            raise ValueError(f"kind must be 'sparkline' or 'bar', not '{kind}'")
+        self.source = source
+        self.series = series
+        self.overlay = overlay
+        self.label = label
+        self.kind = kind
+        self.scale = scale
+        self.graph_color = graph_color
+        self.overlay_color = overlay_color
+        self.shown = None
+        # only bound (so the source is only sampled) while the button is showing
+        self.binding = RefreshBinding(self, source, scheduler or SourceScheduler.shared())
+
+    def set_slot(self, slot:ButtonSlot):
+        shown = self.slot is not None
+        super().set_slot(slot)
+        if not shown:
+            self.binding.scheduler.add(self.binding)
+
+    def clear_slot(self):
+        super().clear_slot()
+        self.binding.unbind()
+
+    def window(self) -> int:
+        return self.style.size[0] if self.kind == 'sparkline' else 1
+
+    def label_text(self) -> str:
+        value = self.source.rings[self.series].latest()
+        if SERIES[self.series] == '%':
+            text = f'{self.label} {value:.0f}%'
+        else:
+            text = f'{self.label} {format_rate(value)}'
+        if self.overlay is not None:
+            text += f'\n{format_rate(self.source.rings[self.overlay].latest())}'
+        return text
+
+    def refresh(self):
+        """redraw if what the key shows has changed since the last sample"""
+        if self.slot is None:
+            return
+        n = self.window()
+        shown = (self.label_text(), self.source.rings[self.series].last(n).tobytes())
+        if self.overlay is not None:
+            shown += (self.source.rings[self.overlay].last(n).tobytes(),)
+        if shown == self.shown:
+            return
+        self.shown = shown
+        self.alert_slot_button_changed()
+
+    def render_kind(self) -> str:
+        return 'graph'
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        # every frame is different, so the payload cache would only push useful entries out
+        start = time.perf_counter()
+        payload = self.draw(rotation, encoder)
+        metrics.render_seconds.observe(time.perf_counter() - start, kind='graph')
+        metrics.renders.inc(kind='graph')
+        return payload
+
+    def draw(self, rotation:int, encoder:KeyImageEncoder, pressed:Optional[bool]=None) -> bytes:
+        # drawn as palette indexes (one byte a pixel, no blending) and expanded to RGB by PIL once at the end
+        width, height = self.style.size
+        indexes = np.zeros((height, width), dtype=np.uint8)
+        rings = self.source.rings
+        # the label takes the top of the key
+        graph_top = height // 3
+        graph_height = height - graph_top
+
+        values = rings[self.series].last(self.window())
+        series = [values]
+        if self.overlay is not None:
+            series.append(rings[self.overlay].last(self.window()))
+        scale = self.scale or max(max((float(s.max()) for s in series if len(s)), default=0.0), 1.0)
+
+        if self.kind == 'bar':
+            filled = int(round(min(max(rings[self.series].latest() / scale, 0.0), 1.0) * width))
+            indexes[graph_top:, :filled] = GRAPH
+        elif len(values):
+            # sample i is column (width - n + i): newest on the right
+            tops = height - np.rint(np.clip(values / scale, 0, 1) * graph_height).astype(np.int32)
+            rows = np.arange(height, dtype=np.int32)[:, None]
+            indexes[:, width - len(values):] = rows >= tops[None, :]
+            if self.overlay is not None and len(series[1]):
+                overlay = series[1]
+                tops = height - np.rint(np.clip(overlay / scale, 0, 1) * (graph_height - 1)).astype(np.int32) - 1
+                indexes[tops, np.arange(width - len(overlay), width)] = OVERLAY
+
+        draw_label(indexes, self.label_text(), int(self.style.font_size))
+        img = PILImage.frombuffer('P', (width, height), indexes.tobytes(), 'raw', 'P', 0, 1)
+        img.putpalette(palette(
+            self.get_background_color(pressed), self.graph_color, self.overlay_color, self.style.text_color,
+        ))
+        return encoder.to_native(img.convert('RGB'), rotation, GRAPH_FRAME)
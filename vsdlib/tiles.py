@@ -0,0 +1,202 @@
+"""
+Fast redraws for keys that show a changing number in a fixed layout: clocks,
+counters, a calculator's readout.
+
+A key's text is normally laid out from scratch for every frame, fitting the
+font and all. A TileButton instead lays out a grid of character cells once
+(from a template like '88:88:88'), rasterizes each character of the
+monospace font once as a tile, and keeps the key's last frame around, so the
+next frame only copies in the tiles of the cells that changed. A clock
+ticking from 12:00:01 to 12:00:02 redraws one cell before encoding.
+
+    clock = TileButton(template='88:88:88\\n 88-88W\\n  8888', style=ButtonStyle(**whites))
+    bind(clock, TimerSource(1), text=format_clock)
+
+Text that doesn't fit the template is drawn the normal way.
+"""
+import time
+import threading
+import functools
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image as PILImage
+from PIL.ImageDraw import Draw
+
+from .buttons import Button
+from .button_style import ButtonStyle
+from .images import KeyImageEncoder, load_font, text_font_path, colorize
+from . import metrics
+
+
+# drawn up front for every tile set; anything else is drawn the first time it's shown
+NUMERIC_CHARS = '0123456789:-.,+*/%() '
+# pixels between rows, like PIL's multiline text
+LINE_SPACING = 4
+ALIGNMENTS = ('left', 'right')
+
+
+def check_align(align:str):
+    if align not in ALIGNMENTS:
+        raise ValueError(f"align must be one of {ALIGNMENTS}, not '{align}'")
+
+
+class TileSet:
+    """every character of one monospace font at one size, as alpha masks the size of a cell"""
+    tiles: Dict[str, np.ndarray]
+
+    def __init__(self, font_path:str, size:int):
+        self.font = load_font(font_path, size)
+        ascent, descent = self.font.getmetrics()
+        self.cell_size = (int(round(self.font.getlength('0'))), ascent + descent)
+        self.tiles = dict()
+        self.lock = threading.Lock()
+        for char in NUMERIC_CHARS:
+            self.get(char)
+
+    def get(self, char:str) -> np.ndarray:
+        tile = self.tiles.get(char)
+        if tile is None:
+            with self.lock:
+                tile = self.tiles.get(char)
+                if tile is None:
+                    img = PILImage.new('L', self.cell_size, 0)
+                    Draw(img).text((0, 0), char, font=self.font, fill=255)
+                    tile = np.asarray(img)
+                    tile.flags.writeable = False
+                    self.tiles[char] = tile
+        return tile
+
+
+@functools.lru_cache(maxsize=64)
+def tile_set(font_path:str, size:int) -> TileSet:
+    return TileSet(font_path, size)
+
+
+class TileLayout:
+    """
+    Where each cell of a template goes on a key: the font is shrunk from
+    `font_size` until the whole grid fits, and the grid is centered. Rows are
+    as long as the template's lines; text is left- or right-aligned in them.
+    """
+    def __init__(
+        self, template:str, font_size:int, size:Tuple[int,int],
+        align:str='left', font_path:str=text_font_path,
+    ):
+        check_align(align)
+        self.columns = [len(line) for line in template.split('\n')]
+        self.align = align
+        self.size = size
+        width, height = size
+        rows = len(self.columns)
+        while True:
+            tiles = tile_set(font_path, font_size)
+            cell_width, cell_height = tiles.cell_size
+            grid_width = cell_width * max(self.columns)
+            grid_height = cell_height * rows + LINE_SPACING * (rows - 1)
+            if (grid_width <= width and grid_height <= height) or font_size <= 1:
+                break
+            font_size -= 1
+        self.tiles = tiles
+        left, top = (width - grid_width) // 2, max(0, (height - grid_height) // 2)
+        self.origins = [
+            [(left + column * cell_width, top + row * (cell_height + LINE_SPACING)) for column in range(columns)]
+            for row, columns in enumerate(self.columns)
+        ]
+
+    def cells(self, text:str) -> Optional[List[str]]:
+        """`text` padded out to the template's rows, or None if it doesn't fit them"""
+        lines = text.split('\n')
+        if len(lines) > len(self.columns):
+            return None
+        lines += [''] * (len(self.columns) - len(lines))
+        if any(len(line) > columns for line, columns in zip(lines, self.columns)):
+            return None
+        if self.align == 'right':
+            return [line.rjust(columns) for line, columns in zip(lines, self.columns)]
+        return [line.ljust(columns) for line, columns in zip(lines, self.columns)]
+
+
+class TileDisplay:
+    """the last frame drawn for a layout, and the characters in each of its cells"""
+    shown: List[List[Optional[str]]]
+    # the (font_size, key size) the layout was made for
+    key: Tuple[int, Tuple[int,int]]
+
+    def __init__(self, layout:TileLayout):
+        self.layout = layout
+        width, height = layout.size
+        self.mask = np.zeros((height, width), dtype=np.uint8)
+        # nothing drawn yet; a blank mask is what ' ' looks like, but None makes sure every cell is drawn once
+        self.shown = [[None] * columns for columns in layout.columns]
+        self.lock = threading.Lock()
+
+    def compose(self, text:str) -> Optional[np.ndarray]:
+        """the alpha mask showing `text` (a copy, so the next frame doesn't change it), or None if it doesn't fit"""
+        lines = self.layout.cells(text)
+        if lines is None:
+            return None
+        tiles = self.layout.tiles
+        cell_width, cell_height = tiles.cell_size
+        with self.lock:
+            for line, shown, origins in zip(lines, self.shown, self.layout.origins):
+                for column, char in enumerate(line):
+                    if shown[column] == char:
+                        continue
+                    x, y = origins[column]
+                    self.mask[y:y + cell_height, x:x + cell_width] = tiles.get(char)
+                    shown[column] = char
+            return self.mask.copy()
+
+
+class TileButton(Button):
+    """
+    A text button for numbers that change often (see the module docstring).
+    `template` gives the grid: one row per line, as many cells as the line
+    has characters. Its characters don't matter beyond that.
+    """
+    __slots__ = ('template', 'align', 'display')
+
+    def __init__(
+        self, fn=None, name:Optional[str]=None, text:Optional[str]='',
+        template:str='88:88:88', align:str='left',
+        button_switches_page:bool=False, style:ButtonStyle=ButtonStyle(),
+    ):
+        super().__init__(fn, name, text=text, button_switches_page=button_switches_page, style=style)
+        check_align(align)
+        self.template = template
+        self.align = align
+        # laid out on the first frame, once the board has set the key size
+        self.display = None
+
+    def get_display(self) -> TileDisplay:
+        key = (int(self.style.font_size), tuple(self.style.size))
+        display = self.display
+        if display is None or display.key != key:
+            display = TileDisplay(TileLayout(self.template, key[0], key[1], self.align))
+            display.key = key
+            self.display = display
+        return display
+
+    def render_kind(self) -> str:
+        return 'tiles'
+
+    def render(self, rotation:int, encoder:KeyImageEncoder) -> bytes:
+        # frames hardly ever repeat, so the payload cache would only push useful entries out
+        if self.style.image_path is not None:
+            return super().render(rotation, encoder)
+        start = time.perf_counter()
+        payload = self.draw(rotation, encoder)
+        metrics.render_seconds.observe(time.perf_counter() - start, kind='tiles')
+        metrics.renders.inc(kind='tiles')
+        return payload
+
+    def draw(self, rotation:int, encoder:KeyImageEncoder, pressed:Optional[bool]=None) -> bytes:
+        if self.style.image_path is not None:
+            return super().draw(rotation, encoder, pressed)
+        display = self.get_display()
+        mask = display.compose(self.text)
+        if mask is None:
+            return super().draw(rotation, encoder, pressed)
+        img = colorize(mask, self.get_background_color(pressed), self.style.text_color)
+        return encoder.to_native(img, rotation)
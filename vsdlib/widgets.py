@@ -1,11 +1,15 @@
 from typing import Dict, Optional, List
 import subprocess
-import time
 import threading
 import datetime
 
 from vsdlib.board import Board
-from vsdlib.buttons import Button, EmojiButton
+from vsdlib.scrolling import ScrollingListLayout
+from vsdlib.buttons import Button, EmojiButton, render_batch
+from vsdlib.calculator import CalculatorEngine
+from vsdlib.bindings import bind, TimerSource
+from vsdlib.sysmon import SystemSource, MonitorButton
+from vsdlib.tiles import TileButton
 from vsdlib.button_style import ButtonStyle
 from vsdlib.colors import grays, greens, blues, reds, pinks, whites
 
@@ -59,32 +63,43 @@ class DiscordWidget(Widget):
         return send_mute_keystroke
 
 
+DAY_OF_WEEK_LETTERS = 'MTWRFSU'
+# the cells format_clock fills
+CLOCK_TEMPLATE = '88:88:88\n 88-88W\n  8888'
+READOUT_TEMPLATE = '88888888'
+
+
+def format_clock(now:datetime.datetime) -> str:
+    dow = DAY_OF_WEEK_LETTERS[now.weekday()]
+    return now.strftime(
+        f'%H:%M:%S\n'      # 8
+        f' %m-%d{dow}\n'   # 6
+        f'  %Y'            # 4
+    )
+
+
 class ClockWidget(Widget):
     def __init__(self, board:Board, style:ButtonStyle=ButtonStyle(**whites)):
         super().__init__(board, style)
-        self.clock_button = Button(lambda *args, **kwargs: None, style=style)
-        self.clock_thread = threading.Thread(target=self.keep_clock_updated, daemon=True)
-        self.clock_thread.start()
-
-    def keep_clock_updated(self):
-        dow_lookup = {
-            0: 'M',
-            1: 'T',
-            2: 'W',
-            3: 'R',
-            4: 'F',
-            5: 'S',
-            6: 'U',
-        }
-        while True:
-            now = datetime.datetime.now()
-            dow = dow_lookup[now.weekday()]
-            self.clock_button.set(text=now.strftime(
-                f'%H:%M:%S\n'      # 8
-                f' %m-%d{dow}\n'   # 6
-                f'  %Y'            # 4
-            ))
-            time.sleep(1)
+        # only the digits that changed are redrawn each second
+        self.clock_button = TileButton(lambda *args, **kwargs: None, template=CLOCK_TEMPLATE, style=style)
+        # every clock shares one timer, which the idle manager pauses
+        self.clock_binding = bind(self.clock_button, TimerSource(1), text=format_clock)
+
+
+class SystemMonitorWidget(Widget):
+    """cpu, memory, network and disk graphs, all fed by one SystemSource sampling every `interval` seconds"""
+    def __init__(
+        self, board:Board, interval:float=0.5,
+        style:ButtonStyle=ButtonStyle(background_color='#111', text_color='#fff', font_size=18),
+    ):
+        super().__init__(board, style)
+        source = SystemSource(interval)
+        self.cpu_button = MonitorButton(source, 'cpu', 'cpu', scale=100, graph_color='#4a4', style=style)
+        self.memory_button = MonitorButton(source, 'memory', 'mem', kind='bar', scale=100, graph_color='#48c', style=style)
+        # received as the area, sent as the line
+        self.network_button = MonitorButton(source, 'net_rx', 'net', overlay='net_tx', graph_color='#a6c', style=style)
+        self.disk_button = MonitorButton(source, 'disk_read', 'disk', overlay='disk_write', graph_color='#c84', style=style)
 
 
 def create_try_playerctl_command(command:str='play-pause'):
@@ -168,34 +183,38 @@ class KeyPadWidget(Widget):
 
 class NumPadWidget(Widget):
     number_buttons: Dict[int, Button]
-    entries: List
+    engine: CalculatorEngine
     spool_display_widget: Button
     bvalue: Button
-    def __init__(self, board:Board, style:ButtonStyle):
-        self.entries = []
+    def __init__(self, board:Board, style:ButtonStyle, precise:bool=False):
+        self.engine = CalculatorEngine(precise=precise)
         self.number_buttons: Dict[int, Button] = dict()
-        self.spool_display_widget = Button(text='0')#, style=style)
-        self.bvalue = Button(text='0')#, style=style)
+        # redrawn on every key press; right-aligned like a calculator's readout, longer text is fitted as usual
+        self.spool_display_widget = TileButton(text='0', template=READOUT_TEMPLATE, align='right')#, style=style)
+        self.bvalue = TileButton(text='0', template=READOUT_TEMPLATE, align='right')#, style=style)
         for i in range(10):
             self.number_buttons[i] = Button(self.create_number_button_callback(i), text=str(i))#, style=style)
 
+    @property
+    def entries(self) -> List[str]:
+        return self.engine.entries
+
     def create_number_button_callback(self, number:int):
         def press_number_button(pressed:bool):
             if not pressed:
                 return
-            self.entries.append(number)
-            joined = self.get_joined()
-            self.spool_display_widget.set(text=joined)
-            self.bvalue.set(text=f'{eval(joined):.2f}')
-            try:
-                self.bvalue.set(text=f'{eval(joined):.2f}')
-            except:
-                print(f"failed to evaluate: '{joined}'")
-                self.bvalue.set(text=joined)
+            self.engine.push(number)
+            self.update_displays()
         return press_number_button
 
+    def update_displays(self):
+        # both keys change together; send them as one update
+        with render_batch():
+            self.spool_display_widget.set(text=self.engine.text)
+            self.bvalue.set(text=self.engine.format_value())
+
     def get_joined(self):
-        return ''.join(str(v) for v in self.entries)
+        return self.engine.text
 
 
 class VSCodeWidget(Widget):
@@ -232,9 +251,9 @@ class CalculatorWidget(NumPadWidget):
     bdiv: Button
     bbackspace: Button
     result_style = ButtonStyle(background_color='#37d495', pressed_background_color='#297858')
-    def __init__(self, board:Board, style:ButtonStyle=ButtonStyle()):
+    def __init__(self, board:Board, style:ButtonStyle=ButtonStyle(), precise:bool=False):
         # super().__init__(board, self.result_style)
-        super().__init__(board, style)
+        super().__init__(board, style, precise=precise)
 
         operator_style = ButtonStyle(**grays)
         self.bdecimal = Button(self.create_operation_button_callback('.'), text='.', style=operator_style)
@@ -254,57 +273,35 @@ class CalculatorWidget(NumPadWidget):
         def perform_clear(pressed:bool):
             if not pressed:
                 return
-            self.entries.clear()
-            print("setting spool display to ''")
-            self.spool_display_widget.set(text='')
-            # self.spool_display_widget.alert_slot_button_changed()
-            print("setting value display to ''")
-            self.bvalue.set(text='')
-            # self.bvalue.alert_slot_button_changed()
+            self.engine.clear()
+            self.update_displays()
         return perform_clear
 
     def create_backspace_button_callback(self):
         def perform_backspace(pressed:bool):
             if not pressed:
                 return
-            try:
-                self.entries.pop()
-                joined = self.get_joined()
-                self.spool_display_widget.set(text=joined)
-                try:
-                    self.bvalue.set(text=f"{eval(joined):.2f}")
-                except:
-                    self.bvalue.set(text=joined)
-            except:
-                pass
+            if self.engine.pop() is not None:
+                self.update_displays()
         return perform_backspace
 
     def create_equals_button_callback(self):
         def perform_equals(pressed:bool):
             if not pressed:
                 return
-            try:
-                joined = self.get_joined()
-                newval = f'{eval(joined):.2f}'
-                self.entries = [c for c in newval]
-                self.spool_display_widget.set(text=newval)
-                self.bvalue.set(text=newval)
-            except:
-                pass
+            value = self.engine.value()
+            if value is None:
+                return
+            self.engine.set(f'{value:.2f}')
+            self.update_displays()
         return perform_equals
 
     def create_operation_button_callback(self, operation:str):
         def perform_operation(pressed:bool):
             if not pressed:
                 return
-            self.entries.append(operation)
-            joined = self.get_joined()
-            self.spool_display_widget.set(text=joined)
-            try:
-                value = f'{eval(joined):.2f}'
-            except:
-                value = joined
-            self.bvalue.set(text=value)
+            self.engine.push(operation)
+            self.update_displays()
 
         return perform_operation
 
@@ -362,6 +359,9 @@ class BluetoothWidget(Widget):
             button.fn = toggle_connection_callback
             self.buttons.append(button)
 
+    def create_layout(self) -> ScrollingListLayout:
+        """one key per paired device, scrolling if there are more devices than keys"""
+        return ScrollingListLayout(self.buttons, style=self.style)
 
     @staticmethod
     def generate_toggle_connection_callback(button:Button, name, mac, connected):
@@ -0,0 +1,133 @@
+import time
+import threading
+import logging
+from typing import Callable, Dict, Optional
+
+from StreamDeck.Devices.StreamDeck import StreamDeck
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class KeyWriter:
+    """
+    Sends key images to the stream deck from a single background thread.
+
+    Has the same `set_key_image` signature as StreamDeck so a ButtonSlot can
+    write through it. Writes that haven't gone out yet are coalesced per key:
+    if a key is set twice before the device catches up, only the newest image
+    is sent.
+
+    The last image written to each key is kept in `frames`, so after the
+    device has been reconnected everything can be sent again with `replay`
+    instead of re-rendered. When a write fails, `on_error` (if set) is called
+    with the exception; the writer keeps the image and holds off until
+    `resume` is called if `on_error` paused it.
+    """
+    sd: StreamDeck
+    pending: Dict[int, bytes]
+    frames: Dict[int, bytes]
+    on_error: Optional[Callable[[Exception], None]] = None
+
+    def __init__(self, sd:StreamDeck):
+        self.sd = sd
+        self.pending = dict()
+        self.frames = dict()
+        self.writing = False
+        self.running = True
+        self.paused = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def set_key_image(self, index:int, image:bytes):
+        with self.condition:
+            self.pending[index] = image
+            self.condition.notify_all()
+
+    def set_key_images(self, images:Dict[int, bytes]):
+        """queue several keys at once, so none of them goes out before the rest are queued"""
+        with self.condition:
+            self.pending.update(images)
+            self.condition.notify_all()
+
+    def key_image_format(self) -> dict:
+        return self.sd.key_image_format()
+
+    def backlog(self) -> int:
+        """number of keys waiting to be written"""
+        return len(self.pending)
+
+    def flush(self, timeout:Optional[float]=None) -> bool:
+        """block until every pending image has been written (or the writer is paused)"""
+        with self.condition:
+            self.condition.wait_for(lambda: (not self.pending and not self.writing) or self.paused, timeout)
+            return not self.pending and not self.writing
+
+    def pause(self):
+        """stop sending (queued images are kept) until `resume`"""
+        with self.condition:
+            self.paused = True
+
+    def resume(self, sd:Optional[StreamDeck]=None, replay:bool=False):
+        """
+        start sending again, to `sd` if given. with `replay`, every key's last
+        image is sent again (the device came back blank); otherwise keys
+        queued with the image they already show are dropped
+        """
+        with self.condition:
+            if sd is not None:
+                self.sd = sd
+            if replay:
+                self.pending = {**self.frames, **self.pending}
+            else:
+                self.pending = {
+                    index: image for index, image in self.pending.items()
+                    if self.frames.get(index) != image
+                }
+            self.paused = False
+            self.condition.notify_all()
+
+    def replay(self):
+        with self.condition:
+            self.pending = {**self.frames, **self.pending}
+            self.condition.notify_all()
+
+    def close(self, timeout:Optional[float]=5):
+        self.flush(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+                self.condition.wait_for(lambda: (self.pending and not self.paused) or not self.running)
+                if not self.running:
+                    return
+                index = next(iter(self.pending))
+                image = self.pending.pop(index)
+                sd = self.sd
+                self.writing = True
+            start = time.perf_counter()
+            try:
+                sd.set_key_image(index, image)
+            except Exception as e:
+                metrics.key_write_errors.inc()
+                if self.on_error is None:
+                    logger.exception(f"Failed to write image to key {index}; error: {e}")
+                    continue
+                with self.condition:
+                    # keep it for when the device is back, unless it's been replaced already
+                    self.pending.setdefault(index, image)
+                self.on_error(e)
+            else:
+                metrics.key_write_seconds.observe(time.perf_counter() - start)
+                metrics.key_write_bytes.observe(len(image))
+                with self.condition:
+                    self.frames[index] = image